@@ -0,0 +1,302 @@
+# """
+# Run a filter/edge pipeline over a whole directory (or glob) of images instead of one hardcoded file.
+#
+# Images are spread over a pool of worker processes, with only a few in flight at a time so a big
+# directory doesn't get decoded into memory all at once. Each worker decodes straight to float32 in
+# [0, 1], since load()'s float64 copy is twice the memory and isn't needed by any stage here, and
+# writes its result itself: either into its slot of one preallocated memory-mapped .npy stack (every
+# image has to come out the same shape) or as an image file per input. Only a status goes back to
+# the parent process, never the pixels.
+#
+# A pipeline is a comma-separated list of stages, each with colon-separated arguments:
+#   gray                        grayscale, rgb2gray's weights (pixelops.grayscale)
+#   blur:ksize[:sigma]          Gaussian blur (convolution.gaussian_kernel, sigma 0 = OpenCV's default)
+#   box:ksize                   mean filter (convolution.box_filter)
+#   boxgauss:sigma              iterated-box approximation to a Gaussian (convolution.box_gaussian)
+#   kernel:name                 one of the kernels from filters.py, e.g. kernel:blur_nicely
+#   threshold:cutoff            1 where brighter than cutoff, 0 elsewhere
+#   canny:low:high[:sigma[:ksize]]  canny.canny on a grayscale image (thresholds are in [0, 1] units)
+#
+# Usage:
+#   python batch.py "frames/*.png" gray,blur:5,canny:0.1:0.2 --out edges.npy
+#   python batch.py photos/ kernel:blur_nicely --out blurred/ --workers 4
+#   python batch.py frames/ gray,canny:0.1:0.2 --profile trace.json   # where the time goes, per stage
+# """
+
+import argparse
+import os
+import resource
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from time import perf_counter
+
+import numpy as np
+
+import profiling
+from profiling import profiled, stage
+
+# Kernels from filters.py that `kernel:name` can refer to
+KERNELS = ("filter1", "filter2", "filter3", "blur_nicely", "fil", "fil2", "shift")
+
+
+@profiled
+def read_float32(path):
+    """
+    Decode an image to float32 in [0, 1], RGB channel order like load(). The uint8 pixels are
+    scaled straight into the float32 result, so there's no float64 intermediate.
+    """
+    import cv2
+
+    pixels = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if pixels is None:
+        raise IOError(f"couldn't read {path}")
+    if pixels.ndim == 3 and pixels.shape[2] == 2:
+        # Gray + alpha: keep the gray
+        pixels = pixels[:, :, 0]
+    elif pixels.ndim == 3:
+        # BGR(A) -> RGB, dropping alpha
+        pixels = pixels[:, :, 2::-1]
+    scale = np.float32(1 / np.iinfo(pixels.dtype).max) if pixels.dtype.kind == "u" else np.float32(1)
+    return np.multiply(pixels, scale, dtype=np.float32)
+
+
+def parse_pipeline(spec):
+    """
+    Args:
+        spec: pipeline string, see the top of this file.
+    Returns:
+        list of (stage name, tuple of float arguments) (kernel:name keeps its name as a string).
+    """
+    arities = {"gray": (0, 0), "blur": (1, 2), "box": (1, 1), "boxgauss": (1, 1), "kernel": (1, 1),
+               "threshold": (1, 1), "canny": (2, 4)}
+    stages = []
+    for part in spec.split(","):
+        name, *args = part.strip().split(":")
+        if name not in arities:
+            raise ValueError(f"unknown stage {name!r}, expected one of {', '.join(arities)}")
+        fewest, most = arities[name]
+        if not fewest <= len(args) <= most:
+            raise ValueError(f"stage {name!r} takes {fewest} to {most} arguments, got {part!r}")
+        if name == "kernel":
+            if args[0] not in KERNELS:
+                raise ValueError(f"unknown kernel {args[0]!r}, expected one of {', '.join(KERNELS)}")
+            stages.append((name, tuple(args)))
+        else:
+            stages.append((name, tuple(float(arg) for arg in args)))
+    return stages
+
+
+@profiled
+def run_pipeline(image, stages, boundary="replicate"):
+    """
+    Args:
+        image: float32 image from `read_float32`.
+        stages: output of `parse_pipeline`.
+        boundary: boundary mode for the filter stages, see convolution.pad_image.
+    Returns:
+        the last stage's output (float32, or boolean after canny).
+    """
+    import convolution
+    from pixelops import grayscale
+
+    for name, args in stages:
+        if name == "gray":
+            if image.ndim == 3:
+                image = grayscale(image)
+        elif name == "blur":
+            kernel = convolution.gaussian_kernel(int(args[0]), *args[1:])
+            image = convolution.convolve(image, kernel, boundary, dtype=np.float32)
+        elif name == "box":
+            image = convolution.box_filter(image, int(args[0]), boundary, dtype=np.float32)
+        elif name == "boxgauss":
+            image = convolution.box_gaussian(image, args[0], boundary, dtype=np.float32)
+        elif name == "kernel":
+            import filters
+            image = convolution.convolve(image, getattr(filters, args[0]), boundary, dtype=np.float32)
+        elif name == "threshold":
+            image = (image > args[0]).astype(np.float32)
+        elif name == "canny":
+            from canny import canny
+            low, high, *blur = args
+            sigma = blur[0] if blur else 1.0
+            ksize = int(blur[1]) if len(blur) > 1 else None
+            image = canny(image, low, high, sigma=sigma, ksize=ksize)
+    return image
+
+
+# Per-worker state, set up by _start_worker
+_worker = {}
+
+
+def _start_worker(spec, boundary, numba_threads, profile):
+    # Several processes each running numba's full thread pool would fight over the cores
+    os.environ["NUMBA_NUM_THREADS"] = str(numba_threads)
+    _worker.update(stages=parse_pipeline(spec), boundary=boundary, stack=None)
+    if profile:
+        profiling.enable()
+
+
+def _process(index, path, out, stack_path=None):
+    """
+    Runs in a worker. Writes the result for one image to its slot of the stack at stack_path, or
+    to a file in the directory out if there's no stack (or nowhere, if out is None too).
+
+    Returns:
+        (index, result, error, events): result is only sent back when asked for with out ==
+        "return", and events are the profiled stages since the last image (None if profiling is
+        off).
+    """
+    result = error = None
+    try:
+        result = run_pipeline(read_float32(path), _worker["stages"], _worker["boundary"])
+        if stack_path is not None and out != "return":
+            if _worker["stack"] is None:
+                _worker["stack"] = np.load(stack_path, mmap_mode="r+")
+            stack = _worker["stack"]
+            if result.shape != stack.shape[1:]:
+                raise ValueError(f"result has shape {result.shape}, the stack holds {stack.shape[1:]}")
+            with stage("batch.write_stack", result.nbytes):
+                stack[index] = result
+        elif out is not None and out != "return":
+            from imagewriter import write_image
+            write_image(os.path.join(out, os.path.splitext(os.path.basename(path))[0] + ".png"), result)
+    except Exception as exception:
+        error = f"{type(exception).__name__}: {exception}"
+    events = profiling.REGISTRY.drain() if profiling.enabled() else None
+    return index, result if out == "return" else None, error, events
+
+
+def peak_rss_mb():
+    """
+    Returns:
+        (this process's peak RSS, the largest peak RSS of any finished child process), in MB.
+    """
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return tuple(resource.getrusage(who).ru_maxrss * unit / 2 ** 20
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def run_batch(paths, spec, out=None, boundary="replicate", workers=None, prefetch=None, numba_threads=1,
+              profile=False):
+    """
+    Run a pipeline over many images with a process pool.
+
+    Args:
+        paths: image files.
+        spec: pipeline string, see the top of this file.
+        out: where results go:
+            "something.npy" - one memory-mapped stack, stack[i] is the result for paths[i] (slots of
+                              images that failed are left as zeros)
+            a directory     - one PNG per input, named after it
+            None            - nowhere (just time the pipeline)
+        boundary: boundary mode for the filter stages.
+        workers: number of worker processes. Defaults to os.cpu_count().
+        prefetch: most images in flight at once. Defaults to 2 per worker.
+        numba_threads: threads each worker's compiled kernels may use.
+        profile: profile the stages in every worker and collect them into profiling.REGISTRY
+            here.
+    Returns:
+        dict with "images", "seconds", "images_per_second", "failed" (list of (path, error)), and
+        "peak_rss_mb": (parent, largest worker).
+    """
+    import multiprocessing
+
+    parse_pipeline(spec)  # fail here rather than in every worker
+    workers = workers or os.cpu_count()
+    prefetch = max(prefetch or 2 * workers, 1)
+    stack_path = out if out is not None and out.endswith(".npy") else None
+    if out is not None and stack_path is None:
+        os.makedirs(out, exist_ok=True)
+
+    failed = []
+    start = perf_counter()
+    # spawn, not fork: a forked child would inherit whatever thread pools the parent had running
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_start_worker,
+                             initargs=(spec, boundary, numba_threads, profile)) as pool:
+        pending = iter(enumerate(paths))
+        in_flight = set()
+        if stack_path is not None:
+            # The stack's shape comes from the first image that makes it through the pipeline
+            stack = None
+            for index, path in pending:
+                _, result, error, events = pool.submit(_process, index, path, "return").result()
+                if events:
+                    profiling.REGISTRY.extend(events)
+                if error is not None:
+                    failed.append((path, error))
+                    continue
+                stack = np.lib.format.open_memmap(stack_path, mode="w+", dtype=result.dtype,
+                                                  shape=(len(paths),) + result.shape)
+                stack[index] = result
+                stack.flush()
+                del stack
+                break
+
+        def submit():
+            for index, path in pending:
+                in_flight.add(pool.submit(_process, index, path, out, stack_path))
+                if len(in_flight) >= prefetch:
+                    return
+
+        submit()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight -= done
+            for future in done:
+                index, _, error, events = future.result()
+                if events:
+                    profiling.REGISTRY.extend(events)
+                if error is not None:
+                    failed.append((paths[index], error))
+            submit()
+    seconds = perf_counter() - start
+
+    if stack_path is not None and os.path.exists(stack_path):
+        # Which file each slot came from
+        with open(os.path.splitext(stack_path)[0] + ".txt", "w") as listing:
+            listing.writelines(path + "\n" for path in paths)
+    count = len(paths) - len(failed)
+    return {"images": count, "seconds": seconds, "images_per_second": count / seconds if seconds else 0.0,
+            "failed": failed, "peak_rss_mb": peak_rss_mb()}
+
+
+def main(argv=None):
+    from lanes import list_frames
+
+    parser = argparse.ArgumentParser(description="Run a filter/edge pipeline over a directory or glob of images.")
+    parser.add_argument("source", help="directory, glob (quote it) or single image")
+    parser.add_argument("pipeline", help="stages, e.g. gray,blur:5,canny:0.1:0.2 (see the top of batch.py)")
+    parser.add_argument("--out", help="a .npy file for one memory-mapped stack, or a directory for one PNG per image")
+    parser.add_argument("--boundary", default="replicate", help="boundary mode for the filters")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--prefetch", type=int, help="most images in flight at once (default: 2 per worker)")
+    parser.add_argument("--numba-threads", type=int, default=1, help="threads per worker for compiled kernels")
+    parser.add_argument("--profile", metavar="TRACE", help="profile every worker's stages, print a summary and "
+                        "write a Chrome trace here")
+    args = parser.parse_args(argv)
+
+    paths = list_frames(args.source)
+    if not paths:
+        parser.error(f"no images found in {args.source}")
+    try:
+        parse_pipeline(args.pipeline)
+    except ValueError as error:
+        parser.error(str(error))
+    boundary = float(args.boundary) if args.boundary.replace(".", "", 1).lstrip("-").isdigit() else args.boundary
+    summary = run_batch(paths, args.pipeline, args.out, boundary, args.workers, args.prefetch, args.numba_threads,
+                        profile=bool(args.profile))
+
+    for path, error in summary["failed"]:
+        print(f"failed: {path}: {error}")
+    parent, worker = summary["peak_rss_mb"]
+    print(f"{summary['images']} images in {summary['seconds']:.2f} s -> {summary['images_per_second']:.1f} images/s")
+    print(f"peak RSS: {parent:.0f} MB (this process), {worker:.0f} MB (largest worker)")
+    if args.profile:
+        profiling.REGISTRY.print_summary()
+        profiling.REGISTRY.write_chrome_trace(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+# """
+# Benchmark harness for the convolution implementations.
+#
+# Every backend is timed over a grid of image sizes, kernel sizes and dtypes. The first call on each
+# input is timed on its own (for the numba backends that's where compilation happens), followed by
+# a few untimed warmup calls and then `repeats` timed calls that give the steady-state numbers.
+#
+# Usage:
+#   python benchmark.py --out results.json                       # run and save
+#   python benchmark.py --out new.json --baseline results.json   # ...and fail if anything got slower
+#   python benchmark.py --import-budget 0.1                      # just check import times
+#   python benchmark.py --accuracy                               # float32/uint8 results vs float64
+# """
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from time import perf_counter
+
+import numpy as np
+
+import convolution
+
+# Modules that should import quickly (i.e. without dragging in numba, skimage, matplotlib or cv2)
+LIBRARY_MODULES = ("convolution", "filters", "edges")
+
+# Backends that loop over pixels in Python are skipped once pixels * kernel taps goes past this,
+# otherwise a single grid point takes minutes
+PYTHON_LOOP_LIMIT = 2_000_000
+
+
+def default_backends():
+    """
+    Returns:
+        dict mapping backend name to (function(image, kernel), loops_in_python) for every
+        convolution in filters.py and convolution.py.
+    """
+    import filters
+
+    return {
+        "naive": (filters.naive_convolution_filter, True),
+        "numba naive": (filters.numba_convolution_filter, False),
+        "matrix": (filters.matrix_convolution_filter, True),
+        "numba matrix": (filters.numba_matrix_convolution_filter, False),
+        "strided": (convolution.strided_convolution_filter, False),
+        "separable": (convolution.separable_convolution_filter, False),
+        "fft": (convolution.fft_convolution_filter, False),
+        "parallel prange": (convolution.parallel_convolution_filter, False),
+        "parallel threads": (lambda image, kernel: convolution.parallel_convolution_filter(image, kernel, backend="threads"), False),
+        "auto": (convolution.convolve, False),
+        "boundary": (filters.boundary_convolution_filter, False),
+        # The grid's images are single channel: time it as a one-channel image with one kernel
+        "multichannel": (lambda image, kernel: convolution.multichannel_convolution_filter(
+            image[:, :, np.newaxis], [kernel])[:, :, 0], False),
+    }
+
+
+def _time_backend(fn, image, kernel, warmup, repeats):
+    start = perf_counter()
+    fn(image, kernel)
+    first_call = perf_counter() - start
+    for _ in range(warmup):
+        fn(image, kernel)
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        fn(image, kernel)
+        times.append(perf_counter() - start)
+    p10, median, p90 = np.percentile(times, [10, 50, 90])
+    return {
+        "first_call": first_call,
+        # Whatever the first call spent beyond a normal call was compilation (or cache warming)
+        "compile": max(0.0, first_call - median),
+        "min": min(times),
+        "p10": p10,
+        "median": median,
+        "p90": p90,
+        "max": max(times),
+        "repeats": repeats,
+    }
+
+
+def run_benchmarks(backends=None, image_sizes=((256, 256), (1024, 1024)), kernel_sizes=(3, 9, 25),
+                   dtypes=(np.float64, np.float32), repeats=5, warmup=1, seed=0):
+    """
+    Args:
+        backends: dict mapping name to (function(image, kernel), loops_in_python). Defaults to
+            `default_backends()`.
+        image_sizes: (rows, cols) sizes to try.
+        kernel_sizes: side lengths of the (dense, random) square kernels to try.
+        dtypes: image dtypes to try.
+        repeats: timed calls per grid point.
+        warmup: untimed calls between the first call and the timed ones.
+        seed: seed for the random images and kernels.
+    Returns:
+        results: list of dicts, one per (backend, image size, kernel size, dtype), with the timings
+            from above or a "skipped"/"error" entry explaining why there are none.
+    """
+    if backends is None:
+        backends = default_backends()
+    rng = np.random.default_rng(seed)
+    results = []
+    for rows, cols in image_sizes:
+        for kernel_size in kernel_sizes:
+            kernel = rng.standard_normal((kernel_size, kernel_size))
+            for dtype in dtypes:
+                image = rng.random((rows, cols)).astype(dtype)
+                for name, (fn, loops_in_python) in backends.items():
+                    result = {
+                        "backend": name,
+                        "image_size": [rows, cols],
+                        "kernel_size": kernel_size,
+                        "dtype": np.dtype(dtype).name,
+                    }
+                    if loops_in_python and rows * cols * kernel_size ** 2 > PYTHON_LOOP_LIMIT:
+                        result["skipped"] = "too slow for a Python loop"
+                    else:
+                        try:
+                            result.update(_time_backend(fn, image, kernel, warmup, repeats))
+                        except Exception as e:
+                            result["error"] = f"{type(e).__name__}: {e}"
+                    results.append(result)
+    return results
+
+
+def _key(result):
+    return (result["backend"], tuple(result["image_size"]), result["kernel_size"], result["dtype"])
+
+
+def print_results(results):
+    print(f"{'backend':<18} {'image':>11} {'kernel':>6} {'dtype':>8} {'compile':>9} {'median':>9} {'p10':>9} {'p90':>9}")
+    for result in results:
+        image = "x".join(map(str, result["image_size"]))
+        head = f"{result['backend']:<18} {image:>11} {result['kernel_size']:>6} {result['dtype']:>8}"
+        if "median" in result:
+            print(f"{head} {result['compile']:>9.4f} {result['median']:>9.4f} {result['p10']:>9.4f} {result['p90']:>9.4f}")
+        else:
+            print(f"{head}   {result.get('skipped') or result.get('error')}")
+
+
+def write_results(results, path):
+    """Save results as JSON, along with enough about the machine to know whether they're comparable."""
+    import numba
+
+    with open(path, "w") as f:
+        json.dump({
+            "machine": {
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "cpus": os.cpu_count(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "numba": numba.__version__,
+            },
+            "results": results,
+        }, f, indent=2)
+
+
+def check_regressions(results, baseline_path, threshold=1.2):
+    """
+    Args:
+        results: output of `run_benchmarks`.
+        baseline_path: JSON file written by `write_results` on an earlier run.
+        threshold: how many times slower than the baseline median a grid point may get.
+    Returns:
+        regressions: list of (result, baseline result, slowdown) for every grid point over threshold.
+    """
+    with open(baseline_path) as f:
+        baseline = {_key(result): result for result in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(_key(result))
+        if previous is None or "median" not in previous or "median" not in result:
+            continue
+        slowdown = result["median"] / previous["median"]
+        if slowdown > threshold:
+            regressions.append((result, previous, slowdown))
+    return regressions
+
+
+# How far a smaller dtype may stray from the same backend's float64 result: float32 relative to the
+# largest float64 value, integer types in levels (rounding alone already costs half a level)
+ACCURACY_BOUNDS = {"float32": 1e-5, "uint8": 1}
+
+
+def dtype_backends():
+    """
+    Returns:
+        dict mapping backend name to function(image, kernel, dtype=None, out=None) for the
+        convolution.py backends that can return smaller dtypes.
+    """
+    return {
+        "strided": convolution.strided_convolution_filter,
+        "separable": convolution.separable_convolution_filter,
+        "fft": convolution.fft_convolution_filter,
+        "parallel prange": convolution.parallel_convolution_filter,
+        "box": lambda image, kernel, **options: convolution.convolve(image, kernel, method="box", **options),
+        "multichannel": lambda image, kernel, **options: convolution.multichannel_convolution_filter(
+            image, [kernel, None, kernel], **options),
+    }
+
+
+def check_accuracy(image=None, kernels=None, dtypes=("float32", "uint8"), boundary="replicate", seed=0,
+                   backends=None):
+    """
+    Run every backend from `dtype_backends()` (or `backends`) at each smaller dtype, once allocating its own
+    result and once into a caller-supplied out, and compare with its float64 result.
+
+    Args:
+        image: uint8 (H, W, 3) image. Defaults to random noise, the worst case for rounding.
+        kernels: dict mapping name to kernel. Defaults to a box blur, a Gaussian, an edge kernel
+            with negative taps (so uint8 results saturate) and a sparse 25x25 shift.
+        dtypes: result dtypes to check, keys of ACCURACY_BOUNDS.
+        boundary: boundary mode.
+        seed: seed for the default image.
+        backends: dict like `dtype_backends()`'s, to only check some of them.
+    Returns:
+        list of dicts with "backend", "kernel", "dtype", "error", "bound", "memory" (bytes of the
+        result relative to float64) and "ok".
+    """
+    if image is None:
+        image = np.random.default_rng(seed).integers(0, 256, (96, 128, 3), dtype=np.uint8)
+    if kernels is None:
+        shift = np.zeros((25, 25))
+        shift[0, 0] = 1
+        kernels = {
+            "box 3x3": np.full((3, 3), 0.1),
+            "gaussian 9x9": convolution.gaussian_kernel(9, 2),
+            "edges 3x3": np.array([[1, 0, -1]] * 3, dtype=np.float64),
+            "shift 25x25": shift,
+        }
+    if backends is None:
+        backends = dtype_backends()
+    results = []
+    for name, fn in backends.items():
+        for kernel_name, kernel in kernels.items():
+            if name == "box" and not convolution.is_box_kernel(kernel):
+                continue
+            reference = fn(image, kernel, boundary=boundary)
+            scale = max(np.abs(reference).max(), 1)
+            for dtype in dtypes:
+                bound = ACCURACY_BOUNDS[dtype]
+                result = fn(image, kernel, boundary=boundary, dtype=dtype)
+                # A buffer that differs from the right answer everywhere, so unwritten pixels show up
+                supplied = np.full(image.shape, np.nan, dtype=dtype) if np.dtype(dtype).kind == "f" else ~result
+                same = fn(image, kernel, boundary=boundary, out=supplied) is supplied and np.array_equal(supplied, result)
+                if np.dtype(dtype).kind in "iu":
+                    info = np.iinfo(dtype)
+                    expected = np.clip(np.rint(reference), info.min, info.max)
+                    error = np.abs(result.astype(np.float64) - expected).max()
+                else:
+                    error = np.abs(result - reference).max() / scale
+                results.append({"backend": name, "kernel": kernel_name, "dtype": dtype, "error": float(error),
+                                "bound": bound, "memory": result.nbytes / reference.nbytes,
+                                "ok": bool(error <= bound and same and result.dtype == dtype)})
+    return results
+
+
+def print_accuracy(results):
+    print(f"{'backend':<18} {'kernel':<14} {'dtype':<8} {'error':>10} {'bound':>8} {'memory':>7}")
+    for result in results:
+        flag = "" if result["ok"] else "  FAIL"
+        print(f"{result['backend']:<18} {result['kernel']:<14} {result['dtype']:<8} {result['error']:>10.3g} "
+              f"{result['bound']:>8.3g} {result['memory']:>6.3f}x{flag}")
+
+
+def import_time(module, repeats=5):
+    """
+    Time importing a module in fresh interpreters, on top of NumPy (which everything needs anyway).
+
+    Args:
+        module: name of a module in this directory.
+        repeats: number of fresh interpreters to try (the fastest is kept).
+    Returns:
+        seconds: time spent in `import module` after NumPy is already loaded.
+    """
+    script = ("import numpy, time; start = time.perf_counter(); "
+              f"import {module}; print(time.perf_counter() - start)")
+    here = os.path.dirname(os.path.abspath(__file__))
+    return min(float(subprocess.check_output([sys.executable, "-c", script], cwd=here, text=True))
+               for _ in range(repeats))
+
+
+def check_import_budget(budget=0.1, modules=LIBRARY_MODULES):
+    """
+    Returns:
+        over: list of (module, seconds) for every module that took longer than budget to import.
+    """
+    over = []
+    for module in modules:
+        seconds = import_time(module)
+        print(f"import {module}: {seconds * 1000:.1f}ms")
+        if seconds > budget:
+            over.append((module, seconds))
+    return over
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the convolution backends.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 1024], help="square image sizes")
+    parser.add_argument("--kernels", type=int, nargs="+", default=[3, 9, 25], help="square kernel sizes")
+    parser.add_argument("--dtypes", nargs="+", default=["float64", "float32"])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--out", default="benchmark.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="fail if a median is more than this many times the baseline's")
+    parser.add_argument("--import-budget", type=float,
+                        help="only check that the library modules import within this many seconds")
+    parser.add_argument("--accuracy", action="store_true",
+                        help="only check the float32/uint8 results against float64 (see check_accuracy)")
+    args = parser.parse_args(argv)
+
+    if args.accuracy:
+        results = check_accuracy()
+        print_accuracy(results)
+        return 0 if all(result["ok"] for result in results) else 1
+
+    if args.import_budget is not None:
+        over = check_import_budget(args.import_budget)
+        for module, seconds in over:
+            print(f"OVER BUDGET import {module}: {seconds * 1000:.1f}ms > {args.import_budget * 1000:.0f}ms")
+        return 1 if over else 0
+
+    results = run_benchmarks(image_sizes=[(size, size) for size in args.sizes], kernel_sizes=args.kernels,
+                             dtypes=[np.dtype(dtype) for dtype in args.dtypes], repeats=args.repeats)
+    print_results(results)
+    write_results(results, args.out)
+
+    if args.baseline:
+        regressions = check_regressions(results, args.baseline, args.threshold)
+        for result, previous, slowdown in regressions:
+            print(f"REGRESSION {result['backend']} {result['image_size']} k={result['kernel_size']} "
+                  f"{result['dtype']}: {previous['median']:.4f}s -> {result['median']:.4f}s ({slowdown:.2f}x)")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
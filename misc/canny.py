@@ -0,0 +1,183 @@
+# """
+# Canny edge detection built on our own convolution code instead of skimage.feature.canny.
+#
+# skimage's canny blurs, takes Sobel gradients, works out magnitudes and suppresses non-maxima as
+# separate whole-image passes, each allocating a full-size float array, and it only lets you choose
+# sigma. Here blur + Sobel + magnitude + non-maximum suppression is one tiled pass (see
+# compiled.canny_gradients) whose only full-size output is the suppressed magnitude map, the blur
+# takes an explicit kernel size (OpenCV's Gaussian, see convolution.gaussian_taps), and hysteresis is
+# a single flood fill from the strong pixels.
+#
+# Thresholds are in the same units as skimage's: gradient magnitudes (unnormalized Sobel) of the
+# image's own pixel values.
+#
+# Usage:
+#   python canny.py image.png 25 50 --ksize 7      # writes image_canny.png, compares with skimage
+# """
+
+import argparse
+import os
+from time import perf_counter
+
+import numpy as np
+
+from convolution import gaussian_taps, pad_image
+from profiling import profiled
+
+
+def default_ksize(sigma):
+    """The kernel size skimage ends up with for sigma (it truncates the Gaussian at 4 sigma)."""
+    return 2 * int(4 * sigma + 0.5) + 1
+
+
+def halo(ksize):
+    """How far `gradient_maxima` pads the image on each side for a blur of size ksize."""
+    # The blur's radius plus one pixel for Sobel and one for non-maximum suppression
+    return ksize // 2 + 2
+
+
+@profiled
+def gradient_maxima(image, sigma=1.0, ksize=None, tile_rows=32, out=None, taps=None, parallel=True,
+                    padded=None):
+    """
+    Everything in Canny before the thresholds: the gradient magnitude of the blurred image at pixels
+    where it peaks across the edge, 0 elsewhere. This is the expensive part, and it doesn't depend
+    on the thresholds, so keep it around if you want to try several.
+
+    Args:
+        image: (H, W) numpy array.
+        sigma: Gaussian standard deviation (<= 0 derives it from ksize, as OpenCV does).
+        ksize: Gaussian kernel size (odd). Defaults to `default_ksize(sigma)`.
+        tile_rows: rows per band of the fused pass.
+        out: float32 (H, W) array to write into. Defaults to a new one.
+        taps: odd-length 1D blur taps to use instead of `gaussian_taps(ksize, sigma)`.
+        parallel: whether to spread the bands over numba's threads. Turn it off when calling this
+            from several threads of your own.
+        padded: float32 array of shape (H + 2 * halo(ksize), W + 2 * halo(ksize)) to pad the image
+            into, so calling this on every frame of a video doesn't allocate one each time.
+    Returns:
+        out
+    """
+    import compiled
+
+    if image.ndim != 2:
+        raise ValueError(f"canny needs a single channel image, got shape {image.shape}")
+    if taps is None:
+        taps = gaussian_taps(default_ksize(sigma) if ksize is None else ksize, sigma)
+    taps = np.asarray(taps, dtype=np.float32)
+    width = halo(len(taps))
+    if padded is None:
+        padded = pad_image(image.astype(np.float32, copy=False), (2 * width + 1, 2 * width + 1), "replicate")
+    else:
+        expected = (image.shape[0] + 2 * width, image.shape[1] + 2 * width)
+        if padded.shape != expected or padded.dtype != np.float32:
+            raise ValueError(f"padded should be a float32 array of shape {expected}, "
+                             f"got {padded.dtype} {padded.shape}")
+        # Replicate padding, written in place: the middle, then the edge columns, then the edge rows
+        # (which copies the corners along with them)
+        padded[width:-width, width:-width] = image
+        padded[width:-width, :width] = padded[width:-width, width:width + 1]
+        padded[width:-width, -width:] = padded[width:-width, -width - 1:-width]
+        padded[:width] = padded[width]
+        padded[-width:] = padded[-width - 1]
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    gradients = compiled.canny_gradients if parallel else compiled.canny_gradients_serial
+    gradients(padded, taps, out, tile_rows)
+    return out
+
+
+@profiled
+def hysteresis(maxima, low_threshold, high_threshold, out=None):
+    """
+    Args:
+        maxima: output of `gradient_maxima`.
+        low_threshold, high_threshold: maxima >= high_threshold are edges, and so are maxima >=
+            low_threshold connected to them. Suppressed (0) pixels never are, whatever the thresholds.
+        out: boolean (H, W) array to write into. Defaults to a new one.
+    Returns:
+        out: boolean edge map.
+    """
+    import compiled
+
+    if high_threshold < low_threshold:
+        raise ValueError("low_threshold should be lower than high_threshold")
+    if out is None:
+        out = np.empty(maxima.shape, dtype=np.bool_)
+    compiled.hysteresis(maxima, float(low_threshold), float(high_threshold), out)
+    return out
+
+
+@profiled
+def canny(image, low_threshold, high_threshold, sigma=1.0, ksize=None, tile_rows=32, out=None, maxima=None,
+          padded=None):
+    """
+    Canny edge detection.
+
+    Args:
+        image: (H, W) numpy array.
+        low_threshold, high_threshold: hysteresis thresholds, see `hysteresis`.
+        sigma, ksize: Gaussian blur parameters, see `gradient_maxima`.
+        tile_rows: rows per band of the fused pass.
+        out: boolean (H, W) array to write into. Defaults to a new one.
+        maxima, padded: scratch buffers for `gradient_maxima` (its out and padded). Pass these, and
+            out, to run on frame after frame without allocating.
+    Returns:
+        out: boolean edge map.
+    """
+    maxima = gradient_maxima(image, sigma, ksize, tile_rows, out=maxima, padded=padded)
+    return hysteresis(maxima, low_threshold, high_threshold, out)
+
+
+def compare_with_skimage(image, low_threshold, high_threshold, sigma=1.0, repeats=10):
+    """
+    Time our canny against skimage's on one image and report how closely the edges agree.
+
+    Returns:
+        dict with "ms" (median times for "skimage" and "fused"), and "agreement": the fraction of
+        either method's edge pixels that the other one has within one pixel.
+    """
+    from scipy import ndimage
+    from skimage import feature
+
+    def median_ms(fn):
+        fn()
+        times = []
+        for _ in range(repeats):
+            start = perf_counter()
+            result = fn()
+            times.append(perf_counter() - start)
+        return np.median(times) * 1000, result
+
+    skimage_ms, expected = median_ms(lambda: feature.canny(image, sigma=sigma, low_threshold=low_threshold,
+                                                           high_threshold=high_threshold))
+    fused_ms, edges = median_ms(lambda: canny(image, low_threshold, high_threshold, sigma=sigma))
+
+    # NMS differs slightly (skimage interpolates, we snap to 4 directions), so allow a pixel of slack
+    near_expected = ndimage.binary_dilation(expected, np.ones((3, 3), dtype=bool))
+    near_edges = ndimage.binary_dilation(edges, np.ones((3, 3), dtype=bool))
+    found = np.count_nonzero(edges & near_expected) / max(np.count_nonzero(edges), 1)
+    recalled = np.count_nonzero(expected & near_edges) / max(np.count_nonzero(expected), 1)
+    return {"ms": {"skimage": skimage_ms, "fused": fused_ms}, "agreement": min(found, recalled)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the fused Canny on an image.")
+    parser.add_argument("image")
+    parser.add_argument("low", type=float)
+    parser.add_argument("high", type=float)
+    parser.add_argument("--sigma", type=float, default=1.0)
+    parser.add_argument("--ksize", type=int, help="Gaussian kernel size (default: 4 sigma each side)")
+    args = parser.parse_args()
+
+    import cv2
+    from imagewriter import write_image
+
+    image = cv2.imread(args.image, flags=cv2.IMREAD_GRAYSCALE)
+    write_image(f"{os.path.splitext(args.image)[0]}_canny.png",
+                canny(image, args.low, args.high, sigma=args.sigma, ksize=args.ksize))
+    if args.ksize is None:
+        comparison = compare_with_skimage(image, args.low, args.high, args.sigma)
+        ms = comparison["ms"]
+        print(f"skimage {ms['skimage']:.2f} ms, fused {ms['fused']:.2f} ms, "
+              f"{comparison['agreement']:.1%} of edges agree")
@@ -0,0 +1,783 @@
+# """
+# Numba kernels backing the faster paths in convolution.py, pixelops.py, hough.py, canny.py and
+# pyramid.py, plus the numba exercises from filters.py.
+#
+# These all work on (H, W, C) arrays that have already been padded (see convolution.pad_image), so
+# there is no bounds checking or boundary handling in the inner loops - grayscale images are passed
+# in with a trailing channel axis of length 1. Outputs are written into caller-provided arrays.
+#
+# Compiled code is cached on disk (next to this file, or under $NUMBA_CACHE_DIR if that's set), so
+# only the very first process pays for LLVM. Run `python compiled.py` at deploy time to build the
+# cache for every signature listed below up front; after that, starting a worker costs a cache load
+# instead of a compile.
+# """
+
+import itertools
+import math
+from time import perf_counter
+
+import numba
+import numpy as np
+from numba import types
+
+FLOATS = (types.float32, types.float64)
+
+# (dispatcher, [signature, ...]) for every kernel in this file, filled in by @kernel
+KERNELS = []
+
+
+def array(dtype, ndim):
+    return types.Array(dtype, ndim, "C")
+
+
+def kernel(signatures, parallel=False):
+    """
+    Compile a function with numba (nopython, nogil, cached on disk), and remember the argument types
+    it's normally called with so `warmup()` can build them ahead of time. Calls with other types
+    still work; they just get compiled (and cached) on first use.
+
+    Args:
+        signatures: list of tuples of numba argument types.
+        parallel: whether the function uses numba.prange.
+    """
+    def decorate(fn):
+        dispatcher = numba.jit(nopython=True, nogil=True, cache=True, parallel=parallel)(fn)
+        KERNELS.append((dispatcher, signatures))
+        return dispatcher
+    return decorate
+
+
+def image_kernel_signatures(kernel_ndim, *extra):
+    """Signatures for (padded image, kernel, out, *extra) over every combination of float types."""
+    return [(array(image, 3), array(weights, kernel_ndim), array(image, 3)) + extra
+            for image, weights in itertools.product(FLOATS, FLOATS)]
+
+
+def warmup(verbose=False):
+    """
+    Compile every kernel for all of its listed signatures, loading from (or filling) the on-disk
+    cache.
+
+    Returns:
+        seconds: time taken.
+    """
+    start = perf_counter()
+    for dispatcher, signatures in KERNELS:
+        for signature in signatures:
+            dispatcher.compile(signature)
+        if verbose:
+            print(f"{dispatcher.py_func.__name__}: {len(signatures)} signatures")
+    return perf_counter() - start
+
+
+@kernel(image_kernel_signatures(1))
+def correlate_columns(padded, taps, out):
+    """
+    Args:
+        padded: numpy array of shape (Ho+len(taps)-1, Wo, C).
+        taps: 1D kernel run down each column.
+        out: numpy array of shape (Ho, Wo, C) to write into.
+    """
+    for row in range(out.shape[0]):
+        for column in range(out.shape[1]):
+            for channel in range(out.shape[2]):
+                out[row, column, channel] = 0.0
+        # Walk the taps in the outer loop so the inner loops stream along contiguous rows
+        for tap in range(taps.shape[0]):
+            weight = taps[tap]
+            for column in range(out.shape[1]):
+                for channel in range(out.shape[2]):
+                    out[row, column, channel] += padded[row + tap, column, channel] * weight
+
+
+@kernel(image_kernel_signatures(1))
+def correlate_rows(padded, taps, out):
+    """
+    Args:
+        padded: numpy array of shape (Ho, Wo+len(taps)-1, C).
+        taps: 1D kernel run along each row.
+        out: numpy array of shape (Ho, Wo, C) to write into.
+    """
+    for row in range(out.shape[0]):
+        for column in range(out.shape[1]):
+            for channel in range(out.shape[2]):
+                value = 0.0
+                for tap in range(taps.shape[0]):
+                    value += padded[row, column + tap, channel] * taps[tap]
+                out[row, column, channel] = value
+
+
+# The decimating passes see an (H, W, C) image as (H, W * C), so the columns pass is one long
+# contiguous loop whatever the channel count
+DECIMATE_SIGNATURES = [(array(image, 2), array(weights, 1), array(image, 2), types.int64)
+                       for image, weights in itertools.product(FLOATS, FLOATS)]
+
+
+@kernel(DECIMATE_SIGNATURES)
+def decimate_columns(padded, taps, out, channels):
+    """
+    correlate_columns, but only at every other row (for pyramid.pyr_down).
+
+    Args:
+        padded: numpy array of shape (2*Ho+len(taps)-2, W*C) or taller.
+        taps: 1D kernel run down each column.
+        out: numpy array of shape (Ho, W*C) to write into: row i is centered on padded row
+            2*i + len(taps)//2.
+        channels: C (unused, every column is handled the same way).
+    """
+    for row in range(out.shape[0]):
+        for n in range(out.shape[1]):
+            out[row, n] = 0.0
+        for tap in range(taps.shape[0]):
+            weight = taps[tap]
+            for n in range(out.shape[1]):
+                out[row, n] += padded[2 * row + tap, n] * weight
+
+
+@kernel(DECIMATE_SIGNATURES)
+def decimate_rows(padded, taps, out, channels):
+    """
+    correlate_rows, but only at every other column (for pyramid.pyr_down).
+
+    Args:
+        padded: numpy array of shape (Ho, (2*Wo+len(taps)-2)*C) or wider.
+        taps: 1D kernel run along each row.
+        out: numpy array of shape (Ho, Wo*C) to write into.
+        channels: C.
+    """
+    ksize = taps.shape[0]
+    cols = out.shape[1] // channels
+    # Each row is split into its even and odd pixels first, so that every tap reads a contiguous
+    # run (reading every other pixel straight from the row is ~5x slower)
+    even = np.empty((cols + (ksize - 1) // 2) * channels, dtype=out.dtype)
+    odd = np.empty(max(cols + (ksize - 2) // 2, 0) * channels, dtype=out.dtype)
+    for row in range(out.shape[0]):
+        if channels == 1:
+            for k in range(even.shape[0]):
+                even[k] = padded[row, 2 * k]
+            for k in range(odd.shape[0]):
+                odd[k] = padded[row, 2 * k + 1]
+        else:
+            for k in range(0, even.shape[0], channels):
+                for channel in range(channels):
+                    even[k + channel] = padded[row, 2 * k + channel]
+            for k in range(0, odd.shape[0], channels):
+                for channel in range(channels):
+                    odd[k + channel] = padded[row, 2 * k + channels + channel]
+        for n in range(out.shape[1]):
+            out[row, n] = 0.0
+        for tap in range(ksize):
+            weight = taps[tap]
+            source = even if tap % 2 == 0 else odd
+            offset = tap // 2 * channels
+            for n in range(out.shape[1]):
+                out[row, n] += source[n + offset] * weight
+
+
+@kernel(image_kernel_signatures(2))
+def correlate(padded, kernel, out):
+    """
+    Plain k x k correlation, in the same tap order as filters.numba_convolution_filter so the two
+    agree bit for bit.
+
+    Args:
+        padded: numpy array of shape (Ho+Hk-1, Wo+Wk-1, C).
+        kernel: numpy array of shape (Hk, Wk).
+        out: numpy array of shape (Ho, Wo, C) to write into.
+    """
+    for row in range(out.shape[0]):
+        for column in range(out.shape[1]):
+            for channel in range(out.shape[2]):
+                value = 0.0
+                for kernel_row in range(kernel.shape[0]):
+                    for kernel_column in range(kernel.shape[1]):
+                        value += padded[row + kernel_row, column + kernel_column, channel] * kernel[kernel_row, kernel_column]
+                out[row, column, channel] = value
+
+
+@kernel(image_kernel_signatures(2, types.int64), parallel=True)
+def correlate_tiled(padded, kernel, out, tile_rows):
+    """
+    `correlate` split into bands of tile_rows output rows (plus the Hk-1 halo rows each band reads)
+    that are spread across numba's thread pool.
+    """
+    tiles = (out.shape[0] + tile_rows - 1) // tile_rows
+    for tile in numba.prange(tiles):
+        start = tile * tile_rows
+        stop = min(start + tile_rows, out.shape[0])
+        correlate(padded[start:stop + kernel.shape[0] - 1], kernel, out[start:stop])
+
+
+@kernel([(array(dtype, 3), array(dtype, 3), array(types.int64, 1), array(dtype, 3)) for dtype in FLOATS])
+def correlate_channels(padded, kernels, channels, out):
+    """
+    Correlate each channel of padded with its own kernel in one pass over the image.
+
+    Args:
+        padded: numpy array of shape (Ho+Hk-1, Wo+Wk-1, N) holding only the channels to filter.
+        kernels: numpy array of shape (N, Hk, Wk), one kernel per padded channel.
+        channels: channel of out that each padded channel is written to.
+        out: numpy array of shape (Ho, Wo, C) to write into. Other channels are left alone.
+    """
+    for row in range(out.shape[0]):
+        for column in range(out.shape[1]):
+            for i in range(channels.shape[0]):
+                value = 0.0
+                for kernel_row in range(kernels.shape[1]):
+                    for kernel_column in range(kernels.shape[2]):
+                        value += padded[row + kernel_row, column + kernel_column, i] * kernels[i, kernel_row, kernel_column]
+                out[row, column, channels[i]] = value
+
+
+
+###
+# Pixel ops for pixelops.py. These take flat (1D) views so one loop covers any image shape, and read
+# and write each pixel exactly once, so in-place use (out is image) is safe and allocates nothing.
+###
+
+PIXELS = (types.uint8, types.float32, types.float64)
+
+
+@kernel([(array(pixels, 1), types.float64, types.float64, types.float64, array(result, 1))
+         for pixels in PIXELS for result in PIXELS])
+def threshold_pixels(image, cutoff, high, low, out):
+    for i in range(image.shape[0]):
+        out[i] = high if image[i] > cutoff else low
+
+
+@kernel([(array(pixels, 1), types.float64, array(pixels, 1)) for pixels in PIXELS])
+def threshold_to_zero_pixels(image, cutoff, out):
+    for i in range(image.shape[0]):
+        out[i] = image[i] if image[i] >= cutoff else 0
+
+
+@kernel([(array(pixels, 1), types.float64, array(types.boolean, 1)) for pixels in PIXELS])
+def mask_pixels(image, cutoff, out):
+    for i in range(image.shape[0]):
+        out[i] = image[i] > cutoff
+
+
+@kernel([(array(pixels, 1), types.float64, types.float64, array(types.uint8, 1)) for pixels in PIXELS])
+def double_threshold_pixels(image, low, high, out):
+    for i in range(image.shape[0]):
+        value = image[i]
+        if value >= high:
+            out[i] = 2
+        elif value >= low:
+            out[i] = 1
+        else:
+            out[i] = 0
+
+
+# Grayscale conversion takes (N, C) pixels instead, reading the first len(weights) channels of each
+
+@kernel([(array(pixels, 2), array(types.float64, 1), array(result, 1))
+         for pixels in PIXELS for result in FLOATS])
+def weighted_channels(pixels, weights, out):
+    for i in range(out.shape[0]):
+        value = 0.0
+        for channel in range(weights.shape[0]):
+            value += pixels[i, channel] * weights[channel]
+        out[i] = value
+
+
+@kernel([(array(types.uint8, 2), array(types.int64, 1), types.int64, array(types.uint8, 1))])
+def weighted_channels_fixed(pixels, weights, shift, out):
+    """Same, with weights in fixed point (1.0 = 1 << shift) that sum to at most 1.0, so no clipping."""
+    rounding = 1 << (shift - 1)
+    for i in range(out.shape[0]):
+        value = rounding
+        for channel in range(weights.shape[0]):
+            value += pixels[i, channel] * weights[channel]
+        out[i] = value >> shift
+
+
+###
+# Hough transform kernels for hough.py. Accumulators are int32 arrays of shape (rho, theta), with
+# rho index = round(x cos(theta) + y sin(theta)) + offset, offset = (n_rho - 1) // 2. cos and sin
+# come in as 16.16 fixed point tables (HOUGH_ONE = 1.0) so a vote is integer multiply-adds and a
+# shift. Edge maps are boolean (H, W) arrays and segments come out as int32 (N, 2, 2) arrays of
+# ((x0, y0), (x1, y1)).
+###
+
+HOUGH_SHIFT = 16
+HOUGH_ONE = 1 << HOUGH_SHIFT
+HOUGH_TABLES = (array(types.int64, 1), array(types.int64, 1))
+
+
+@numba.njit(inline="always")
+def _rho_index(x, y, cos_theta, sin_theta, offset):
+    return ((x * cos_theta + y * sin_theta + (HOUGH_ONE >> 1)) >> HOUGH_SHIFT) + offset
+
+
+@kernel([(array(types.boolean, 2), array(types.int64, 1), array(types.int64, 1)) + HOUGH_TABLES
+         + (array(types.int32, 2), types.int64, types.int64, types.int64, array(types.int32, 3))])
+def probabilistic_hough(mask, xs, ys, cos_table, sin_table, accumulator, threshold, line_length, line_gap,
+                        segments):
+    # Progressive probabilistic Hough (Matas et al.), as in OpenCV and skimage: vote one point at a
+    # time in the given order, and as soon as a point pushes some line over the threshold, walk along
+    # that line to find the segment, then take its points out of the mask (and their votes out of the
+    # accumulator). mask is consumed. Returns the number of segments written.
+    height, width = mask.shape
+    offset = (accumulator.shape[0] - 1) // 2
+    count = 0
+    line_end = np.empty((2, 2), dtype=np.int64)
+    for point in range(xs.shape[0]):
+        x, y = xs[point], ys[point]
+        # Already part of a line we found
+        if not mask[y, x]:
+            continue
+
+        best, best_theta = threshold - 1, -1
+        for j in range(cos_table.shape[0]):
+            r = _rho_index(x, y, cos_table[j], sin_table[j], offset)
+            accumulator[r, j] += 1
+            if accumulator[r, j] > best:
+                best, best_theta = accumulator[r, j], j
+        if best < threshold:
+            continue
+
+        # Step one pixel at a time along the line's longer axis, in 16.16 fixed point along the other
+        a, b = -sin_table[best_theta], cos_table[best_theta]
+        x_major = abs(a) > abs(b)
+        if x_major:
+            dx0, dy0 = (1 if a > 0 else -1), int(math.floor(b * HOUGH_ONE / abs(a) + 0.5))
+            x0, y0 = x, (y << HOUGH_SHIFT) + (HOUGH_ONE >> 1)
+        else:
+            dx0, dy0 = int(math.floor(a * HOUGH_ONE / abs(b) + 0.5)), (1 if b > 0 else -1)
+            x0, y0 = (x << HOUGH_SHIFT) + (HOUGH_ONE >> 1), y
+
+        # Walk both ways from the point until the gap gets too big; the last edge pixels seen are
+        # the segment's ends
+        for k in range(2):
+            px, py = x0, y0
+            dx, dy = (dx0, dy0) if k == 0 else (-dx0, -dy0)
+            line_end[k, 0], line_end[k, 1] = x, y
+            gap = 0
+            while True:
+                x1, y1 = (px, py >> HOUGH_SHIFT) if x_major else (px >> HOUGH_SHIFT, py)
+                if x1 < 0 or x1 >= width or y1 < 0 or y1 >= height:
+                    break
+                gap += 1
+                if mask[y1, x1]:
+                    gap = 0
+                    line_end[k, 0], line_end[k, 1] = x1, y1
+                elif gap > line_gap:
+                    break
+                px += dx
+                py += dy
+
+        good = (abs(line_end[1, 0] - line_end[0, 0]) >= line_length
+                or abs(line_end[1, 1] - line_end[0, 1]) >= line_length)
+
+        # Walk it again, clearing the segment's pixels (and, if we keep it, their votes)
+        for k in range(2):
+            px, py = x0, y0
+            dx, dy = (dx0, dy0) if k == 0 else (-dx0, -dy0)
+            while True:
+                x1, y1 = (px, py >> HOUGH_SHIFT) if x_major else (px >> HOUGH_SHIFT, py)
+                if mask[y1, x1]:
+                    if good:
+                        for j in range(cos_table.shape[0]):
+                            accumulator[_rho_index(x1, y1, cos_table[j], sin_table[j], offset), j] -= 1
+                    mask[y1, x1] = False
+                if x1 == line_end[k, 0] and y1 == line_end[k, 1]:
+                    break
+                px += dx
+                py += dy
+
+        if good:
+            segments[count, 0, 0], segments[count, 0, 1] = line_end[0, 0], line_end[0, 1]
+            segments[count, 1, 0], segments[count, 1, 1] = line_end[1, 0], line_end[1, 1]
+            count += 1
+    return count
+
+
+@kernel([(array(types.boolean, 2), array(types.boolean, 2)) + HOUGH_TABLES + (array(types.int32, 2),)])
+def hough_update(edges, previous, cos_table, sin_table, accumulator):
+    # Incremental voting: pixels that turned on since `previous` add their votes, pixels that turned
+    # off take theirs back, unchanged pixels cost one comparison. previous becomes edges. Returns the
+    # number of pixels that changed.
+    offset = (accumulator.shape[0] - 1) // 2
+    changed = 0
+    for y in range(edges.shape[0]):
+        for x in range(edges.shape[1]):
+            if edges[y, x] == previous[y, x]:
+                continue
+            vote = 1 if edges[y, x] else -1
+            for j in range(cos_table.shape[0]):
+                accumulator[_rho_index(x, y, cos_table[j], sin_table[j], offset), j] += vote
+            previous[y, x] = edges[y, x]
+            changed += 1
+    return changed
+
+
+@kernel([(array(types.int32, 2), types.int64, types.int64, types.int64, array(types.int64, 2))])
+def hough_peaks(accumulator, threshold, rho_distance, theta_distance, out):
+    # Local maxima >= threshold, strongest first, dropping any within (rho_distance, theta_distance)
+    # of a stronger one we already kept. Writes (rho index, theta index) rows into out, returns how
+    # many.
+    n_rho, n_theta = accumulator.shape
+    candidates = []
+    for r in range(n_rho):
+        for j in range(n_theta):
+            votes = accumulator[r, j]
+            if votes < threshold:
+                continue
+            is_max = True
+            for nr in range(max(r - 1, 0), min(r + 2, n_rho)):
+                for nj in range(max(j - 1, 0), min(j + 2, n_theta)):
+                    if accumulator[nr, nj] > votes:
+                        is_max = False
+            if is_max:
+                candidates.append((-votes, r, j))
+    candidates.sort()
+
+    count = 0
+    for _, r, j in candidates:
+        if count == out.shape[0]:
+            break
+        suppressed = False
+        for kept in range(count):
+            if abs(out[kept, 0] - r) <= rho_distance and abs(out[kept, 1] - j) <= theta_distance:
+                suppressed = True
+                break
+        if not suppressed:
+            out[count, 0], out[count, 1] = r, j
+            count += 1
+    return count
+
+
+@kernel([(array(types.boolean, 2), array(types.float64, 1), array(types.float64, 1), array(types.float64, 1),
+          types.int64, types.int64, array(types.int32, 3))])
+def trace_segments(edges, rhos, cos_thetas, sin_thetas, line_length, line_gap, segments):
+    # Walk each (rho, theta) line across the edge map one pixel at a time along its longer axis and
+    # cut it into runs of edge pixels separated by at most line_gap misses (an edge pixel one step to
+    # either side counts as a hit). Runs spanning at least line_length pixels are written to
+    # segments. Returns how many.
+    height, width = edges.shape
+    count = 0
+    for i in range(rhos.shape[0]):
+        rho, c, s = rhos[i], cos_thetas[i], sin_thetas[i]
+        y_major = abs(c) >= abs(s)
+        steps = height if y_major else width
+        start_u = start_v = end_u = end_v = -1
+        gap = 0
+        for u in range(steps + 1):
+            hit = False
+            if u < steps:
+                v = int(math.floor(((rho - u * s) / c if y_major else (rho - u * c) / s) + 0.5))
+                limit = width if y_major else height
+                for nv in (v, v - 1, v + 1):
+                    if 0 <= nv < limit and (edges[u, nv] if y_major else edges[nv, u]):
+                        hit, v = True, nv
+                        break
+            if hit:
+                if start_u < 0:
+                    start_u, start_v = u, v
+                end_u, end_v = u, v
+                gap = 0
+                continue
+            gap += 1
+            if start_u >= 0 and (gap > line_gap or u >= steps):
+                if end_u - start_u >= line_length or abs(end_v - start_v) >= line_length:
+                    if count == segments.shape[0]:
+                        return count
+                    # Endpoints in the order probabilistic_hough gives them: the end it walks to first
+                    # (down for steep lines, towards -sin(theta) for flat ones) comes first
+                    if y_major:
+                        segments[count, 0, 0], segments[count, 0, 1] = end_v, end_u
+                        segments[count, 1, 0], segments[count, 1, 1] = start_v, start_u
+                    elif s < 0:
+                        segments[count, 0, 0], segments[count, 0, 1] = end_u, end_v
+                        segments[count, 1, 0], segments[count, 1, 1] = start_u, start_v
+                    else:
+                        segments[count, 0, 0], segments[count, 0, 1] = start_u, start_v
+                        segments[count, 1, 0], segments[count, 1, 1] = end_u, end_v
+                    count += 1
+                start_u = -1
+    return count
+
+
+###
+# Canny kernels for canny.py.
+###
+
+# tan(22.5 degrees) and tan(67.5 degrees): the boundaries between the four gradient directions
+TAN_22 = math.tan(math.pi / 8)
+TAN_67 = math.tan(3 * math.pi / 8)
+
+
+CANNY_SIGNATURES = [(array(types.float32, 2), array(types.float32, 1), array(types.float32, 2), types.int64)]
+
+
+@numba.njit(nogil=True, cache=True)
+def canny_block(padded, taps, out, start, rows, left, width):
+    # One block of canny_gradients: output rows start .. start+rows-1, columns left .. left+width-1
+    ksize = taps.shape[0]
+    # Padded columns the block reads: its width plus the blur's taps and 2 pixels of halo each side
+    span = width + ksize + 3
+
+    # Blur rows start-2 .. start+rows+1 (2 rows of halo for Sobel + NMS): columns first, over
+    # the block's span of the padded image, then rows. Padded row start + a is the first tap for
+    # blurred row a, and padded column left + c is column c of the span.
+    columns_done = np.zeros((rows + 4, span), dtype=np.float32)
+    for a in range(rows + 4):
+        for t in range(ksize):
+            weight = taps[t]
+            for c in range(span):
+                columns_done[a, c] += padded[start + a + t, left + c] * weight
+    blurred = np.empty((rows + 4, width + 4), dtype=np.float32)
+    for a in range(rows + 4):
+        for b in range(width + 4):
+            value = np.float32(0.0)
+            for t in range(ksize):
+                value += columns_done[a, b + t] * taps[t]
+            blurred[a, b] = value
+
+    # Sobel, one pixel of halo around the block
+    gx = np.empty((rows + 2, width + 2), dtype=np.float32)
+    gy = np.empty((rows + 2, width + 2), dtype=np.float32)
+    magnitude = np.empty((rows + 2, width + 2), dtype=np.float32)
+    for a in range(1, rows + 3):
+        for b in range(1, width + 3):
+            x = (blurred[a - 1, b + 1] + 2 * blurred[a, b + 1] + blurred[a + 1, b + 1]
+                 - blurred[a - 1, b - 1] - 2 * blurred[a, b - 1] - blurred[a + 1, b - 1])
+            y = (blurred[a + 1, b - 1] + 2 * blurred[a + 1, b] + blurred[a + 1, b + 1]
+                 - blurred[a - 1, b - 1] - 2 * blurred[a - 1, b] - blurred[a - 1, b + 1])
+            gx[a - 1, b - 1] = x
+            gy[a - 1, b - 1] = y
+            magnitude[a - 1, b - 1] = math.sqrt(x * x + y * y)
+
+    # Keep pixels that are at least as strong as both neighbours along the gradient (strictly
+    # stronger than one of them, so a flat ridge two pixels wide keeps one)
+    for i in range(rows):
+        for j in range(width):
+            m = magnitude[i + 1, j + 1]
+            if m == 0:
+                out[start + i, left + j] = 0
+                continue
+            ax, ay = abs(gx[i + 1, j + 1]), abs(gy[i + 1, j + 1])
+            if ay <= ax * TAN_22:
+                first, second = magnitude[i + 1, j], magnitude[i + 1, j + 2]
+            elif ay >= ax * TAN_67:
+                first, second = magnitude[i, j + 1], magnitude[i + 2, j + 1]
+            elif (gx[i + 1, j + 1] > 0) == (gy[i + 1, j + 1] > 0):
+                first, second = magnitude[i, j], magnitude[i + 2, j + 2]
+            else:
+                first, second = magnitude[i, j + 2], magnitude[i + 2, j]
+            out[start + i, left + j] = m if m > first and m >= second else 0
+
+
+@numba.njit(nogil=True, cache=True)
+def canny_band(padded, taps, out, start, rows):
+    # One band of canny_gradients: output rows start .. start+rows-1, all the way across
+    canny_block(padded, taps, out, start, rows, 0, out.shape[1])
+
+
+@kernel(CANNY_SIGNATURES, parallel=True)
+def canny_gradients(padded, taps, out, tile_rows):
+    """
+    Gaussian blur, Sobel gradients, magnitude and non-maximum suppression in one pass, a band of
+    tile_rows rows at a time, with the bands spread across numba's thread pool. Each band's
+    intermediates only live in small scratch buffers (a few rows wide, so they stay in cache) and
+    the only full-size array written is out.
+
+    Args:
+        padded: (Ho + 2p, Wo + 2p) image padded by p = len(taps) // 2 + 2 on every side (the blur's
+            radius, plus one pixel each for Sobel and non-maximum suppression).
+        taps: odd-length 1D Gaussian, run down the columns and then along the rows.
+        out: (Ho, Wo) array to write into: the gradient magnitude where it's a local maximum
+            along the gradient direction, 0 everywhere else.
+        tile_rows: output rows per band.
+    """
+    height = out.shape[0]
+    for tile in numba.prange((height + tile_rows - 1) // tile_rows):
+        start = tile * tile_rows
+        canny_band(padded, taps, out, start, min(start + tile_rows, height) - start)
+
+
+@kernel(CANNY_SIGNATURES)
+def canny_gradients_serial(padded, taps, out, tile_rows):
+    """`canny_gradients` on the calling thread only, for callers that do their own threading."""
+    height = out.shape[0]
+    for start in range(0, height, tile_rows):
+        canny_band(padded, taps, out, start, min(start + tile_rows, height) - start)
+
+
+@kernel([(array(image, 2), array(types.float32, 1), array(types.float32, 2), array(types.int64, 2), types.int64)
+         for image in (types.uint8, types.float32)], parallel=True)
+def canny_gradients_blocks(image, taps, out, blocks, block_rows):
+    """
+    `canny_gradients` for just some blocks of the image, spread across numba's thread pool. Pixels
+    outside the blocks aren't written. Each block copies its own halo out of the image (repeating
+    the edge pixels past the border, like the "replicate" padding canny_gradients is normally
+    given), so there's no padded copy of the whole image and a block's output is exactly what the
+    whole-image pass would have written there.
+
+    Args:
+        image: (Ho, Wo) image, unpadded.
+        taps: odd-length 1D Gaussian, as for `canny_gradients`.
+        out: (Ho, Wo) array to write into.
+        blocks: (N, 3) array of (top, left, width) of the blocks, in output coordinates.
+        block_rows: height of every block (blocks at the bottom are cut off by the image).
+    """
+    height, width = out.shape
+    pad = taps.shape[0] // 2 + 2
+    for k in numba.prange(blocks.shape[0]):
+        top, left = blocks[k, 0], blocks[k, 1]
+        rows, cols = min(top + block_rows, height) - top, min(left + blocks[k, 2], width) - left
+        padded = np.empty((rows + 2 * pad, cols + 2 * pad), dtype=np.float32)
+        for a in range(rows + 2 * pad):
+            y = min(max(top + a - pad, 0), height - 1)
+            for c in range(cols + 2 * pad):
+                padded[a, c] = image[y, min(max(left + c - pad, 0), width - 1)]
+        canny_block(padded, taps, out[top:top + rows, left:left + cols], 0, rows, 0, cols)
+
+
+@numba.njit(nogil=True, cache=True)
+def track_edge(magnitude, low, out, stack, y, x):
+    # Flood fill from the strong pixel (y, x) through maxima >= low that aren't edges yet. Suppressed
+    # pixels are 0, so they're skipped even if low <= 0 (skimage: local_maxima & (magnitude >= low))
+    height, width = magnitude.shape
+    out[y, x] = True
+    stack[0] = y * width + x
+    top = 1
+    while top:
+        top -= 1
+        cy, cx = divmod(stack[top], width)
+        for ny in range(max(cy - 1, 0), min(cy + 2, height)):
+            for nx in range(max(cx - 1, 0), min(cx + 2, width)):
+                if not out[ny, nx] and magnitude[ny, nx] > 0 and magnitude[ny, nx] >= low:
+                    out[ny, nx] = True
+                    stack[top] = ny * width + nx
+                    top += 1
+
+
+@kernel([(array(types.float32, 2), types.float64, types.float64, array(types.boolean, 2))])
+def hysteresis(magnitude, low, high, out):
+    """
+    Canny's edge tracking as a flood fill: every maximum (nonzero pixel) >= high is an edge, and so
+    is every maximum >= low connected to one (8-connectivity). Each pixel is pushed at most once,
+    so this is linear in the image size.
+
+    Args:
+        magnitude: (H, W) non-maximum-suppressed gradient magnitudes.
+        low, high: hysteresis thresholds.
+        out: (H, W) boolean array to write the edges into.
+    """
+    height, width = magnitude.shape
+    out[:] = False
+    stack = np.empty(height * width, dtype=np.int32)
+    for y in range(height):
+        for x in range(width):
+            if not out[y, x] and magnitude[y, x] > 0 and magnitude[y, x] >= high:
+                track_edge(magnitude, low, out, stack, y, x)
+
+
+@kernel([(array(types.float32, 2), types.float64, types.float64, array(types.boolean, 2), array(types.int64, 2),
+          types.int64)])
+def hysteresis_blocks(magnitude, low, high, out, blocks, block_rows):
+    """
+    `hysteresis` for a magnitude map that's 0 outside some blocks (see `canny_gradients_blocks`):
+    only the blocks are searched for strong pixels, instead of the whole image.
+
+    Args:
+        magnitude, low, high, out: as for `hysteresis`.
+        blocks: (N, 3) array of (top, left, width) of the blocks.
+        block_rows: height of every block.
+    """
+    height, width = magnitude.shape
+    out[:] = False
+    stack = np.empty(height * width, dtype=np.int32)
+    for k in range(blocks.shape[0]):
+        top, left = blocks[k, 0], blocks[k, 1]
+        for y in range(top, min(top + block_rows, height)):
+            for x in range(left, min(left + blocks[k, 2], width)):
+                if not out[y, x] and magnitude[y, x] > 0 and magnitude[y, x] >= high:
+                    track_edge(magnitude, low, out, stack, y, x)
+
+
+###
+# The numba exercises from filters.py. They're defined here rather than there so that importing
+# filters.py doesn't import numba; filters.py hands them out lazily under their usual names.
+###
+
+# The exercise kernels are 2D only
+EXERCISE_SIGNATURES = [(array(image, 2), array(weights, 2)) for image, weights in itertools.product(FLOATS, FLOATS)]
+
+
+@kernel(EXERCISE_SIGNATURES)
+def numba_convolution_filter(image, kernel):
+    """
+    Args:
+        image: numpy array of shape (Hi, Wi).
+        kernel: numpy array of shape (Hk, Wk).
+    Returns:
+        out: numpy array of shape (Hi, Wi).
+    """
+    out = np.zeros(image.shape)
+    
+    for image_row in range(image.shape[0]):
+        for image_column in range(image.shape[1]):
+            output_value = 0.0
+            for kernel_row in range(kernel.shape[0]):
+                for kernel_column in range(kernel.shape[1]):
+                    image_row_offset = math.ceil(kernel_row - kernel.shape[0] / 2)
+                    image_column_offset = math.ceil(kernel_column - kernel.shape[1] / 2)
+                    
+                    if (image_row + image_row_offset < 0 or 
+                        image_row + image_row_offset >= image.shape[0] or
+                        image_column + image_column_offset < 0 or 
+                        image_column + image_column_offset >= image.shape[1]):
+                        image_value = 0.0
+                    else:
+                        image_value = image[image_row + image_row_offset, image_column + image_column_offset]
+
+                    output_value += image_value * kernel[kernel_row, kernel_column]
+
+            out[image_row, image_column] = output_value
+            
+    return out
+
+
+@kernel(EXERCISE_SIGNATURES)
+def numba_matrix_convolution_filter(image, kernel):
+    """
+    Args:
+        image: numpy array of shape (Hi, Wi).
+        kernel: numpy array of shape (Hk, Wk).
+    Returns:
+        out: numpy array of shape (Hi, Wi).
+    """
+    out = np.zeros(image.shape)
+    rows, cols = image.shape[:2]
+    # np.pad() not implemented in Numba, so we make do manually
+    img = np.zeros((image.shape[0]+kernel.shape[0]-1, image.shape[1]+kernel.shape[1]-1))
+    img[math.floor(kernel.shape[0]/2):image.shape[0]+math.floor(kernel.shape[0]/2),
+        math.floor(kernel.shape[1]/2):image.shape[1]+math.floor(kernel.shape[1]/2)] = image
+    
+    for image_row in range(rows):
+        for image_column in range(cols):
+            region = np.zeros((kernel.shape[0], kernel.shape[1]))
+            for kernel_row in range(kernel.shape[0]):
+                for kernel_column in range(kernel.shape[1]):
+                    region[kernel_row, kernel_column] = img[image_row+kernel_row, image_column+kernel_column]
+            new = kernel * region
+            out[image_row, image_column] = np.sum(new)            
+            
+    return out
+
+
+@kernel([(array(dtype, ndim),) + (types.int64,) * 4 for dtype in FLOATS for ndim in (2, 3)])
+def replicate(image, image_row, image_column, image_row_offset, image_column_offset):
+    # Clamp to the last valid index, not one past it
+    row = min(image_row + image_row_offset, image.shape[0] - 1)
+    row = max(row, 0)
+    col = min(image_column + image_column_offset, image.shape[1] - 1)
+    col = max(col, 0)
+    return image[row, col]
+
+
+if __name__ == "__main__":
+    print(f"compiled in {warmup(verbose=True):.2f}s")
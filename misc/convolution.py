@@ -0,0 +1,897 @@
+# """
+# Faster convolution backends for the filters in filters.py.
+#
+# Everything in here follows the same conventions as `naive_convolution_filter`: the kernel is
+# correlated (not flipped) with the image, pixels outside the image count as zero, and tap
+# (kernel_row, kernel_column) reads the pixel at offset ceil(kernel_row - Hk/2), which for both odd
+# and even kernels works out to kernel_row - Hk//2.
+#
+# Most entry points also take a `boundary` argument saying what "outside the image" means:
+#   "zero"      - pixels outside the image are 0 (what the naive filter does)
+#   "replicate" - pixels outside the image copy the nearest edge pixel
+#   "reflect"   - the image is mirrored about its edge pixels, which aren't repeated (...dcb|abcd|cba...)
+#   "wrap"      - the image tiles periodically (...bcd|abcd|abc...)
+#   a number    - pixels outside the image all have that constant value
+#   a function  - `fn(image, widths)` returning the image padded by `widths` (as passed to np.pad),
+#                 for anything more exotic. Old-style per-pixel strategies like filters.replicate,
+#                 `fn(image, row, column, row_offset, column_offset)` returning one pixel, still work:
+#                 they're called once per border pixel to fill the padding, so they're slow
+# Every backend pads once up front and then runs branch-free over the padded buffer, so the
+# boundary mode costs one copy of the image rather than a check on every kernel tap.
+#
+# Only NumPy is imported up front. The numba kernels (compiled.py) are imported by the functions that
+# use them, so code that only wants the NumPy/FFT paths never pays for loading numba.
+# """
+
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import perf_counter
+
+import numpy as np
+
+from profiling import profiled
+
+# np.pad() mode backing each named boundary strategy
+BOUNDARY_MODES = {
+    "zero": "constant",
+    "replicate": "edge",
+    "reflect": "reflect",
+    "wrap": "wrap",
+}
+
+# How much more an FFT costs per (padded pixel * log2(padded pixels)) than a direct convolution does
+# per (pixel * kernel tap). `measure_fft_crossover()` gave 0.7-1.3 for 512-1024px frames; rerun it
+# on new hardware and assign the result here if the dispatch looks off.
+FFT_COST_RATIO = 1.0
+
+# Default cap on what an IntermediateCache holds
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+# Cap on the kernel spectra fft_convolution_filter keeps. Each one is as big as the padded frame
+# (34 MB for 2000x2000 and a 31x31 kernel, in complex128), so this is a handful of frame sizes
+SPECTRUM_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def kernel_offsets(kernel_shape):
+    """
+    Args:
+        kernel_shape: (Hk, Wk) shape of a kernel.
+    Returns:
+        ((top, bottom), (left, right)) amount of padding needed on each side so that every tap of
+        the kernel lands inside the padded image.
+    """
+    rows, cols = kernel_shape[:2]
+    return (rows // 2, rows - 1 - rows // 2), (cols // 2, cols - 1 - cols // 2)
+
+
+def pad_image(image, kernel_shape, boundary="zero"):
+    """
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        kernel_shape: (Hk, Wk) shape of the kernel that will be run over the result.
+        boundary: name from BOUNDARY_MODES, a constant fill value, or a padding function (see the
+            top of this file).
+    Returns:
+        padded: padded copy of shape (Hi+Hk-1, Wi+Wk-1) (plus any trailing channel axis).
+    """
+    (top, bottom), (left, right) = kernel_offsets(kernel_shape)
+    widths = ((top, bottom), (left, right)) + ((0, 0),) * (image.ndim - 2)
+    if callable(boundary):
+        if _is_pixel_strategy(boundary):
+            return _pad_per_pixel(image, widths, boundary)
+        return boundary(image, widths)
+    if boundary == "zero" or isinstance(boundary, (int, float, np.number)):
+        # Cheaper than np.pad for the common case: one allocation, one copy
+        fill = 0 if boundary == "zero" else boundary
+        padded = np.full((image.shape[0] + top + bottom, image.shape[1] + left + right) + image.shape[2:],
+                         fill, dtype=image.dtype)
+        padded[top:top + image.shape[0], left:left + image.shape[1]] = image
+        return padded
+    if boundary not in BOUNDARY_MODES:
+        raise ValueError(f"unknown boundary mode {boundary!r}, expected one of {list(BOUNDARY_MODES)}, "
+                         "a number or a function")
+    return np.pad(image, widths, mode=BOUNDARY_MODES[boundary])
+
+
+def _is_pixel_strategy(fn):
+    # fn(image, row, column, row_offset, column_offset), as in the naive filters, rather than
+    # fn(image, widths)
+    try:
+        parameters = inspect.signature(fn).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    required = [p for p in parameters if p.default is p.empty
+                and p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    return len(required) == 5
+
+
+def _pad_per_pixel(image, widths, strategy):
+    (top, bottom), (left, right) = widths[:2]
+    rows, cols = image.shape[0] + top + bottom, image.shape[1] + left + right
+    padded = np.empty((rows, cols) + image.shape[2:], dtype=image.dtype)
+    padded[top:top + image.shape[0], left:left + image.shape[1]] = image
+    for row in range(rows):
+        inside_row = top <= row < top + image.shape[0]
+        for col in range(cols):
+            if inside_row and left <= col < left + image.shape[1]:
+                continue
+            padded[row, col] = strategy(image, row - top, col - left, 0, 0)
+    return padded
+
+
+def output_buffer(shape, dtype=None, out=None):
+    """
+    Args:
+        shape: shape of a filter's result.
+        dtype: dtype the caller asked for. None means float64, or out's dtype if there is an out.
+        out: array the caller passed in to be written into.
+    Returns:
+        out (checked against shape and dtype) or a new uninitialized array.
+    """
+    if out is None:
+        return np.empty(shape, dtype=np.float64 if dtype is None else dtype)
+    if out.shape != tuple(shape):
+        raise ValueError(f"out has shape {out.shape}, expected {tuple(shape)}")
+    if dtype is not None and out.dtype != np.dtype(dtype):
+        raise ValueError(f"out has dtype {out.dtype}, but dtype {np.dtype(dtype)} was asked for")
+    return out
+
+
+def work_dtype(dtype):
+    """
+    The float type a result of this dtype is computed in: float64 results in float64, anything
+    smaller (float32, uint8, ...) in float32, whose rounding error stays far below one uint8 level.
+    """
+    return np.float64 if np.dtype(dtype) == np.float64 else np.float32
+
+
+def store(result, out):
+    """
+    Copy a float result into out, rounding and saturating if out is an integer type. result may be
+    overwritten on the way.
+
+    Returns:
+        out
+    """
+    if result is out:
+        return out
+    if out.dtype.kind in "iu":
+        info = np.iinfo(out.dtype)
+        if result.dtype.kind == "f":
+            result = np.rint(result, out=result)
+        result = np.clip(result, info.min, info.max, out=result)
+    np.copyto(out, result, casting="unsafe")
+    return out
+
+
+def fixed_point_kernel(kernel, image_dtype, accumulator=np.int32):
+    """
+    Quantize a kernel for integer accumulation: each tap becomes round(tap * 2**shift), with shift
+    as large as it can be without image_dtype pixels overflowing the accumulator.
+
+    Returns:
+        (integer taps, shift), or None if the kernel is too big for the accumulator to keep 8
+        fractional bits.
+    """
+    pixel_max = 1 if image_dtype == np.bool_ else max(abs(int(np.iinfo(image_dtype).min)), np.iinfo(image_dtype).max)
+    largest = pixel_max * float(np.abs(kernel).sum())
+    if largest == 0:
+        return np.zeros(kernel.shape, dtype=accumulator), 8
+    # One bit of slack for the rounding offset and the taps rounding up
+    shift = np.iinfo(accumulator).bits - 2 - int(np.ceil(np.log2(largest)))
+    if shift < 8:
+        return None
+    shift = min(shift, 24)
+    return np.rint(kernel * float(1 << shift)).astype(accumulator), shift
+
+
+@profiled
+def strided_convolution_filter(image, kernel, boundary="zero", dtype=None, out=None):
+    """
+    Shift-and-accumulate convolution: instead of looping over pixels, loop over the (few) kernel taps
+    and add a shifted view of the padded image to the whole output at once. Each output pixel sees
+    exactly the same sequence of multiply-adds as in `naive_convolution_filter`, so the result is
+    bit-identical for finite images. Taps that are zero are skipped, which is what makes sparse
+    kernels like the 81x81 `shift` cheap.
+
+    Smaller dtypes accumulate in float32, except integer images into integer outputs (uint8 ->
+    uint8, say), which accumulate in int32 fixed point (see `fixed_point_kernel`).
+
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        kernel: numpy array of shape (Hk, Wk).
+        boundary: boundary mode, see `pad_image`.
+        dtype: dtype of the result (e.g. np.float32 or np.uint8). Defaults to float64.
+        out: array of shape (Hi, Wi) (or (Hi, Wi, C)) to write into.
+    Returns:
+        out: numpy array of shape (Hi, Wi) (or (Hi, Wi, C)).
+    """
+    out = output_buffer(image.shape, dtype, out)
+    rows, cols = image.shape[:2]
+    padded = pad_image(image, kernel.shape, boundary)
+    fixed = None
+    if out.dtype.kind in "iu" and image.dtype.kind in "biu":
+        fixed = fixed_point_kernel(kernel, image.dtype)
+    if fixed is not None:
+        kernel, shift = fixed
+        accumulator_dtype = kernel.dtype
+    else:
+        accumulator_dtype = work_dtype(out.dtype)
+        kernel = kernel.astype(accumulator_dtype, copy=False)
+    accumulator = out if out.dtype == accumulator_dtype else np.empty(image.shape, dtype=accumulator_dtype)
+    accumulator[...] = 0
+    # One scratch buffer reused for every tap so we don't allocate a full frame per multiply
+    scratch = np.empty(image.shape, dtype=accumulator.dtype)
+
+    for kernel_row in range(kernel.shape[0]):
+        for kernel_column in range(kernel.shape[1]):
+            weight = kernel[kernel_row, kernel_column]
+            if weight == 0:
+                continue
+            window = padded[kernel_row:kernel_row + rows, kernel_column:kernel_column + cols]
+            np.multiply(window, weight, out=scratch, casting="same_kind")
+            np.add(accumulator, scratch, out=accumulator)
+
+    if fixed is not None:
+        # Back from fixed point, rounding to nearest
+        accumulator += 1 << (shift - 1)
+        accumulator >>= shift
+    return store(accumulator, out)
+
+
+# Names accepted for channels in `multichannel_convolution_filter`
+CHANNEL_NAMES = {"R": 0, "G": 1, "B": 2, "A": 3}
+
+
+def _channel_kernels(kernels, channel_count):
+    """Normalize the kernels argument of `multichannel_convolution_filter` to {channel index: kernel}."""
+    if isinstance(kernels, dict):
+        pairs = kernels.items()
+    else:
+        pairs = enumerate(kernels)
+    by_channel = {}
+    for channel, kernel in pairs:
+        if kernel is None:
+            continue
+        channel = CHANNEL_NAMES.get(channel, channel)
+        if not 0 <= channel < channel_count:
+            raise ValueError(f"no channel {channel} in an image with {channel_count} channels")
+        by_channel[channel] = np.asarray(kernel)
+    return by_channel
+
+
+@profiled
+def multichannel_convolution_filter(image, kernels, boundary="zero", out=None, dtype=None):
+    """
+    Filter some or all channels of an image, each with its own kernel, in one compiled pass.
+    Channels without a kernel are passed through untouched. float32 images stay float32 (sums are
+    still accumulated in double precision); anything that isn't float32 comes back as float64,
+    unless another dtype is asked for.
+
+    Args:
+        image: numpy array of shape (Hi, Wi, C).
+        kernels: dict mapping channel index (or "R", "G", "B", "A") to a kernel, or a sequence with
+            one kernel (or None to pass through) per channel. Kernels can be different sizes.
+        boundary: boundary mode, see `pad_image`.
+        out: optional array of shape (Hi, Wi, C) to write into. Passing the image itself filters it
+            in place, in which case the passed-through channels are never copied at all.
+        dtype: dtype of the result, e.g. np.uint8 to keep a uint8 image uint8 (filtered channels
+            are rounded and saturated).
+    Returns:
+        out: numpy array of shape (Hi, Wi, C).
+    """
+    import compiled
+
+    if dtype is None and out is None:
+        dtype = np.float32 if image.dtype == np.float32 else np.float64
+    by_channel = _channel_kernels(kernels, image.shape[2])
+    in_place = out is image
+    out = output_buffer(image.shape, dtype, out)
+    # Filtering in place leaves the passed-through channels where they are; any other out gets them
+    # copied in
+    passthrough = [] if in_place else [channel for channel in range(image.shape[2]) if channel not in by_channel]
+    if passthrough and out.dtype.kind in "iu" and image.dtype.kind == "f":
+        for channel in passthrough:
+            store(image[..., channel].astype(np.float32), out[..., channel])
+    elif passthrough:
+        out[..., passthrough] = image[..., passthrough]
+    if not by_channel:
+        return out
+
+    # Stack the kernels into one (N, Hk, Wk) block, lining up their centers so the whole stack
+    # shares a single padding. Smaller kernels get zero taps around them.
+    work = work_dtype(out.dtype)
+    channels = np.array(sorted(by_channel), dtype=np.int64)
+    before = [max(kernel_offsets(k.shape)[axis][0] for k in by_channel.values()) for axis in (0, 1)]
+    after = [max(kernel_offsets(k.shape)[axis][1] for k in by_channel.values()) for axis in (0, 1)]
+    stacked = np.zeros((len(channels), before[0] + after[0] + 1, before[1] + after[1] + 1), dtype=work)
+    for i, channel in enumerate(channels):
+        kernel = by_channel[channel]
+        (top, _), (left, _) = kernel_offsets(kernel.shape)
+        stacked[i, before[0] - top:before[0] - top + kernel.shape[0],
+                before[1] - left:before[1] - left + kernel.shape[1]] = kernel
+
+    padded = pad_image(image[..., channels].astype(work, copy=False), stacked.shape[1:], boundary)
+    if out.dtype == work:
+        compiled.correlate_channels(padded, stacked, channels, out)
+        return out
+    # Integer outputs: filter into a float32 frame, then round each filtered channel into out
+    filtered = np.empty(image.shape, dtype=work)
+    compiled.correlate_channels(padded, stacked, channels, filtered)
+    for channel in channels:
+        store(filtered[..., channel], out[..., channel])
+    return out
+
+
+def _fast_length(n):
+    """Smallest 5-smooth number >= n, which pocketfft handles much faster than awkward sizes."""
+    best = n
+    while True:
+        m = best
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return best
+        best += 1
+
+
+class IntermediateCache:
+    """
+    Least-recently-used cache of numpy arrays with a cap on their total size. Safe to share between
+    threads. Arrays are stored read-only, since they may be handed out to several callers.
+
+    Args:
+        max_bytes: once the arrays held add up to more than this, the least recently used ones are
+            dropped. Arrays bigger than max_bytes are never stored.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Returns: the array stored under key (marking it recently used), or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entries to make room."""
+        value.setflags(write=False)
+        if value.nbytes > self.max_bytes:
+            return value
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return value
+
+    def cached(self, key, compute):
+        """
+        Args:
+            key: hashable key.
+            compute: function of no arguments that makes the array if it isn't cached.
+        Returns:
+            the cached array (read-only).
+        """
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# Conjugated kernel spectra, by (kernel, transform size, dtype)
+SPECTRUM_CACHE = IntermediateCache(SPECTRUM_CACHE_BYTES)
+
+
+def kernel_spectrum(kernel, fft_shape, dtype=np.float64):
+    """
+    Args:
+        kernel: numpy array of shape (Hk, Wk).
+        fft_shape: (Hf, Wf) size of the transform.
+        dtype: float type of the images it will be multiplied with (complex64 for float32).
+    Returns:
+        Conjugated rfft2 of the zero-padded kernel (read-only). Kept in SPECTRUM_CACHE, so repeated
+        frames of the same size pay for the kernel transform only once.
+    """
+    kernel = np.ascontiguousarray(kernel, dtype=np.float64)
+    spectrum_dtype = np.complex64 if np.dtype(dtype) == np.float32 else np.complex128
+
+    def compute():
+        # Convolution theorem gives us convolution, but we want correlation: conjugate the spectrum
+        return np.conj(np.fft.rfft2(kernel, s=fft_shape)).astype(spectrum_dtype, copy=False)
+
+    key = (kernel.tobytes(), kernel.shape, tuple(fft_shape), np.dtype(spectrum_dtype).str)
+    return SPECTRUM_CACHE.cached(key, compute)
+
+
+def fft_shape_for(image_shape, kernel_shape):
+    """
+    Args:
+        image_shape: shape of the image.
+        kernel_shape: shape of the kernel.
+    Returns:
+        (Hf, Wf) transform size big enough that circular correlation doesn't wrap around.
+    """
+    return (_fast_length(image_shape[0] + kernel_shape[0] - 1),
+            _fast_length(image_shape[1] + kernel_shape[1] - 1))
+
+
+@profiled
+def fft_convolution_filter(image, kernel, boundary="zero", dtype=None, out=None):
+    """
+    Convolution via the FFT. Costs O(HW log HW) no matter how big the kernel is, so it wins for the
+    large kernels (the 81x81 `shift`, 45x45 Gaussians). Agrees with the direct filters to within
+    floating point rounding. Smaller dtypes do the transforms in single precision.
+
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        kernel: numpy array of shape (Hk, Wk).
+        boundary: boundary mode, see `pad_image`.
+        dtype: dtype of the result (e.g. np.float32 or np.uint8). Defaults to float64.
+        out: array of shape (Hi, Wi) (or (Hi, Wi, C)) to write into.
+    Returns:
+        out: numpy array of shape (Hi, Wi) (or (Hi, Wi, C)).
+    """
+    out = output_buffer(image.shape, dtype, out)
+    work = work_dtype(out.dtype)
+    rows, cols = image.shape[:2]
+    padded = pad_image(image.astype(work, copy=False), kernel.shape, boundary)
+    fft_shape = fft_shape_for(image.shape, kernel.shape)
+    spectrum = kernel_spectrum(kernel, fft_shape, work)
+    if image.ndim == 3:
+        spectrum = spectrum[:, :, np.newaxis]
+
+    product = np.fft.rfft2(padded, s=fft_shape, axes=(0, 1))
+    product *= spectrum
+    return store(np.fft.irfft2(product, s=fft_shape, axes=(0, 1))[:rows, :cols], out)
+
+
+def separable_factors(kernel, tolerance=1e-10):
+    """
+    Split a kernel into a sum of outer products using its SVD. Box blurs, Gaussians and the
+    [1, 0, -1] edge kernels are all rank 1, so they come back as a single (column, row) pair.
+
+    Args:
+        kernel: numpy array of shape (Hk, Wk).
+        tolerance: singular values below tolerance * (largest singular value) are dropped.
+    Returns:
+        factors: list of (column, row) pairs of 1D arrays, with
+            kernel ~= sum(np.outer(column, row) for column, row in factors).
+    """
+    u, s, vt = np.linalg.svd(np.asarray(kernel, dtype=np.float64))
+    if s.size == 0 or s[0] == 0:
+        return []
+    rank = int(np.count_nonzero(s > tolerance * s[0]))
+    scale = np.sqrt(s[:rank])
+    return [(np.ascontiguousarray(u[:, i] * scale[i]), np.ascontiguousarray(vt[i] * scale[i]))
+            for i in range(rank)]
+
+
+@profiled
+def separable_convolution_filter(image, kernel, boundary="zero", factors=None, dtype=None, out=None):
+    """
+    Convolve as a column pass followed by a row pass for each rank-1 piece of the kernel, which
+    costs O(Hk + Wk) per pixel (per piece) instead of O(Hk * Wk). Agrees with the direct filters to
+    within floating point rounding. Smaller dtypes run both passes in float32.
+
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        kernel: numpy array of shape (Hk, Wk).
+        boundary: boundary mode, see `pad_image`.
+        factors: precomputed `separable_factors(kernel)`, if you have them.
+        dtype: dtype of the result (e.g. np.float32 or np.uint8). Defaults to float64.
+        out: array of shape (Hi, Wi) (or (Hi, Wi, C)) to write into.
+    Returns:
+        out: numpy array of shape (Hi, Wi) (or (Hi, Wi, C)).
+    """
+    import compiled
+
+    if factors is None:
+        factors = separable_factors(kernel)
+    out = output_buffer(image.shape, dtype, out)
+    work = work_dtype(out.dtype)
+    rows, cols = image.shape[:2]
+    # The compiled passes only deal with (H, W, C)
+    padded = pad_image(image.astype(work, copy=False), kernel.shape, boundary)
+    padded = padded.reshape(padded.shape[:2] + (-1,))
+
+    shape = (rows, cols, padded.shape[2])
+    # A single piece can go straight into out
+    direct = len(factors) == 1 and out.dtype == work and out.flags.c_contiguous
+    total = out.reshape(shape) if direct else np.zeros(shape, dtype=work)
+    columns_done = np.empty((rows, padded.shape[1], padded.shape[2]), dtype=work)
+    # With a single piece there's nothing to sum, so it's written straight into total
+    piece = total if len(factors) == 1 else np.empty_like(total)
+    # Pad once and run both passes in "valid" mode: summing over the padded buffer is exactly the
+    # 2D correlation, whatever the boundary mode was
+    for column, row in factors:
+        compiled.correlate_columns(padded, column, columns_done)
+        compiled.correlate_rows(columns_done, row, piece)
+        if piece is not total:
+            total += piece
+    return out if direct else store(total.reshape(image.shape), out)
+
+
+# The fixed taps cv2.getGaussianKernel uses for small kernels when sigma <= 0
+SMALL_GAUSSIANS = {
+    1: [1.0],
+    3: [0.25, 0.5, 0.25],
+    5: [0.0625, 0.25, 0.375, 0.25, 0.0625],
+    7: [0.03125, 0.109375, 0.21875, 0.28125, 0.21875, 0.109375, 0.03125],
+    9: [4 / 256, 13 / 256, 30 / 256, 51 / 256, 60 / 256, 51 / 256, 30 / 256, 13 / 256, 4 / 256],
+}
+
+
+def gaussian_taps(ksize, sigma=0):
+    """
+    1D Gaussian taps, the same as cv2.getGaussianKernel(ksize, sigma) so results line up with
+    cv2.GaussianBlur(image, (ksize, ksize), sigma).
+
+    Args:
+        ksize: number of taps (odd).
+        sigma: standard deviation. <= 0 means work it out from ksize the way OpenCV does.
+    Returns:
+        taps: float64 array of length ksize summing to 1.
+    """
+    if ksize < 1 or ksize % 2 == 0:
+        raise ValueError(f"Gaussian kernel size must be odd and positive, got {ksize}")
+    return _gaussian_taps(int(ksize), float(sigma)).copy()
+
+
+@lru_cache(maxsize=128)
+def _gaussian_taps(ksize, sigma):
+    # Parameter sweeps ask for the same few kernels over and over
+    if sigma <= 0 and ksize in SMALL_GAUSSIANS:
+        return np.array(SMALL_GAUSSIANS[ksize])
+    if sigma <= 0:
+        sigma = 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+    x = np.arange(ksize) - (ksize - 1) / 2
+    taps = np.exp(-x * x / (2 * sigma * sigma))
+    return taps / taps.sum()
+
+
+def gaussian_kernel(ksize, sigma=0):
+    """
+    Returns:
+        kernel: (ksize, ksize) Gaussian blur kernel, the outer product of `gaussian_taps`.
+    """
+    taps = gaussian_taps(ksize, sigma)
+    return np.outer(taps, taps)
+
+
+def _box_sums(padded, rows, cols):
+    """
+    Sum over every rows x cols window of an already padded image, via its summed-area table: four
+    lookups per pixel whatever the window size. Integer images are summed exactly: unsigned ones
+    (uint8, ...) in a uint32 table when a window's sum fits in 32 bits, since the differences of
+    the table come out right modulo 2**32 even where the table itself wraps around; other integers
+    in int64. Float images use a float64 table, because a float32 one loses the low bits of every
+    pixel once the running sums get large.
+
+    Returns:
+        sums: array of shape (Hp-rows+1, Wp-cols+1) (plus any trailing channel axis), in the
+        table's dtype.
+    """
+    dtype = np.float64
+    if padded.dtype.kind in "bu":
+        pixel_max = 1 if padded.dtype == np.bool_ else np.iinfo(padded.dtype).max
+        # +1 leaves room to round when dividing by the area
+        dtype = np.uint32 if (pixel_max + 1) * rows * cols < 2 ** 32 else np.int64
+    elif padded.dtype.kind == "i":
+        dtype = np.int64
+    table = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1) + padded.shape[2:], dtype=dtype)
+    np.cumsum(padded, axis=0, dtype=dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    height, width = padded.shape[0] - rows + 1, padded.shape[1] - cols + 1
+    sums = table[rows:rows + height, cols:cols + width] - table[:height, cols:cols + width]
+    sums -= table[rows:rows + height, :width]
+    sums += table[:height, :width]
+    return sums
+
+
+def _scale_sums(sums, out, divisor=1, scale=1.0):
+    """
+    Write sums * scale / divisor into out. Integer sums going into an integer out with scale 1 are
+    divided exactly (rounding halves up) without ever becoming floats.
+    """
+    if sums.dtype.kind in "iu" and out.dtype.kind in "iu" and scale == 1:
+        sums += divisor // 2
+        sums //= divisor
+        return store(sums, out)
+    if out.dtype.kind == "f" and scale == 1:
+        return np.divide(sums, divisor, out=out, casting="same_kind")
+    if out.dtype.kind == "f":
+        return np.multiply(sums, scale / divisor, out=out, casting="same_kind")
+    return store(np.multiply(sums, scale / divisor, dtype=np.float32), out)
+
+
+def _box_size(ksize):
+    return (ksize, ksize) if np.isscalar(ksize) else tuple(ksize)
+
+
+@profiled
+def box_filter(image, ksize, boundary="zero", normalize=True, dtype=None, out=None):
+    """
+    Box (mean) filter in O(1) per pixel: the same as convolving with np.ones(ksize) / area, with the
+    same offsets and boundary modes as everything else in this file, but the cost doesn't depend on
+    the kernel size. uint8 -> uint8 is exact (the mean, rounded).
+
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        ksize: kernel size, as an int or (rows, cols). Even sizes follow the usual offset convention.
+        boundary: boundary mode, see `pad_image`.
+        normalize: divide by the kernel area (a mean). False gives the plain window sums.
+        dtype: dtype of the result (e.g. np.float32 or np.uint8). Defaults to float64.
+        out: array of shape (Hi, Wi) (or (Hi, Wi, C)) to write into.
+    Returns:
+        out: numpy array of shape (Hi, Wi) (or (Hi, Wi, C)).
+    """
+    rows, cols = _box_size(ksize)
+    sums = _box_sums(pad_image(image, (rows, cols), boundary), rows, cols)
+    return _scale_sums(sums, output_buffer(image.shape, dtype, out), rows * cols if normalize else 1)
+
+
+def box_sizes_for_gaussian(sigma, passes=3):
+    """
+    Widths of `passes` box filters that, run one after another, come closest to a Gaussian of
+    standard deviation sigma (Kovesi, "Fast almost-Gaussian filtering"). Boxes are odd, so the
+    result stays centered.
+    """
+    ideal = np.sqrt(12 * sigma * sigma / passes + 1)
+    lower = int(np.floor(ideal))
+    if lower % 2 == 0:
+        lower -= 1
+    lower = max(lower, 1)
+    # How many of the passes use the smaller width so that the variances add up to sigma^2
+    smaller = round((12 * sigma * sigma - passes * lower * lower - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    smaller = min(max(smaller, 0), passes)
+    return [lower if i < smaller else lower + 2 for i in range(passes)]
+
+
+@profiled
+def box_gaussian(image, sigma, boundary="zero", passes=3, dtype=None, out=None):
+    """
+    Approximate Gaussian blur as a few box filters in a row (the central limit theorem at work;
+    three passes are within a few percent of a true Gaussian). Each pass is O(1) per pixel, so big
+    sigmas cost the same as small ones.
+
+    The image is padded once for the combined kernel and the passes run in "valid" mode, so every
+    boundary mode means exactly what it does for a single convolution.
+
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        sigma: standard deviation of the Gaussian to approximate.
+        boundary: boundary mode, see `pad_image`.
+        passes: number of box filters.
+        dtype: dtype of the result (e.g. np.float32 or np.uint8). Defaults to float64; anything
+            smaller keeps the intermediate passes in float32.
+        out: array of shape (Hi, Wi) (or (Hi, Wi, C)) to write into.
+    Returns:
+        out: numpy array of shape (Hi, Wi) (or (Hi, Wi, C)).
+    """
+    out = output_buffer(image.shape, dtype, out)
+    sizes = box_sizes_for_gaussian(sigma, passes)
+    combined = sum(sizes) - len(sizes) + 1
+    current = pad_image(image, (combined, combined), boundary)
+    for size in sizes[:-1]:
+        current = np.divide(_box_sums(current, size, size), size * size, dtype=work_dtype(out.dtype))
+    return _scale_sums(_box_sums(current, sizes[-1], sizes[-1]), out, sizes[-1] * sizes[-1])
+
+
+def direct_cost(image_shape, kernel):
+    """Rough cost of `strided_convolution_filter`: one multiply-add per pixel per nonzero tap."""
+    return image_shape[0] * image_shape[1] * np.count_nonzero(kernel)
+
+
+def fft_cost(image_shape, kernel):
+    """Rough cost of `fft_convolution_filter`, in the same units as `direct_cost`."""
+    size = np.prod(fft_shape_for(image_shape, kernel.shape))
+    return FFT_COST_RATIO * size * np.log2(size)
+
+
+def separable_cost(image_shape, factors):
+    """Rough cost of `separable_convolution_filter`, in the same units as `direct_cost`."""
+    return image_shape[0] * image_shape[1] * sum(len(column) + len(row) for column, row in factors)
+
+
+def box_cost(image_shape):
+    """Rough cost of `box_filter` (two running sums and four lookups per pixel), in the same units."""
+    return 6 * image_shape[0] * image_shape[1]
+
+
+def is_box_kernel(kernel):
+    """Whether every tap of kernel has the same nonzero weight, so it's a scaled `box_filter`."""
+    first = kernel.flat[0]
+    return first != 0 and bool(np.all(kernel == first))
+
+
+@profiled
+def convolve(image, kernel, boundary="zero", method="auto", dtype=None, out=None):
+    """
+    Convolve with whichever backend should be fastest for this image and kernel.
+
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        kernel: numpy array of shape (Hk, Wk).
+        boundary: boundary mode, see `pad_image`.
+        method: "direct", "separable", "fft", "box" (constant kernels only) or "auto" (pick using
+            the cost model above).
+        dtype: dtype of the result (e.g. np.float32 or np.uint8). Defaults to float64.
+        out: array of shape (Hi, Wi) (or (Hi, Wi, C)) to write into.
+    Returns:
+        out: numpy array of shape (Hi, Wi) (or (Hi, Wi, C)).
+    """
+    factors = None
+    if method == "auto":
+        costs = {
+            "direct": direct_cost(image.shape, kernel),
+            "fft": fft_cost(image.shape, kernel),
+        }
+        if is_box_kernel(kernel):
+            costs["box"] = box_cost(image.shape)
+        # An SVD is cheap next to even one pass over the image
+        if min(kernel.shape[:2]) > 1:
+            factors = separable_factors(kernel)
+            costs["separable"] = separable_cost(image.shape, factors)
+        method = min(costs, key=costs.get)
+    if method == "direct":
+        return strided_convolution_filter(image, kernel, boundary, dtype, out)
+    if method == "separable":
+        return separable_convolution_filter(image, kernel, boundary, factors, dtype, out)
+    if method == "fft":
+        return fft_convolution_filter(image, kernel, boundary, dtype, out)
+    if method == "box":
+        if not is_box_kernel(kernel):
+            raise ValueError("the box method needs a kernel with every tap equal")
+        sums = _box_sums(pad_image(image, kernel.shape, boundary), *kernel.shape)
+        return _scale_sums(sums, output_buffer(image.shape, dtype, out), scale=float(kernel.flat[0]))
+    raise ValueError(f"unknown convolution method {method!r}")
+
+
+def measure_fft_crossover(size=1024, kernel_size=15, repeats=3):
+    """
+    Time both backends on a random frame and work out the FFT_COST_RATIO that makes the cost model
+    match this machine.
+
+    Args:
+        size: side length of the square test frame.
+        kernel_size: side length of the dense test kernel.
+        repeats: number of timed runs per backend (the fastest is used).
+    Returns:
+        ratio: value to use for FFT_COST_RATIO.
+    """
+    rng = np.random.default_rng(0)
+    image = rng.random((size, size))
+    kernel = rng.random((kernel_size, kernel_size))
+
+    def best_time(fn):
+        fn(image, kernel)  # warm the spectrum cache / allocator
+        times = []
+        for _ in range(repeats):
+            start = perf_counter()
+            fn(image, kernel)
+            times.append(perf_counter() - start)
+        return min(times)
+
+    direct_per_unit = best_time(strided_convolution_filter) / direct_cost(image.shape, kernel)
+    fft_size = np.prod(fft_shape_for(image.shape, kernel.shape))
+    fft_per_unit = best_time(fft_convolution_filter) / (fft_size * np.log2(fft_size))
+    return fft_per_unit / direct_per_unit
+
+
+@profiled
+def parallel_convolution_filter(image, kernel, boundary="zero", backend="prange", workers=None, tile_rows=None,
+                                dtype=None, out=None):
+    """
+    Direct k x k convolution split into row bands that run on every core. Each band reads its own
+    Hk-1 rows of halo from the shared padded buffer and writes a disjoint slice of the output, so
+    the result is exactly that of the serial `numba_convolution_filter`.
+
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        kernel: numpy array of shape (Hk, Wk).
+        boundary: boundary mode, see `pad_image`.
+        backend: "prange" (numba's own thread pool) or "threads" (a ThreadPoolExecutor driving the
+            nogil kernel).
+        workers: number of threads to use. Defaults to every core.
+        tile_rows: output rows per band. Defaults to enough bands for 4 per worker.
+        dtype: dtype of the result (e.g. np.float32 or np.uint8). Defaults to float64; anything
+            smaller works on a float32 copy of the image (sums are still double precision).
+        out: array of shape (Hi, Wi) (or (Hi, Wi, C)) to write into.
+    Returns:
+        out: numpy array of shape (Hi, Wi) (or (Hi, Wi, C)).
+    """
+    import numba
+    import compiled
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    rows = image.shape[0]
+    if tile_rows is None:
+        tile_rows = max(1, -(-rows // (workers * 4)))
+    out = output_buffer(image.shape, dtype, out)
+    work = work_dtype(out.dtype)
+    kernel = np.ascontiguousarray(kernel, dtype=np.float64)
+    padded = pad_image(image.astype(work, copy=False), kernel.shape, boundary)
+    padded = padded.reshape(padded.shape[:2] + (-1,))
+    shape = (rows, image.shape[1], padded.shape[2])
+    direct = out.dtype == work and out.flags.c_contiguous
+    result = out.reshape(shape) if direct else np.empty(shape, dtype=work)
+
+    if backend == "prange":
+        previous = numba.get_num_threads()
+        numba.set_num_threads(min(workers, numba.config.NUMBA_NUM_THREADS))
+        try:
+            compiled.correlate_tiled(padded, kernel, result, tile_rows)
+        finally:
+            numba.set_num_threads(previous)
+    elif backend == "threads":
+        halo = kernel.shape[0] - 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            bands = [pool.submit(compiled.correlate, padded[start:min(start + tile_rows, rows) + halo],
+                                 kernel, result[start:start + tile_rows])
+                     for start in range(0, rows, tile_rows)]
+            for band in bands:
+                band.result()
+    else:
+        raise ValueError(f"unknown parallel backend {backend!r}")
+    return out if direct else store(result.reshape(image.shape), out)
+
+
+def scaling_benchmark(image, kernel, backend="prange", max_workers=None, repeats=3):
+    """
+    Time `parallel_convolution_filter` at every thread count from 1 to max_workers.
+
+    Args:
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C).
+        kernel: numpy array of shape (Hk, Wk).
+        backend: "prange" or "threads".
+        max_workers: largest thread count to try. Defaults to every core.
+        repeats: timed runs per thread count (the fastest is kept).
+    Returns:
+        results: dict mapping thread count to (seconds, speedup over 1 thread).
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    # First call compiles; keep that out of the numbers
+    parallel_convolution_filter(image[:8, :8], kernel, backend=backend, workers=1)
+
+    timings = {}
+    for workers in range(1, max_workers + 1):
+        best = float("inf")
+        for _ in range(repeats):
+            start = perf_counter()
+            parallel_convolution_filter(image, kernel, backend=backend, workers=workers)
+            best = min(best, perf_counter() - start)
+        timings[workers] = best
+    return {workers: (seconds, timings[1] / seconds) for workers, seconds in timings.items()}
@@ -1,123 +1,158 @@
+# """
+# Generates the images for the Edge Detection writeup (edges.org): run `python edges.py` from this
+# directory after downloading the images listed there.
+#
+# Importing this file only loads NumPy: cv2, skimage and matplotlib are imported the first time
+# something needs them, and the exercises only run when it's executed as a script.
+# """
 
-from skimage import io
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from time import time
+
+from pixelops import threshold as pixel_threshold, threshold_to_zero
+from profiling import profiled
+
+def pyplot():
+    # Deferred so that importing this module doesn't start up matplotlib
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 def display(img, title=None):
+    plt = pyplot()
     # Show image
     plt.figure(figsize = (5,5))
     plt.imshow(img)
     plt.title(title)
     plt.axis('off')
     plt.show()
+    plt.close()
 
 ### Bonus utility for saving images
 def save(img, name, title=None):
-    # Show image
-    plt.figure(figsize = (5,5))
-    plt.imshow(img)
-    plt.title(title)
-    plt.axis('off')
-    plt.savefig(f"./{name}.jpg", bbox_inches='tight')
+    # Writes the pixels themselves (no figure, axes or resampling); title is only used by display().
+    # Everything here comes from cv2.imread, so color images are BGR.
+    from imagewriter import write_image
+    write_image(f"./{name}.jpg", img, bgr=True)
+
+# Derivative responses below this are zeroed by simple_edge_detection's "filtered" image
+EDGE_RESPONSE_CUTOFF = 60
 
-import cv2
+def simple_edge_detection():
+    import cv2
 
-fil = np.array(
-[
-    [1,0,-1]
-])
+    fil = np.array(
+    [
+        [1,0,-1]
+    ])
 
-image = cv2.imread('./iguana.png')
+    image = cv2.imread('./iguana.png')
 
-# # The image is dark, and it's hard to tell where the edges are that we found. How can we improve on this? Can we do this in a single filter?
+    # # The image is dark, and it's hard to tell where the edges are that we found. How can we improve on this? Can we do this in a single filter?
 
-fil = np.array([[1, 0, -1]])
-save(cv2.filter2D(image, -1, fil), "brighter")
+    fil = np.array([[1, 0, -1]])
+    save(cv2.filter2D(image, -1, fil), "brighter")
 
-# # The algorithm finds lots of edges, but we don't care about all of them. Could we keep only the brightest edges somehow?
+    # # The algorithm finds lots of edges, but we don't care about all of them. Could we keep only the brightest edges somehow?
 
-fil = np.array([2, 0, -2])
-result = cv2.filter2D(image, -1, fil)
-threshold = 60
-def f(x):
-    if x < threshold:
-        return 0
-    else:
-        return x
-result = np.vectorize(f)(result)
-save(result, "filtered")
+    fil = np.array([2, 0, -2])
+    result = cv2.filter2D(image, -1, fil)
+    threshold_to_zero(result, EDGE_RESPONSE_CUTOFF, out=result)
+    save(result, "filtered")
 
-# # We used a horizontal derivative filter. Create and run a vertical derivative filter. Should it look similar? Does it? Find an image where the horizontal and vertical derivative filters produce very different output.
+    # # We used a horizontal derivative filter. Create and run a vertical derivative filter. Should it look similar? Does it? Find an image where the horizontal and vertical derivative filters produce very different output.
 
-stripes = cv2.imread('./stripes.jpg')
-fil = np.array([[2, 0, -2]]) # needs to be a 2d array!
-print(np.transpose(fil), fil)
-save(cv2.filter2D(stripes, -1, np.transpose(fil)), "vert")
-save(cv2.filter2D(stripes, -1, fil), "nonvert")
+    stripes = cv2.imread('./stripes.jpg')
+    fil = np.array([[2, 0, -2]]) # needs to be a 2d array!
+    print(np.transpose(fil), fil)
+    save(cv2.filter2D(stripes, -1, np.transpose(fil)), "vert")
+    save(cv2.filter2D(stripes, -1, fil), "nonvert")
 
-# # How does the derivative filter respond to noise? Load and run the filter on the noisy_einstein image. Can you improve on this result?
+    # # How does the derivative filter respond to noise? Load and run the filter on the noisy_einstein image. Can you improve on this result?
 
-einstein = cv2.imread('./noisy_einstein.png')
-save(cv2.filter2D(einstein, -1, fil*2), "einstein")
-save(cv2.filter2D(cv2.filter2D(einstein, -1, np.ones((3,3))/9), -1, fil*2), "blur_einstein")
+    einstein = cv2.imread('./noisy_einstein.png')
+    save(cv2.filter2D(einstein, -1, fil*2), "einstein")
+    # Mean blur from the summed-area table ("reflect" is cv2's default border); cost doesn't grow with the box
+    from convolution import box_filter
+    blurred = box_filter(einstein, 3, "reflect", dtype=np.uint8)
+    save(cv2.filter2D(blurred, -1, fil*2), "blur_einstein")
 
 ########
 # Adv edge detection
 #######
 
-# Recall from lecture that the two parameters to Gaussian blur are kernel size and sigma. How do changing these parameters affect the output of the blur filter? You may want to find a different example image to illustrate your point.
+def advanced_edge_detection():
+    import cv2
+    from skimage import feature, data
 
-save(cv2.GaussianBlur(einstein, (5,5), 0.1), "sigma01")
-save(cv2.GaussianBlur(einstein, (5,5), 0.5), "sigma05")
-save(cv2.GaussianBlur(einstein, (5,5), 1), "sigma1")
-save(cv2.GaussianBlur(einstein, (5,5), 2), "sigma2")
-save(cv2.GaussianBlur(einstein, (5,5), 10), "sigma10")
+    # Timed as stages when profiling is on (see profiling.py)
+    gaussian_blur = profiled(cv2.GaussianBlur, "cv2.GaussianBlur")
+    skimage_canny = profiled(feature.canny, "skimage.canny")
 
-save(cv2.GaussianBlur(einstein, (5,5), 0.1), "kern5")
-save(cv2.GaussianBlur(einstein, (15,15), 0.1), "kern15")
-save(cv2.GaussianBlur(einstein, (25,25), 0.1), "kern25")
-save(cv2.GaussianBlur(einstein, (45,45), 0.1), "kern45")
+    einstein = cv2.imread('./noisy_einstein.png')
 
-from skimage import feature, data
+    # Recall from lecture that the two parameters to Gaussian blur are kernel size and sigma. How do changing these parameters affect the output of the blur filter? You may want to find a different example image to illustrate your point.
 
-coins = data.coins()
-# Play with the thresholds to get different output. How does changing each threshold affect the edges that the algorithm finds?
-save(feature.canny(coins, sigma=1, low_threshold=5, high_threshold=50), "low_5")
-save(feature.canny(coins, sigma=1, low_threshold=25, high_threshold=50), "low_25")
-save(feature.canny(coins, sigma=1, low_threshold=40, high_threshold=50), "low_40")
-save(feature.canny(coins, sigma=1, low_threshold=45, high_threshold=50), "low_45")
+    save(gaussian_blur(einstein, (5,5), 0.1), "sigma01")
+    save(gaussian_blur(einstein, (5,5), 0.5), "sigma05")
+    save(gaussian_blur(einstein, (5,5), 1), "sigma1")
+    save(gaussian_blur(einstein, (5,5), 2), "sigma2")
+    save(gaussian_blur(einstein, (5,5), 10), "sigma10")
 
-save(feature.canny(coins, sigma=1, low_threshold=25, high_threshold=30), "high_30")
-save(feature.canny(coins, sigma=1, low_threshold=25, high_threshold=50), "high_50")
-save(feature.canny(coins, sigma=1, low_threshold=25, high_threshold=80), "high_80")
-save(feature.canny(coins, sigma=1, low_threshold=25, high_threshold=90), "high_90")
+    save(gaussian_blur(einstein, (5,5), 0.1), "kern5")
+    save(gaussian_blur(einstein, (15,15), 0.1), "kern15")
+    save(gaussian_blur(einstein, (25,25), 0.1), "kern25")
+    save(gaussian_blur(einstein, (45,45), 0.1), "kern45")
 
-# Imagine that you have an image with lots of false positives: that is, it finds lots of edges that aren't actually edges. How would you adjust thresholds to improve the result?
+    coins = data.coins()
+    # (sweep.py runs grids like these sharing the work between settings: one blur per kernel, one
+    # gradient pass for all the thresholds)
+    # Play with the thresholds to get different output. How does changing each threshold affect the edges that the algorithm finds?
+    save(skimage_canny(coins, sigma=1, low_threshold=5, high_threshold=50), "low_5")
+    save(skimage_canny(coins, sigma=1, low_threshold=25, high_threshold=50), "low_25")
+    save(skimage_canny(coins, sigma=1, low_threshold=40, high_threshold=50), "low_40")
+    save(skimage_canny(coins, sigma=1, low_threshold=45, high_threshold=50), "low_45")
 
-## Raise them 
+    save(skimage_canny(coins, sigma=1, low_threshold=25, high_threshold=30), "high_30")
+    save(skimage_canny(coins, sigma=1, low_threshold=25, high_threshold=50), "high_50")
+    save(skimage_canny(coins, sigma=1, low_threshold=25, high_threshold=80), "high_80")
+    save(skimage_canny(coins, sigma=1, low_threshold=25, high_threshold=90), "high_90")
 
-# Imagine that you have an image where the edges don't connect well: that is, it finds some edges, but the edges tend to be broken lines instead of solid lines. How would you adjust thresholds to improve the result?
+    # Imagine that you have an image with lots of false positives: that is, it finds lots of edges that aren't actually edges. How would you adjust thresholds to improve the result?
 
-## Lower the low threshold some
+    ## Raise them
 
-# Remember from exercise 1 that the two parameters to the Gaussian blur are kernel size and sigma, and that both affect the output of the blur filter. Notice that skimage's canny implementation only takes sigma as a parameter. Without modifying the source code, how might you incorporate a different kernel size into the implementation?
+    # Imagine that you have an image where the edges don't connect well: that is, it finds some edges, but the edges tend to be broken lines instead of solid lines. How would you adjust thresholds to improve the result?
 
-## I'd pre-blur the image, then set the sigma to not blur it at all?
-prepross = cv2.GaussianBlur(coins, (5,5), 0.1)
-save(feature.canny(coins, sigma=0, low_threshold=25, high_threshold=50), "prepross")
+    ## Lower the low threshold some
 
-# Try to improve the edges you find by tweaking the parameters.
+    # Remember from exercise 1 that the two parameters to the Gaussian blur are kernel size and sigma, and that both affect the output of the blur filter. Notice that skimage's canny implementation only takes sigma as a parameter. Without modifying the source code, how might you incorporate a different kernel size into the implementation?
 
-# Try running the edge detector on some different images. skimage.data has a good set to start with. You can also look at Berkeley's collection of benchmark images. Take notes on which images Canny performs well on, and which it does not.
+    ## I'd pre-blur the image, then set the sigma to not blur it at all?
+    prepross = gaussian_blur(coins, (5,5), 0.1)
+    save(skimage_canny(coins, sigma=0, low_threshold=25, high_threshold=50), "prepross")
+
+    ## Or use our own canny (canny.py), which takes the kernel size directly and does the blur in the
+    ## same pass as the gradients instead of as a separate image
+    from canny import canny
+    save(canny(coins, 25, 50, sigma=1, ksize=5), "canny_kern5")
+    save(canny(coins, 25, 50, sigma=1, ksize=15), "canny_kern15")
+
+    ## The coins are still there at half the size: pyramid_canny finds them there and only goes
+    ## back over the full size image around what it found (pyramid.py)
+    from pyramid import pyramid_canny
+    save(pyramid_canny(coins, 25, 50, sigma=1, levels=1), "canny_pyramid")
+
+    # Try to improve the edges you find by tweaking the parameters.
+
+    # Try running the edge detector on some different images. skimage.data has a good set to start with. You can also look at Berkeley's collection of benchmark images. Take notes on which images Canny performs well on, and which it does not.
 
 ### Hough Transform
 
 # #  We've found some lines. Lots of them, in fact. Using only the techniques we've learned so far, how can we clean up this image to only show the lines that correspond to lanes? Optional: implement some of them and show the improvement in the produced image.
 
 def show_lines(edge_image, lines):
+    plt = pyplot()
     plt.figure(figsize = (5,5))
     plt.imshow(edge_image * 0)
     plt.axis('off')
@@ -125,76 +160,90 @@ def show_lines(edge_image, lines):
         p0, p1 = line
         plt.plot((p0[0], p1[0]), (p0[1], p1[1]))
     plt.show()
+    plt.close()
 
 
 def save_lines(edge_image, lines, name):
-    plt.figure(figsize = (5,5))
-    plt.imshow(edge_image * 0)
-    plt.axis('off')
-    for line in lines:
-        p0, p1 = line
-        plt.plot((p0[0], p1[0]), (p0[1], p1[1]))
-    plt.savefig(f"./{name}.jpg", bbox_inches='tight')
-    
-from skimage.transform import probabilistic_hough_line
-
-# # These lines should be ideal for both the canny edge detection and the hough transform, so let's just go crazy with the thresholding. We could also crank up the sigma value.
-
-image = cv2.imread('./road.jpg', flags=cv2.IMREAD_GRAYSCALE)
-
-edge_image = feature.canny(image, sigma=1, low_threshold=20, high_threshold=80)
-lines = probabilistic_hough_line(edge_image, threshold=1, line_length=20, line_gap=5)
-save_lines(image, lines, "poor_canny")
-
-edge_image = feature.canny(image, sigma=1, low_threshold=100, high_threshold=120)
-lines = probabilistic_hough_line(edge_image, threshold=1, line_length=20, line_gap=5)
-save_lines(edge_image, lines, "mediocre_canny")
+    from imagewriter import write_lines
+    write_lines(f"./{name}.jpg", edge_image.shape, lines)
 
-# image = cv2.imread('./road.jpg', flags=cv2.IMREAD_GRAYSCALE)
-# edge_image = feature.canny(image, sigma=1, low_threshold=100, high_threshold=120)
-# display(image)
 # # We can also try masking out all the white spots in the image...
-
-image = cv2.imread('./road.jpg', flags=cv2.IMREAD_GRAYSCALE)
-
-for row in range(image.shape[0]):
-    for col in range(image.shape[1]):
-        if image[row, col] > 200:
-            image[row,col] = 255
-        else:
-            image[row,col] = 0
-
-edge_image = feature.canny(image, sigma=1, low_threshold=100, high_threshold=120)            
-lines = probabilistic_hough_line(edge_image, threshold=1, line_length=5, line_gap=5)
-save(image, "masked_image")
-save_lines(image, lines, "masked")
-
-# # print(image.shape)    
-# display(edge_image)
-
-# lines = probabilistic_hough_line(edge_image, threshold=1, line_length=5, line_gap=5)
-# save_lines(edge_image, lines, "better_canny")
+def mask_bright(image, cutoff=200):
+    # In place, like the row/col loop this used to be
+    return pixel_threshold(image, cutoff, 255, 0, out=image)
 
 # We can also use additional information that we have about the image; namely, we know that our images are always coming from a camera mounted on the front of the car. How could we use this information to improve on our lane-finding algorithm? Optional: implement your suggestion and show the improvement in the produced image.
-
-
-edge_image = feature.canny(image, sigma=1, low_threshold=100, high_threshold=120)
-lines = probabilistic_hough_line(edge_image, threshold=50, line_length=25, line_gap=30)
-
-final_lines = []
-for line in lines:
-    try:
-        slope = (line[1][0]-line[0][0])/(line[1][1]-line[0][1])
-        if abs(slope) > 4:
-            continue
-        if line[0][0] < image.shape[1]/2 and slope < 0:            
-            final_lines.append(line)
-        elif line[0][0] > image.shape[1]/2 and slope > 0:
-            final_lines.append(line)
-    except:
-        pass
-save_lines(edge_image, lines, "prefilter")
-save_lines(edge_image, final_lines, "postfilter")
+@profiled
+def filter_lane_lines(lines, width):
+    # Keep lines that aren't too flat (|dx/dy| <= 4, horizontal ones are out) and lean the way a lane
+    # does on their side of the car: left half leaning one way, right half the other. LineSet does
+    # this for all the lines at once instead of one try/except per line.
+    from lineset import LineSet
+    return LineSet(lines).lane_filter(width, max_slope=4)
+
+def hough_transform():
+    import cv2
+    from skimage import feature
+    from skimage.transform import probabilistic_hough_line
+
+    # Timed as stages when profiling is on (see profiling.py)
+    skimage_canny = profiled(feature.canny, "skimage.canny")
+    probabilistic_hough_line = profiled(probabilistic_hough_line, "skimage.probabilistic_hough_line")
+
+    # # These lines should be ideal for both the canny edge detection and the hough transform, so let's just go crazy with the thresholding. We could also crank up the sigma value.
+
+    image = cv2.imread('./road.jpg', flags=cv2.IMREAD_GRAYSCALE)
+
+    edge_image = skimage_canny(image, sigma=1, low_threshold=20, high_threshold=80)
+    lines = probabilistic_hough_line(edge_image, threshold=1, line_length=20, line_gap=5)
+    save_lines(image, lines, "poor_canny")
+
+    edge_image = skimage_canny(image, sigma=1, low_threshold=100, high_threshold=120)
+    lines = probabilistic_hough_line(edge_image, threshold=1, line_length=20, line_gap=5)
+    save_lines(edge_image, lines, "mediocre_canny")
+
+    # image = cv2.imread('./road.jpg', flags=cv2.IMREAD_GRAYSCALE)
+    # edge_image = feature.canny(image, sigma=1, low_threshold=100, high_threshold=120)
+    # display(image)
+
+    image = mask_bright(cv2.imread('./road.jpg', flags=cv2.IMREAD_GRAYSCALE))
+
+    edge_image = skimage_canny(image, sigma=1, low_threshold=100, high_threshold=120)
+    lines = probabilistic_hough_line(edge_image, threshold=1, line_length=5, line_gap=5)
+    save(image, "masked_image")
+    save_lines(image, lines, "masked")
+
+    # # print(image.shape)
+    # display(edge_image)
+
+    # lines = probabilistic_hough_line(edge_image, threshold=1, line_length=5, line_gap=5)
+    # save_lines(edge_image, lines, "better_canny")
+
+    edge_image = skimage_canny(image, sigma=1, low_threshold=100, high_threshold=120)
+    lines = probabilistic_hough_line(edge_image, threshold=50, line_length=25, line_gap=30)
+
+    final_lines = filter_lane_lines(lines, image.shape[1])
+    save_lines(edge_image, lines, "prefilter")
+    save_lines(edge_image, final_lines, "postfilter")
+
+    # Better yet, the camera tells us where the road is before we do any work: crop to a trapezoid
+    # ahead of the car, run Canny/Hough on just that, and map the lines back afterwards
+    from lanes import RegionOfInterest
+    roi = RegionOfInterest()
+    edge_image = roi.mask_edges(skimage_canny(roi.crop(image), sigma=1, low_threshold=100, high_threshold=120))
+    lines = roi.to_full_frame(probabilistic_hough_line(edge_image, threshold=50, line_length=25, line_gap=30))
+    save_lines(image, filter_lane_lines(lines, image.shape[1]), "roi")
+
+    # The lane lines are still there at a quarter of the size, so look for them there first and
+    # only redo Canny + Hough at full resolution in a band around what was found (pyramid.py). On
+    # big frames that's a small part of the image.
+    from pyramid import pyramid_hough_lines
+    lines = pyramid_hough_lines(image, 100, 120, threshold=50, line_length=25, line_gap=30)
+    save_lines(image, filter_lane_lines(lines, image.shape[1]), "pyramid")
 
 # A video is just a series of images (usually 30 images per second). Imagine that your lane-finding algorithm is being fed a video from a front-mounted camera. Describe how you would use your lane-finding algorithm to keep the car driving straight and in its lane.
 
+if __name__ == "__main__":
+    simple_edge_detection()
+    advanced_edge_detection()
+    hough_transform()
@@ -8,42 +8,46 @@
 # ```
 # wget https://upload.wikimedia.org/wikipedia/commons/thumb/b/b6/Image_created_with_a_mobile_phone.png/440px-Image_created_with_a_mobile_phone.png -O image.png
 # ```
-# to get the larger image used in the advanced exercises.
+# to get the larger image used in the advanced exercises, then run `python filters.py`.
+#
+# Importing this file only loads NumPy: skimage, matplotlib and numba are pulled in the first time
+# something actually needs them, and the exercises only run when it's executed as a script.
 # """
 
 
-from skimage import io
 import numpy as np
-import matplotlib.pyplot as plt
-from time import time
 import math
 
+from profiling import profiled
+
 ### Provided methods for loading/displaying images
-def load(image_path):
+# (batch.py runs these filters over whole directories, decoding to float32 instead)
+@profiled
+def load(image_path, dtype=np.float64):
+    # dtype=np.float32 halves the memory (scaled straight into float32, no float64 copy), and
+    # dtype=np.uint8 keeps the file's own 0-255 pixels at an eighth of it
+    from skimage import io
     out = io.imread(image_path)
-    out = out.astype(np.float64) / 255
-    return out
+    if np.dtype(dtype) == np.uint8:
+        return out
+    # A true division, so float64 pixels are bit-for-bit what astype(np.float64) / 255 gives
+    return np.divide(out, 255, dtype=dtype)
 
 def display(img, title=None):
+    import matplotlib.pyplot as plt
     # Show image
     plt.figure(figsize = (5,5))
     plt.imshow(img, cmap="Greys_r")
     plt.title(title)
     plt.axis('off')
     plt.show()
+    plt.close()
 
 ### Bonus utility for saving images
 def save(img, name, title=None):
-    # Show image
-    plt.figure(figsize = (5,5))
-    plt.imshow(img)
-    plt.title(title)
-    plt.axis('off')
-    plt.savefig(f"./{name}.jpg")
-    
-# Use default image.
-image_path = './dog.jpg'
-image = load(image_path)
+    # Writes the pixels themselves (no figure, axes or resampling); title is only used by display()
+    from imagewriter import write_image
+    write_image(f"./{name}.jpg", img)
 
 # Convolution implementation provided by the assignment
 def naive_convolution_filter(image, kernel):
@@ -111,9 +115,10 @@ filter3 = np.array(
     [-.11,-.11,-.11],
 ])
 
-save(naive_convolution_filter(image, filter1), "filter1")
-save(naive_convolution_filter(image, filter2), "filter2")
-save(naive_convolution_filter(image, filter3), "filter3")
+def exercise_1(image):
+    save(naive_convolution_filter(image, filter1), "filter1")
+    save(naive_convolution_filter(image, filter2), "filter2")
+    save(naive_convolution_filter(image, filter3), "filter3")
 
 ##################################
 #         Exercise 2.            #
@@ -129,7 +134,7 @@ def naive_convolution_filter_rgb(image, kernels):
     """
     out = np.zeros(image.shape)
 
-    assert(len(kernels) < 3 and len(kernels) > 0)
+    assert(len(kernels) <= 3 and len(kernels) > 0)
     for image_row in range(image.shape[0]):
         for image_column in range(image.shape[1]):
             output_value = np.zeros(3)
@@ -159,7 +164,12 @@ def naive_convolution_filter_rgb(image, kernels):
             
     return out
 
-save(naive_convolution_filter_rgb(image, {"R": filter2, "B": filter1}), "imagerb")
+def exercise_2(image):
+    save(naive_convolution_filter_rgb(image, {"R": filter2, "B": filter1}), "imagerb")
+
+    # Same thing in one compiled pass (and no longer limited to two channels)
+    from convolution import multichannel_convolution_filter
+    save(multichannel_convolution_filter(image, {"R": filter2, "G": filter3, "B": filter1}), "imagergb")
 
 ##################################
 #         Exercise 3.            #
@@ -171,67 +181,29 @@ blur_nicely = np.array([
     [0.1, 0.1, 0.1]
 ])
 
-save(naive_convolution_filter(image, blur_nicely), "blur_nicely")
-
 fil = np.array([
     [0.5, 0.5, 0.5],
     [0.5, -3, 0.5],
     [0.5, 0.5, 0.5]
 ])
 
-save(naive_convolution_filter(image, fil), "emboss")
-
 fil2 =  np.array([
     [1, 0, -1],
     [1, 0, -1],
     [1, 0, -1],
 ])
 
-save(naive_convolution_filter(image, fil2), "edges")
+def exercise_3(image):
+    save(naive_convolution_filter(image, blur_nicely), "blur_nicely")
+    save(naive_convolution_filter(image, fil), "emboss")
+    save(naive_convolution_filter(image, fil2), "edges")
 
 ##################################
 #     Advanced Exercise 2.       #
 ##################################
 
-# Start using larger image.
-image = load("./image.png")
-
-import numba
-
-
-@numba.jit(nopython=True, nogil=True)
-def numba_convolution_filter(image, kernel):
-    """
-    Args:
-        image: numpy array of shape (Hi, Wi).
-        kernel: numpy array of shape (Hk, Wk).
-    Returns:
-        out: numpy array of shape (Hi, Wi).
-    """
-    out = np.zeros(image.shape)
-    
-    for image_row in range(image.shape[0]):
-        for image_column in range(image.shape[1]):
-            output_value = 0.0
-            for kernel_row in range(kernel.shape[0]):
-                for kernel_column in range(kernel.shape[1]):
-                    image_row_offset = math.ceil(kernel_row - kernel.shape[0] / 2)
-                    image_column_offset = math.ceil(kernel_column - kernel.shape[1] / 2)
-                    
-                    if (image_row + image_row_offset < 0 or 
-                        image_row + image_row_offset >= image.shape[0] or
-                        image_column + image_column_offset < 0 or 
-                        image_column + image_column_offset >= image.shape[1]):
-                        image_value = 0.0
-                    else:
-                        image_value = image[image_row + image_row_offset, image_column + image_column_offset]
-
-                    output_value += image_value * kernel[kernel_row, kernel_column]
-
-            out[image_row, image_column] = output_value
-            
-    return out
-
+# numba_convolution_filter and numba_matrix_convolution_filter live in compiled.py (so that importing
+# this file doesn't import numba) and are looked up from there on first use; see __getattr__ below.
 
 def matrix_convolution_filter(image, kernel):
     """
@@ -256,59 +228,30 @@ def matrix_convolution_filter(image, kernel):
             
     return out
 
-@numba.jit(nopython=True, nogil=True)
-def numba_matrix_convolution_filter(image, kernel):
-    """
-    Args:
-        image: numpy array of shape (Hi, Wi).
-        kernel: numpy array of shape (Hk, Wk).
-    Returns:
-        out: numpy array of shape (Hi, Wi).
-    """
-    out = np.zeros(image.shape)
-    rows, cols = image.shape[:2]
-    # np.pad() not implemented in Numba, so we make do manually
-    img = np.zeros((image.shape[0]+1, image.shape[1]+1))
-    img[math.floor(kernel.shape[0]/2):image.shape[0]+math.floor(kernel.shape[0]/2),
-        math.floor(kernel.shape[1]/2):image.shape[1]+math.floor(kernel.shape[1]/2)] = image
-    
-    for image_row in range(rows):
-        for image_column in range(cols):
-            region = np.zeros((kernel.shape[0], kernel.shape[1]))
-            for kernel_row in range(kernel.shape[0]):
-                for kernel_column in range(kernel.shape[1]):
-                    region[kernel_row, kernel_column] = img[image_row+kernel_row, image_column+kernel_column]
-            new = kernel * region
-            out[image_row, image_column] = np.sum(new)            
-            
-    return out
-
 # quick and dirty utility from https://stackoverflow.com/a/12201744
-def rgb2gray(rgb):
-    return np.dot(rgb[...,:3], [0.2989, 0.5870, 0.1140])
-
-image = rgb2gray(image)
-
-import time
-b = time.time()
-naive_convolution_filter(image, fil)
-a = time.time()
-print(f"naive: {a-b}")
-
-b = time.time()
-numba_convolution_filter(image, fil)
-a = time.time()
-print(f"numba naive: {a-b}")
-
-b = time.time()
-matrix_convolution_filter(image, fil)
-a = time.time()
-print(f"matrix: {a-b}")
-
-b = time.time()
-numba_matrix_convolution_filter(image, fil)
-a = time.time()
-print(f"numba matrix: {a-b}")
+# Asking for a dtype (or passing out) does it in one compiled pass instead: float32 from any image,
+# or uint8 -> uint8 in fixed point (see pixelops.grayscale)
+def rgb2gray(rgb, dtype=None, out=None):
+    if dtype is None and out is None:
+        return np.dot(rgb[...,:3], [0.2989, 0.5870, 0.1140])
+    from pixelops import grayscale
+    return grayscale(rgb, dtype=dtype, out=out)
+
+# Time everything properly: warmup, compile time split out, repeats, and a sweep over sizes instead
+# of a single time.time() per backend. Pass an earlier benchmark_filters.json as the baseline to
+# catch regressions (see benchmark.py).
+def advanced_exercise_2(image):
+    import benchmark
+
+    results = benchmark.run_benchmarks(image_sizes=[(64, 64), (256, 256), image.shape[:2]],
+                                       kernel_sizes=[3, 9], repeats=5)
+    benchmark.print_results(results)
+    benchmark.write_results(results, "./benchmark_filters.json")
+
+    # How well do the tiled numba kernels scale with cores?
+    for backend in ["prange", "threads"]:
+        for workers, (seconds, speedup) in benchmark.convolution.scaling_benchmark(image, fil, backend).items():
+            print(f"{backend} x{workers}: {seconds} ({speedup:.2f}x)")
 
 ##################################
 #     Advanced Exercise 1.       #
@@ -317,41 +260,67 @@ print(f"numba matrix: {a-b}")
 shift = np.zeros((81, 81))
 shift[0, 0] = 1
 
-@numba.jit(nopython=True)
-def replicate(image, image_row, image_column, image_row_offset, image_column_offset):
-    row = min(image_row + image_row_offset, image.shape[0])
-    row = max(row, 0)
-    col = min(image_column + image_column_offset, image.shape[1])
-    col = max(col, 0)    
-    return image[row, col]
-    
-@numba.jit(nopython=True)
-def boundary_convolution_filter(image, kernel, strategy=replicate):
+# Calling a strategy like replicate() (now in compiled.py) once per kernel tap keeps numba from doing
+# anything clever with the inner loop, so instead we pad the image once according to the strategy
+# and run a plain branch-free loop over the padded buffer.
+def boundary_convolution_filter(image, kernel, strategy="replicate", dtype=None, out=None):
     """
     Args:
-        image: numpy array of shape (Hi, Wi).
+        image: numpy array of shape (Hi, Wi) or (Hi, Wi, C) for any number of channels C.
         kernel: numpy array of shape (Hk, Wk).
-        strategy: Numba-accelerated (w/ nopython pipeline) function taking
-            image, image_row, image_col, image_row_offset, image_col_offset and returning
-            and returning a pixel value. Defaults to replicate().
+        strategy: "zero", "replicate", "reflect", "wrap", a constant fill value, or a function
+            padding the image (see convolution.py). Defaults to "replicate".
+        dtype: dtype of the result, e.g. np.float32 or np.uint8 (see convolution.py). Defaults to
+            float64.
+        out: array of shape (Hi, Wi) (or (Hi, Wi, C)) to write into.
     Returns:
-        out: numpy array of shape (Hi, Wi).
+        out: numpy array of shape (Hi, Wi) (or (Hi, Wi, C)).
     """
-    out = np.zeros(image.shape)
-    
-    for image_row in range(image.shape[0]):
-        for image_column in range(image.shape[1]):
-            output_value = np.zeros(3)
-            for kernel_row in range(kernel.shape[0]):
-                for kernel_column in range(kernel.shape[1]):
-                    image_row_offset = math.ceil(kernel_row - kernel.shape[0] / 2)
-                    image_column_offset = math.ceil(kernel_column - kernel.shape[1] / 2)
-
-                    image_value = strategy(image, image_row, image_column, image_row_offset, image_column_offset)
-                    output_value += image_value * kernel[kernel_row, kernel_column]
-
-            out[image_row, image_column] = output_value
-            
-    return out
-
-save(boundary_convolution_filter(load('./dog.jpg'), shift, replicate), "dog_replicate")
+    import compiled
+    from convolution import output_buffer, pad_image, store, work_dtype
+
+    out = output_buffer(image.shape, dtype, out)
+    work = work_dtype(out.dtype)
+    padded = pad_image(image.astype(work, copy=False), kernel.shape, strategy)
+    padded = padded.reshape(padded.shape[:2] + (-1,))
+    result = np.zeros(image.shape[:2] + padded.shape[2:], dtype=work)
+    compiled.correlate(padded, kernel.astype(np.float64), result)
+    return store(result.reshape(image.shape), out)
+
+def advanced_exercise_1(image):
+    save(boundary_convolution_filter(image, shift, "replicate"), "dog_replicate")
+    save(boundary_convolution_filter(image, shift, "reflect"), "dog_reflect")
+    save(boundary_convolution_filter(image, shift, "wrap"), "dog_wrap")
+
+    # shift is 81x81 but has a single nonzero tap, and the direct loop skips zero taps, so convolve
+    # picks it over the FFT (which only wins for big dense kernels)
+    from convolution import convolve
+    save(convolve(image, shift, "replicate"), "dog_replicate_auto")
+
+    # Constant kernels like blur_nicely go through the summed-area table, which costs the same at any
+    # size; a few box blurs in a row are close to a Gaussian
+    from convolution import box_gaussian
+    save(convolve(image, blur_nicely, "replicate"), "dog_blur_nicely_box")
+    save(box_gaussian(image, 5, "replicate"), "dog_box_gaussian")
+
+
+# Names that are really defined in compiled.py, imported the first time someone asks for them
+COMPILED_FILTERS = ("numba_convolution_filter", "numba_matrix_convolution_filter", "replicate")
+
+def __getattr__(name):
+    if name in COMPILED_FILTERS:
+        import compiled
+        return getattr(compiled, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == "__main__":
+    # Use default image.
+    image = load('./dog.jpg')
+    exercise_1(image)
+    exercise_2(image)
+    exercise_3(image)
+
+    # Start using larger image.
+    advanced_exercise_2(rgb2gray(load("./image.png")))
+    advanced_exercise_1(image)
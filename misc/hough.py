@@ -0,0 +1,231 @@
+# """
+# Our own Hough transform, so lane finding doesn't have to treat skimage's probabilistic_hough_line
+# as a black box.
+#
+# Two ways in, both voting into a compact int32 (rho, theta) accumulator with compiled kernels (see
+# compiled.py):
+#   - probabilistic_hough_line: the same progressive probabilistic algorithm (and arguments) as
+#     skimage's, but it returns a LineSet and can be told to only consider some angles
+#   - HoughAccumulator: a standard Hough accumulator that stays alive between frames. update() only
+#     votes for the edge pixels that changed since the last frame, and segments() reads lines off
+#     the peaks.
+# For lanes, lane_thetas() gives the angles worth voting for: skipping near-horizontal lines makes
+# every vote cheaper and keeps those lines out of the results in the first place.
+#
+# Usage:
+#   python hough.py road.jpg              # compare against skimage on the writeup's road image
+# """
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from lineset import LineSet
+from profiling import profiled
+
+
+def default_thetas(steps=180):
+    """The angles skimage uses: `steps` evenly spaced angles in [-pi/2, pi/2)."""
+    return np.linspace(-np.pi / 2, np.pi / 2, steps, endpoint=False)
+
+
+def lane_thetas(max_slope=4, min_slope=0, steps=180):
+    """
+    Angles of lines that can be lanes, in the convention used here (and by skimage): theta is the
+    angle of the line's normal, so a vertical line has theta 0 and its slope dx/dy is -tan(theta).
+
+    Args:
+        max_slope: drop lines flatter than this |dx/dy|, same as LineSet.lane_filter.
+        min_slope: drop lines steeper than this |dx/dy| (a lane seen from the car is never exactly
+            vertical unless it's straight under the camera).
+        steps: angle resolution, as the number of angles over the full half turn.
+    Returns:
+        the subset of `default_thetas(steps)` with min_slope <= |dx/dy| <= max_slope.
+    """
+    thetas = default_thetas(steps)
+    slopes = np.abs(np.tan(thetas))
+    return thetas[(slopes >= min_slope) & (slopes <= max_slope)]
+
+
+def _tables(theta):
+    # cos and sin in the kernels' 16.16 fixed point
+    from compiled import HOUGH_ONE
+
+    theta = default_thetas() if theta is None else np.asarray(theta, dtype=np.float64)
+    return theta, np.rint(np.cos(theta) * HOUGH_ONE).astype(np.int64), np.rint(np.sin(theta) * HOUGH_ONE).astype(np.int64)
+
+
+def _accumulator(shape, n_theta):
+    # Every rho a pixel of this image can have, centered on 0
+    offset = int(np.ceil(np.hypot(*shape[:2])))
+    return np.zeros((2 * offset + 1, n_theta), dtype=np.int32)
+
+
+@profiled
+def probabilistic_hough_line(image, threshold=10, line_length=50, line_gap=10, theta=None, rng=None):
+    """
+    Drop-in for skimage.transform.probabilistic_hough_line.
+
+    Args:
+        image: (H, W) edge map; nonzero pixels are edges.
+        threshold: votes a line needs before we go looking for a segment on it.
+        line_length: shortest segment to keep (along its longer axis, in pixels).
+        line_gap: most missing pixels allowed inside a segment.
+        theta: angles to vote for, e.g. `lane_thetas()`. Defaults to `default_thetas()`.
+        rng: seed or numpy Generator for the order points are visited in.
+    Returns:
+        LineSet of the segments found.
+    """
+    import compiled
+
+    _, cos_table, sin_table = _tables(theta)
+    mask = np.array(image, dtype=np.bool_)
+    # 2D np.nonzero costs more than the whole Hough transform; flat indices are ~10x cheaper
+    points = np.flatnonzero(mask)
+    np.random.default_rng(rng).shuffle(points)
+    ys, xs = np.divmod(points, mask.shape[1])
+    segments = np.empty((len(points), 2, 2), dtype=np.int32)
+    count = compiled.probabilistic_hough(mask, xs, ys, cos_table, sin_table,
+                                         _accumulator(mask.shape, len(cos_table)), threshold, line_length,
+                                         line_gap, segments)
+    return LineSet(segments[:count])
+
+
+class HoughAccumulator:
+    """
+    A standard Hough accumulator for a stream of same-sized edge maps. Each update() adds the votes
+    of edge pixels that appeared since the previous one and removes the votes of those that went
+    away, so consecutive frames that share most of their edges share most of the work.
+
+    Args:
+        shape: (H, W) of the edge maps.
+        theta: angles to vote for, e.g. `lane_thetas()`. Defaults to `default_thetas()`.
+    """
+
+    def __init__(self, shape, theta=None):
+        self.shape = tuple(shape[:2])
+        self.theta, self.cos_table, self.sin_table = _tables(theta)
+        self.votes = _accumulator(self.shape, len(self.theta))
+        self.offset = (self.votes.shape[0] - 1) // 2
+        # The edge map the votes currently describe
+        self.edges = np.zeros(self.shape, dtype=np.bool_)
+
+    def reset(self):
+        self.votes[:] = 0
+        self.edges[:] = False
+
+    @profiled
+    def update(self, edges):
+        """
+        Args:
+            edges: (H, W) boolean edge map.
+        Returns:
+            changed: number of pixels whose votes were added or removed.
+        """
+        import compiled
+
+        if edges.shape != self.shape:
+            raise ValueError(f"edge map has shape {edges.shape}, expected {self.shape}")
+        return compiled.hough_update(np.ascontiguousarray(edges, dtype=np.bool_), self.edges, self.cos_table,
+                                     self.sin_table, self.votes)
+
+    def peaks(self, threshold, rho_distance=10, theta_distance=5, max_peaks=32):
+        """
+        Args:
+            threshold: fewest votes a peak can have.
+            rho_distance, theta_distance: peaks closer than this (in accumulator cells) to a
+                stronger peak are dropped.
+            max_peaks: most peaks to return.
+        Returns:
+            (rhos, thetas, votes) of the peaks, strongest first.
+        """
+        import compiled
+
+        out = np.empty((max_peaks, 2), dtype=np.int64)
+        count = compiled.hough_peaks(self.votes, threshold, rho_distance, theta_distance, out)
+        rows, columns = out[:count, 0], out[:count, 1]
+        return (rows - self.offset).astype(np.float64), self.theta[columns], self.votes[rows, columns]
+
+    @profiled
+    def segments(self, threshold=10, line_length=50, line_gap=10, **peak_options):
+        """
+        Find the strongest lines and cut them into segments where the current edge map has pixels.
+
+        Args:
+            threshold: fewest votes a line needs.
+            line_length: shortest segment to keep (along its longer axis, in pixels).
+            line_gap: most missing pixels allowed inside a segment.
+            peak_options: passed to `peaks`.
+        Returns:
+            LineSet of the segments found.
+        """
+        import compiled
+
+        rhos, thetas, _ = self.peaks(threshold, **peak_options)
+        # A line can break into at most this many segments
+        per_line = max(self.shape) // (line_length + line_gap + 1) + 1
+        segments = np.empty((len(rhos) * per_line, 2, 2), dtype=np.int32)
+        count = compiled.trace_segments(self.edges, rhos, np.cos(thetas), np.sin(thetas), line_length, line_gap,
+                                        segments)
+        return LineSet(segments[:count])
+
+
+def compare_with_skimage(path="./road.jpg", repeats=20):
+    """
+    Run the writeup's lane finder (edges.hough_transform's final stage) on an image with skimage's
+    Hough and with ours, and print the median time and the lanes each one ends up with.
+
+    Returns:
+        dict mapping method name to (median ms, lanes) where lanes is LineSet.fit_sides' output.
+    """
+    import cv2
+    from skimage import feature
+    from skimage.transform import probabilistic_hough_line as skimage_hough_line
+
+    from edges import mask_bright
+
+    image = mask_bright(cv2.imread(path, flags=cv2.IMREAD_GRAYSCALE))
+    edges = feature.canny(image, sigma=1, low_threshold=100, high_threshold=120)
+    width = image.shape[1]
+    options = dict(threshold=50, line_length=25, line_gap=30)
+
+    def accumulate():
+        accumulator = HoughAccumulator(edges.shape, theta=lane_thetas())
+        accumulator.update(edges)
+        return accumulator.segments(**options)
+
+    accumulator = HoughAccumulator(edges.shape, theta=lane_thetas())
+    accumulator.update(edges)
+
+    methods = {
+        "skimage": lambda: skimage_hough_line(edges, rng=0, **options),
+        "native": lambda: probabilistic_hough_line(edges, rng=0, **options),
+        "native, lane angles": lambda: probabilistic_hough_line(edges, theta=lane_thetas(), rng=0, **options),
+        "accumulator": accumulate,
+        # Same frame again: nothing changed, so no votes at all
+        "accumulator, update": lambda: (accumulator.update(edges), accumulator.segments(**options))[1],
+    }
+    results = {}
+    print(f"{'method':<22} {'ms':>8} {'lines':>6}  lanes (x = slope * y + intercept)")
+    for name, method in methods.items():
+        method()
+        times = []
+        for _ in range(repeats):
+            start = perf_counter()
+            lines = method()
+            times.append(perf_counter() - start)
+        lanes = LineSet(lines).lane_filter(width)
+        fits = lanes.fit_sides(width)
+        results[name] = (np.median(times) * 1000, fits)
+        described = ", ".join(f"{side} {slope:+.2f}y{intercept:+.0f}" for side, (slope, intercept, _, _) in fits.items())
+        print(f"{name:<22} {results[name][0]:>8.2f} {len(lanes):>6}  {described}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare our Hough transform with skimage's on one image.")
+    parser.add_argument("image", nargs="?", default="./road.jpg")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    compare_with_skimage(args.image, args.repeats)
@@ -0,0 +1,123 @@
+# """
+# Writing result arrays straight to image files, without going through a matplotlib figure.
+#
+# The old save() helpers rendered every result into a 5x5 inch figure and saved that, which resized
+# the image, added axes padding, leaked a figure per call and spent most of its time plotting. This
+# writes the pixel array itself at its native resolution. Line overlays are rasterized directly
+# into the array too.
+# """
+
+import numpy as np
+
+from profiling import profiled
+
+# matplotlib's default color cycle ("tab10"), so line overlays look like they used to
+LINE_COLORS = np.array([
+    [31, 119, 180], [255, 127, 14], [44, 160, 44], [214, 39, 40], [148, 103, 189],
+    [140, 86, 75], [227, 119, 194], [127, 127, 127], [188, 189, 34], [23, 190, 207],
+], dtype=np.uint8)
+
+
+def to_uint8(img, normalize=None):
+    """
+    Args:
+        img: numpy array of shape (H, W), (H, W, 1), (H, W, 3) or (H, W, 4).
+        normalize: how to map values to 0-255.
+            "clip"   - floats are taken to be in [0, 1] and clipped, integers clipped to [0, 255]
+            "minmax" - stretch the image's own min..max to 0..255
+            None     - what plt.imshow would do: "minmax" for single channel floats, "clip" otherwise
+    Returns:
+        out: uint8 array of the same shape. Booleans come out as 0/255.
+    """
+    if img.dtype == np.bool_:
+        return img.astype(np.uint8) * 255
+    if normalize is None:
+        single_channel = img.ndim == 2 or img.shape[2] == 1
+        normalize = "minmax" if single_channel and img.dtype.kind == "f" else "clip"
+
+    if normalize == "minmax":
+        low, high = np.min(img), np.max(img)
+        scaled = img.astype(np.float32)
+        scaled -= low
+        scaled *= 255 / (high - low) if high > low else 0
+        return np.rint(scaled, out=scaled).astype(np.uint8)
+    if normalize == "clip":
+        if img.dtype == np.uint8:
+            return img
+        if img.dtype.kind == "f":
+            scaled = np.clip(img, 0, 1).astype(np.float32)
+            scaled *= 255
+            return np.rint(scaled, out=scaled).astype(np.uint8)
+        return np.clip(img, 0, 255).astype(np.uint8)
+    raise ValueError(f"unknown normalization {normalize!r}")
+
+
+@profiled
+def write_image(path, img, normalize=None, bgr=False):
+    """
+    Args:
+        path: file to write; the format comes from the extension.
+        img: numpy array of shape (H, W) or (H, W, C).
+        normalize: see `to_uint8`.
+        bgr: whether a 3/4 channel img is in OpenCV's BGR(A) order rather than RGB(A).
+    """
+    from skimage import io
+
+    out = to_uint8(img, normalize)
+    if out.ndim == 3 and out.shape[2] == 1:
+        out = out[:, :, 0]
+    elif bgr and out.ndim == 3:
+        out = out[:, :, [2, 1, 0, 3][:out.shape[2]]]
+    io.imsave(path, out, check_contrast=False)
+
+
+def draw_lines(canvas, lines, color=None):
+    """
+    Rasterize line segments into an image, in place. Each segment is sampled once per pixel along
+    its longer axis, all segments at once.
+
+    Args:
+        canvas: numpy array of shape (H, W) or (H, W, C) to draw on.
+        lines: sequence of ((x0, y0), (x1, y1)) segments (what probabilistic_hough_line returns), or
+            an array of shape (N, 2, 2).
+        color: value (or per-channel color) to draw with. Defaults to cycling through LINE_COLORS for
+            color canvases and 255 for single channel ones.
+    Returns:
+        canvas
+    """
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2, 2)
+    if len(lines) == 0:
+        return canvas
+    start, end = lines[:, 0], lines[:, 1]
+    steps = np.ceil(np.abs(end - start).max(axis=1)).astype(np.int64) + 1
+
+    # One entry per pixel drawn: which segment it belongs to and how far along it is
+    segment = np.repeat(np.arange(len(lines)), steps)
+    offsets = np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)
+    t = offsets / np.maximum(steps - 1, 1)[segment]
+    points = np.rint(start[segment] + (end - start)[segment] * t[:, np.newaxis]).astype(np.int64)
+
+    x, y = points[:, 0], points[:, 1]
+    inside = (x >= 0) & (x < canvas.shape[1]) & (y >= 0) & (y < canvas.shape[0])
+    x, y, segment = x[inside], y[inside], segment[inside]
+    if color is None:
+        if canvas.ndim == 3 and canvas.shape[2] >= 3:
+            canvas[y, x, :3] = LINE_COLORS[segment % len(LINE_COLORS)]
+            return canvas
+        color = 255
+    canvas[y, x] = color
+    return canvas
+
+
+@profiled
+def write_lines(path, shape, lines):
+    """
+    Write line segments drawn on a black background, the way save_lines() used to show them.
+
+    Args:
+        path: file to write.
+        shape: (H, W) size of the image the lines were found in.
+        lines: see `draw_lines`.
+    """
+    canvas = np.zeros(tuple(shape[:2]) + (3,), dtype=np.uint8)
+    write_image(path, draw_lines(canvas, lines))
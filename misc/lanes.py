@@ -0,0 +1,401 @@
+# """
+# Streaming version of the lane finder from edges.py, for video from a front-mounted camera.
+#
+# Each frame goes through the same stages as the still-image version (grayscale -> binarize ->
+# Canny -> probabilistic Hough -> slope filter), but the pipeline keeps state between frames:
+#   - the grayscale buffer is allocated once and reused for every frame
+#   - the lanes found in one frame are carried over to the next, and once we have them Canny only
+#     runs on the tiles of a narrow band around where the lanes were, and Hough only sees the edge
+#     pixels inside it (lanes don't jump far in 1/30s)
+#   - if a lane goes missing for a few frames we fall back to searching the whole frame again
+# and an optional region of interest (RegionOfInterest) cuts the frame down to the part of the road
+# in front of the car before any of the expensive stages run.
+#
+# Usage:
+#   python lanes.py road.mp4              # or a directory / glob of frames, e.g. "frames/*.png"
+# """
+
+import argparse
+import glob
+import os
+from time import perf_counter
+
+import numpy as np
+
+from canny import canny, default_ksize, halo
+from edges import filter_lane_lines
+from hough import HoughAccumulator, lane_thetas, probabilistic_hough_line
+from lineset import LineSet
+from pixelops import threshold
+from profiling import stage
+from pyramid import refine_edges
+
+# Extensions treated as still frames when the source is a directory
+FRAME_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+# Tile side for the banded Canny pass once both lanes are known
+BAND_TILE = 16
+
+STAGES = ("read", "grayscale", "binarize", "canny", "roi mask", "band", "hough", "filter", "lanes")
+
+
+class RegionOfInterest:
+    """
+    The part of the frame lanes can actually be in. Frames are cropped to the bounding box of the
+    region before blurring/Canny/Hough (so their cost drops with the area thrown away), edges
+    outside the region are masked off, and detected lines are mapped back to full-frame
+    coordinates.
+
+    Args:
+        polygon: convex polygon as (x, y) vertices in fractions of the frame's width and height.
+            Defaults to a trapezoid over the road ahead: the full width at the bottom, narrowing to
+            the middle 10% at 60% of the way down.
+        lower: alternatively, just keep the bottom `lower` fraction of the frame (e.g. 0.4).
+    """
+
+    TRAPEZOID = ((0.0, 1.0), (0.45, 0.6), (0.55, 0.6), (1.0, 1.0))
+
+    def __init__(self, polygon=None, lower=None):
+        if lower is not None:
+            polygon = ((0.0, 1.0), (0.0, 1.0 - lower), (1.0, 1.0 - lower), (1.0, 1.0))
+        self.polygon = np.asarray(polygon if polygon is not None else self.TRAPEZOID, dtype=np.float64)
+        self._shape = None
+
+    def _prepare(self, shape):
+        if self._shape == shape[:2]:
+            return
+        height, width = shape[:2]
+        vertices = self.polygon * (width, height)
+        top = int(np.floor(vertices[:, 1].min()))
+        left = int(np.floor(vertices[:, 0].min()))
+        self.top, self.left = max(top, 0), max(left, 0)
+        self.bottom = min(int(np.ceil(vertices[:, 1].max())), height)
+        self.right = min(int(np.ceil(vertices[:, 0].max())), width)
+
+        # Inside a convex polygon = on the same side of every edge. Test pixel centers.
+        ys, xs = np.mgrid[self.top:self.bottom, self.left:self.right] + 0.5
+        start, end = vertices, np.roll(vertices, -1, axis=0)
+        crosses = np.array([(b[0] - a[0]) * (ys - a[1]) - (b[1] - a[1]) * (xs - a[0]) for a, b in zip(start, end)])
+        self.inside = np.all(crosses >= 0, axis=0) | np.all(crosses <= 0, axis=0)
+        # A rectangle covers its whole bounding box, so there's nothing to mask
+        self.is_box = bool(self.inside.all())
+        self._shape = shape[:2]
+
+    def crop(self, frame):
+        """
+        Returns:
+            view of frame cut down to the region's bounding box (no copy).
+        """
+        self._prepare(frame.shape)
+        return frame[self.top:self.bottom, self.left:self.right]
+
+    def mask_edges(self, edges):
+        """
+        Clear edge pixels of a cropped edge map that fall outside the polygon, in place. This runs
+        after Canny rather than masking the image before it, which would add edges along the
+        polygon's border.
+        """
+        if not self.is_box:
+            edges &= self.inside
+        return edges
+
+    @property
+    def offset(self):
+        """(x, y) of the cropped region's top left corner in the full frame."""
+        return self.left, self.top
+
+    def to_full_frame(self, lines):
+        """
+        Args:
+            lines: ((x0, y0), (x1, y1)) segments in cropped coordinates, or a LineSet.
+        Returns:
+            LineSet of the same segments in full-frame coordinates.
+        """
+        return LineSet(lines).translate(*self.offset)
+
+
+def list_frames(source):
+    """
+    Args:
+        source: a directory, a glob pattern or a single file.
+    Returns:
+        sorted list of the images in the directory or matching the pattern, or [source].
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().endswith(FRAME_EXTENSIONS))
+    if glob.has_magic(source):
+        return sorted(glob.glob(source))
+    return [source]
+
+
+def read_frames(source, buffer=None):
+    """
+    Yield frames from a video file, a directory of images, or a glob of images (sorted by name).
+
+    Args:
+        source: path to a video, a directory, or a glob pattern.
+        buffer: for video, an array to decode every frame into. The same array is yielded each
+            time, so copy it if you need a frame to outlive the next one.
+    Yields:
+        frame: BGR (or grayscale) numpy array.
+    """
+    import cv2
+
+    if os.path.isdir(source) or glob.has_magic(source):
+        for path in list_frames(source):
+            with stage("lanes.read_frames"):
+                frame = cv2.imread(path)
+            if frame is None:
+                raise IOError(f"couldn't read {path}")
+            yield frame
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError(f"couldn't open {source}")
+    try:
+        while True:
+            with stage("lanes.read_frames"):
+                ok, frame = capture.read(buffer)
+            if not ok:
+                return
+            buffer = frame
+            yield frame
+    finally:
+        capture.release()
+
+
+class LanePipeline:
+    """
+    Args:
+        cutoff: pixels brighter than this are kept by the binarize stage.
+        sigma, low_threshold, high_threshold: passed to canny.canny.
+        ksize: Gaussian kernel size for canny.canny (defaults to what skimage would use for sigma).
+        hough_threshold, line_length, line_gap: passed to probabilistic_hough_line.
+        band: half-width (in pixels) of the search band around the previous frame's lanes. Once both
+            lanes are known, Canny only runs on the tiles the band touches.
+        smoothing: how much of the previous lane estimate to keep each frame (0 = none).
+        max_misses: frames a lane may go undetected before we search the whole frame again.
+        roi: optional RegionOfInterest; only that part of each frame is processed.
+        hough: which Hough transform to use:
+            "native"      - hough.probabilistic_hough_line, only voting for lane_thetas() angles
+            "incremental" - a hough.HoughAccumulator kept across frames, so each frame only votes
+                            for the edge pixels that changed
+            "skimage"     - skimage's probabilistic_hough_line
+    """
+
+    def __init__(self, cutoff=200, sigma=1, low_threshold=100, high_threshold=120, hough_threshold=50,
+                 line_length=25, line_gap=30, band=40, smoothing=0.5, max_misses=5, roi=None,
+                 hough="native", ksize=None):
+        self.cutoff = cutoff
+        self.sigma = sigma
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.ksize = ksize
+        self.hough_threshold = hough_threshold
+        self.line_length = line_length
+        self.line_gap = line_gap
+        self.band = band
+        self.smoothing = smoothing
+        self.max_misses = max_misses
+        self.roi = roi
+        if hough not in ("native", "incremental", "skimage"):
+            raise ValueError(f"unknown Hough transform {hough!r}")
+        self.hough = hough
+        self.thetas = lane_thetas()
+        self.accumulator = None
+
+        self.gray = None
+        # Canny's scratch buffers, (re)allocated by _edges when the frame size changes
+        self.padded = self.maxima = self.edges = None
+        # side ("left"/"right") -> (slope, intercept, top), and how many frames since it was seen
+        self.lanes = {}
+        self.misses = {}
+        self.timings = {stage: [] for stage in STAGES}
+
+    def _grayscale(self, frame):
+        import cv2
+
+        if self.gray is None or self.gray.shape != frame.shape[:2]:
+            self.gray = np.empty(frame.shape[:2], dtype=np.uint8)
+        if frame.ndim == 2:
+            np.copyto(self.gray, frame)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        return self.gray
+
+    def _edges(self, gray, offset):
+        if self.edges is None or self.edges.shape != gray.shape:
+            ksize = default_ksize(self.sigma) if self.ksize is None else self.ksize
+            width = halo(ksize)
+            self.padded = np.empty((gray.shape[0] + 2 * width, gray.shape[1] + 2 * width), dtype=np.float32)
+            self.maxima = np.empty(gray.shape, dtype=np.float32)
+            self.edges = np.empty(gray.shape, dtype=np.bool_)
+        if len(self.lanes) < 2:
+            return canny(gray, self.low_threshold, self.high_threshold, sigma=self.sigma, ksize=self.ksize,
+                         out=self.edges, maxima=self.maxima, padded=self.padded)
+        # Both lanes known: only the gradient tiles the band passes through (refine_edges does the
+        # whole frame anyway if that's most of it)
+        return refine_edges(gray, self._band_tiles(gray.shape, offset), self.low_threshold, self.high_threshold,
+                            self.sigma, self.ksize, scale=BAND_TILE, tile=BAND_TILE, out=self.edges,
+                            maxima=self.maxima, padded=self.padded)
+
+    def _band_tiles(self, shape, offset):
+        # Which BAND_TILE x BAND_TILE tiles come within `band` of a lane: the lane's x varies by up to
+        # |slope| * BAND_TILE / 2 across half a tile's height, on top of half a tile's width
+        rows, cols = -(-shape[0] // BAND_TILE), -(-shape[1] // BAND_TILE)
+        ys = (np.arange(rows) * BAND_TILE + BAND_TILE / 2 + offset[1])[:, np.newaxis]
+        xs = np.arange(cols) * BAND_TILE + BAND_TILE / 2 + offset[0]
+        tiles = np.zeros((rows, cols), dtype=np.bool_)
+        for slope, intercept, _ in self.lanes.values():
+            reach = self.band + BAND_TILE / 2 * (1 + abs(slope))
+            tiles |= np.abs(xs - (slope * ys + intercept)) < reach
+        return tiles
+
+    def _restrict_to_band(self, edges, offset):
+        # Only the edge pixels are touched, so this is cheap however big the frame is
+        ys, xs = np.nonzero(edges)
+        keep = np.zeros(len(xs), dtype=np.bool_)
+        # Lanes are kept in full-frame coordinates, edges may be cropped
+        full_xs, full_ys = xs + offset[0], ys + offset[1]
+        for slope, intercept, _ in self.lanes.values():
+            keep |= np.abs(full_xs - (slope * full_ys + intercept)) < self.band
+        edges[ys[~keep], xs[~keep]] = False
+        return edges
+
+    def _update_lanes(self, lines, width):
+        # One least-squares fit per side over all of this frame's segments at once
+        fits = lines.fit_sides(width)
+        for side in ("left", "right"):
+            if side not in fits:
+                self.misses[side] = self.misses.get(side, 0) + 1
+                if self.misses[side] > self.max_misses:
+                    self.lanes.pop(side, None)
+                continue
+            self.misses[side] = 0
+            lane = fits[side][:3]
+            if side in self.lanes:
+                lane = tuple(self.smoothing * old + (1 - self.smoothing) * new
+                             for old, new in zip(self.lanes[side], lane))
+            self.lanes[side] = lane
+
+    def _hough_lines(self, edges):
+        options = dict(threshold=self.hough_threshold, line_length=self.line_length, line_gap=self.line_gap)
+        if self.hough == "skimage":
+            from skimage.transform import probabilistic_hough_line as skimage_hough_line
+            return skimage_hough_line(edges, rng=0, **options)
+        if self.hough == "native":
+            return probabilistic_hough_line(edges, theta=self.thetas, rng=0, **options)
+        if self.accumulator is None or self.accumulator.shape != edges.shape:
+            self.accumulator = HoughAccumulator(edges.shape, theta=self.thetas)
+        self.accumulator.update(edges)
+        return self.accumulator.segments(**options)
+
+    def process(self, frame):
+        """
+        Args:
+            frame: BGR or grayscale numpy array.
+        Returns:
+            (lanes, lines): current lane estimates ({side: (slope, intercept, top)}, with x = slope
+            * y + intercept) and the filtered Hough segments from this frame, as a LineSet.
+        """
+        width = frame.shape[1]
+        offset = (0, 0)
+        times = [perf_counter()]
+        if self.roi is not None:
+            frame = self.roi.crop(frame)
+            offset = self.roi.offset
+        gray = self._grayscale(frame)
+        times.append(perf_counter())
+        threshold(gray, self.cutoff, out=gray)
+        times.append(perf_counter())
+        edges = self._edges(gray, offset)
+        times.append(perf_counter())
+        if self.roi is not None:
+            self.roi.mask_edges(edges)
+        times.append(perf_counter())
+        # Only narrow the search once we have both lanes to narrow it around
+        if len(self.lanes) == 2:
+            self._restrict_to_band(edges, offset)
+        times.append(perf_counter())
+        lines = self._hough_lines(edges)
+        if self.roi is not None:
+            lines = self.roi.to_full_frame(lines)
+        times.append(perf_counter())
+        lines = filter_lane_lines(lines, width)
+        times.append(perf_counter())
+        self._update_lanes(lines, width)
+        times.append(perf_counter())
+
+        for stage, start, end in zip(STAGES[1:], times, times[1:]):
+            self.timings[stage].append(end - start)
+        return self.lanes, lines
+
+    def stream(self, frames):
+        """
+        Args:
+            frames: iterable of frames, e.g. `read_frames(path)`.
+        Yields:
+            (lanes, lines) for each frame, as returned by `process`.
+        """
+        frames = iter(frames)
+        while True:
+            start = perf_counter()
+            frame = next(frames, None)
+            if frame is None:
+                return
+            self.timings["read"].append(perf_counter() - start)
+            yield self.process(frame)
+
+    def report(self):
+        """
+        Returns:
+            dict mapping stage name to (mean ms, median ms, p95 ms), plus "total" and "fps".
+        """
+        summary = {}
+        for stage, times in self.timings.items():
+            if times:
+                ms = np.array(times) * 1000
+                summary[stage] = (ms.mean(), np.median(ms), np.percentile(ms, 95))
+        per_frame = sum(mean for mean, _, _ in summary.values())
+        summary["total"] = (per_frame, None, None)
+        summary["fps"] = 1000 / per_frame if per_frame else float("inf")
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the lane finder over a video or image sequence.")
+    parser.add_argument("source", help="video file, directory of frames, or glob of frames")
+    parser.add_argument("--frames", type=int, help="stop after this many frames")
+    parser.add_argument("--band", type=int, default=40, help="search band half-width in pixels")
+    parser.add_argument("--hough", choices=("native", "incremental", "skimage"), default="native",
+                        help="Hough transform implementation")
+    parser.add_argument("--ksize", type=int, help="Canny's Gaussian kernel size")
+    roi = parser.add_mutually_exclusive_group()
+    roi.add_argument("--trapezoid", action="store_true", help="only look at the default trapezoid ahead")
+    roi.add_argument("--lower", type=float, help="only look at this bottom fraction of the frame")
+    args = parser.parse_args(argv)
+    if args.lower is not None and not 0 < args.lower <= 1:
+        parser.error(f"--lower should be a fraction in (0, 1], got {args.lower}")
+
+    if args.trapezoid or args.lower is not None:
+        roi = RegionOfInterest(lower=args.lower)
+    else:
+        roi = None
+    pipeline = LanePipeline(band=args.band, roi=roi, hough=args.hough, ksize=args.ksize)
+    for count, (lanes, _) in enumerate(pipeline.stream(read_frames(args.source)), start=1):
+        if count == args.frames:
+            break
+
+    summary = pipeline.report()
+    fps = summary.pop("fps")
+    total = summary.pop("total")[0]
+    print(f"{'stage':<10} {'mean ms':>8} {'median':>8} {'p95':>8}")
+    for stage, (mean, median, p95) in summary.items():
+        print(f"{stage:<10} {mean:>8.2f} {median:>8.2f} {p95:>8.2f}")
+    print(f"{'total':<10} {total:>8.2f}    -> {fps:.1f} fps")
+
+
+if __name__ == "__main__":
+    main()
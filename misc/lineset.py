@@ -0,0 +1,157 @@
+# """
+# Batch operations over the line segments that come out of the Hough transform.
+#
+# A LineSet stores N segments as one (N, 2, 2) array: [segment, endpoint, (x, y)]. Slopes, angles,
+# side-of-road tests and lane fitting are computed for every segment at once, so a frame with tens
+# of thousands of segments costs a handful of NumPy calls rather than a Python loop.
+#
+# "Slope" follows edges.py: change in x per unit of y, which stays finite for the near-vertical lines
+# lanes make. Horizontal segments get an infinite slope.
+# """
+
+import numpy as np
+
+LEFT, CENTER, RIGHT = -1, 0, 1
+
+
+class LineSet:
+    """
+    Args:
+        segments: array of shape (N, 2, 2), or anything that reshapes to it (e.g. the list of
+            ((x0, y0), (x1, y1)) tuples probabilistic_hough_line returns).
+    """
+
+    def __init__(self, segments=()):
+        self.segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        # Same shape as probabilistic_hough_line's output, so a LineSet can go anywhere a list did
+        for (x0, y0), (x1, y1) in self.segments.tolist():
+            yield (x0, y0), (x1, y1)
+
+    def __getitem__(self, index):
+        return LineSet(self.segments[index])
+
+    def __array__(self, dtype=None, copy=None):
+        # np.asarray(line_set) gives the (N, 2, 2) array, e.g. in imagewriter.draw_lines
+        return self.segments if dtype is None else self.segments.astype(dtype)
+
+    def __repr__(self):
+        return f"LineSet({len(self)} segments)"
+
+    @property
+    def starts(self):
+        return self.segments[:, 0]
+
+    @property
+    def ends(self):
+        return self.segments[:, 1]
+
+    @property
+    def dx(self):
+        return self.segments[:, 1, 0] - self.segments[:, 0, 0]
+
+    @property
+    def dy(self):
+        return self.segments[:, 1, 1] - self.segments[:, 0, 1]
+
+    @property
+    def lengths(self):
+        return np.hypot(self.dx, self.dy)
+
+    @property
+    def slopes(self):
+        dx, dy = self.dx, self.dy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(dy != 0, dx / np.where(dy != 0, dy, 1), np.inf)
+
+    @property
+    def angles(self):
+        """Angle of each segment from the x axis, in degrees in (-180, 180]."""
+        return np.degrees(np.arctan2(self.dy, self.dx))
+
+    def translate(self, dx, dy):
+        """Returns: a new LineSet shifted by (dx, dy)."""
+        return LineSet(self.segments + (dx, dy))
+
+    def sides(self, width):
+        """
+        Args:
+            width: width of the frame.
+        Returns:
+            LEFT, CENTER or RIGHT for each segment, from where its first endpoint is.
+        """
+        return np.sign(self.segments[:, 0, 0] - width / 2).astype(np.int8)
+
+    def filter_slope(self, max_slope):
+        """Returns: the segments with |slope| <= max_slope (so never horizontal ones)."""
+        return self[np.abs(self.slopes) <= max_slope]
+
+    def lane_filter(self, width, max_slope=4):
+        """
+        What edges.py does to Hough output: drop shallow segments, then keep segments on the left
+        half leaning one way and on the right half leaning the other, which is how lanes look from a
+        front-mounted camera.
+
+        Args:
+            width: width of the frame.
+            max_slope: segments with |slope| above this are too close to horizontal to be lanes.
+        Returns:
+            the LineSet of plausible lane segments.
+        """
+        slopes = self.slopes
+        sides = self.sides(width)
+        keep = (np.abs(slopes) <= max_slope) & (((sides == LEFT) & (slopes < 0)) | ((sides == RIGHT) & (slopes > 0)))
+        return self[keep]
+
+    def fit_sides(self, width):
+        """
+        Fit one line through all the segments on each side of the frame (least squares over the
+        endpoints, weighted by segment length).
+
+        Args:
+            width: width of the frame.
+        Returns:
+            dict mapping "left"/"right" to (slope, intercept, top, bottom), with x = slope * y +
+            intercept and top/bottom the y range the segments covered. Sides with no segments (or
+            only horizontal ones) are left out.
+        """
+        sides = self.sides(width)
+        # Group 0 = left, 1 = right; segments exactly on the center line go with neither
+        groups = np.repeat(np.where(sides == LEFT, 0, np.where(sides == RIGHT, 1, 2)), 2)
+        xs, ys = self.segments[:, :, 0].ravel(), self.segments[:, :, 1].ravel()
+        weights = np.repeat(self.lengths, 2)
+
+        def sums(values):
+            return np.bincount(groups, weights=values, minlength=3)[:2]
+
+        total, sum_x, sum_y = sums(weights), sums(weights * xs), sums(weights * ys)
+        sum_yy, sum_xy = sums(weights * ys * ys), sums(weights * xs * ys)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slopes = (total * sum_xy - sum_y * sum_x) / (total * sum_yy - sum_y ** 2)
+            intercepts = (sum_x - slopes * sum_y) / total
+
+        lanes = {}
+        for group, side in enumerate(("left", "right")):
+            in_group = groups == group
+            if not np.isfinite(slopes[group]) or not in_group.any():
+                continue
+            lanes[side] = (slopes[group], intercepts[group], ys[in_group].min(), ys[in_group].max())
+        return lanes
+
+    def merge(self, width):
+        """
+        Merge each side's segments into a single lane segment.
+
+        Args:
+            width: width of the frame.
+        Returns:
+            LineSet with (at most) a left lane and a right lane, each running over the y range its
+            segments covered.
+        """
+        merged = [((slope * top + intercept, top), (slope * bottom + intercept, bottom))
+                  for slope, intercept, top, bottom in self.fit_sides(width).values()]
+        return LineSet(merged)
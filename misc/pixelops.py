@@ -0,0 +1,139 @@
+# """
+# Per-pixel operations (thresholds, masks, grayscale) that run as a single compiled loop over the
+# image instead of np.vectorize or a Python loop per pixel.
+#
+# Every op takes an optional `out` array. Passing the input itself as `out` works in place, with no
+# temporaries: each pixel is read and written exactly once. uint8, float32 and float64 images are
+# compiled ahead of time (see compiled.py); anything else gets compiled on first use.
+# """
+
+import numpy as np
+
+# Labels written by double_threshold
+NONE, WEAK, STRONG = 0, 1, 2
+
+# filters.rgb2gray's weights, and the fixed point grayscale() uses for uint8 images
+GRAY_WEIGHTS = (0.2989, 0.5870, 0.1140)
+GRAY_SHIFT = 14
+GRAY_ONE = 1 << GRAY_SHIFT
+
+
+def _flat(array, name):
+    flat = array.reshape(-1)
+    if not np.may_share_memory(flat, array):
+        raise ValueError(f"{name} must be contiguous")
+    return flat
+
+
+def _prepare(image, out, dtype):
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    elif out.shape != image.shape:
+        raise ValueError(f"out has shape {out.shape}, expected {image.shape}")
+    return np.ascontiguousarray(image).reshape(-1), out, _flat(out, "out")
+
+
+def threshold(image, cutoff, high=255, low=0, out=None):
+    """
+    Binarize: pixels brighter than cutoff become high, everything else becomes low.
+
+    Args:
+        image: numpy array of any shape.
+        cutoff: pixels > cutoff count as bright.
+        high: value for bright pixels.
+        low: value for the rest.
+        out: array to write into (may be image itself). Defaults to a new array of image's dtype.
+    Returns:
+        out
+    """
+    import compiled
+
+    pixels, out, flat = _prepare(image, out, image.dtype)
+    compiled.threshold_pixels(pixels, float(cutoff), float(high), float(low), flat)
+    return out
+
+
+def threshold_to_zero(image, cutoff, out=None):
+    """
+    Zero out pixels below cutoff and keep the rest as they are.
+
+    Args:
+        image: numpy array of any shape.
+        cutoff: pixels < cutoff are set to 0.
+        out: array to write into (may be image itself). Defaults to a new array of image's dtype.
+    Returns:
+        out
+    """
+    import compiled
+
+    pixels, out, flat = _prepare(image, out, image.dtype)
+    compiled.threshold_to_zero_pixels(pixels, float(cutoff), flat)
+    return out
+
+
+def binary_mask(image, cutoff, out=None):
+    """
+    Args:
+        image: numpy array of any shape.
+        cutoff: pixels > cutoff are in the mask.
+        out: boolean array to write into. Defaults to a new one.
+    Returns:
+        out: boolean array of image's shape.
+    """
+    import compiled
+
+    pixels, out, flat = _prepare(image, out, np.bool_)
+    compiled.mask_pixels(pixels, float(cutoff), flat)
+    return out
+
+
+def grayscale(rgb, weights=GRAY_WEIGHTS, dtype=np.float32, out=None):
+    """
+    Weighted sum of the first len(weights) channels, in one pass with no float64 copy of the image.
+    uint8 -> uint8 is done in 14-bit fixed point (off by at most one level from rounding the
+    float64 result).
+
+    Args:
+        rgb: numpy array of shape (H, W, C) with C >= len(weights).
+        weights: weight of each channel.
+        dtype: uint8 (uint8 images only), float32 or float64. Ignored if out is given.
+        out: (H, W) array to write into. Defaults to a new one.
+    Returns:
+        out: (H, W) array, in the same units as rgb (0-255 for uint8 images).
+    """
+    import compiled
+
+    if out is None:
+        out = np.empty(rgb.shape[:2], dtype=dtype)
+    elif out.shape != rgb.shape[:2]:
+        raise ValueError(f"out has shape {out.shape}, expected {rgb.shape[:2]}")
+    pixels = np.ascontiguousarray(rgb).reshape(-1, rgb.shape[2])
+    flat = _flat(out, "out")
+    weights = np.asarray(weights, dtype=np.float64)
+    if out.dtype == np.uint8:
+        if rgb.dtype != np.uint8:
+            raise ValueError(f"uint8 grayscale needs a uint8 image, got {rgb.dtype}")
+        compiled.weighted_channels_fixed(pixels, np.rint(weights * GRAY_ONE).astype(np.int64), GRAY_SHIFT, flat)
+    else:
+        compiled.weighted_channels(pixels, weights, flat)
+    return out
+
+
+def double_threshold(image, low, high, out=None):
+    """
+    The first half of Canny's hysteresis: label every pixel as STRONG (>= high), WEAK (>= low) or
+    NONE.
+
+    Args:
+        image: numpy array of any shape, e.g. gradient magnitudes.
+        low: lower threshold.
+        high: upper threshold.
+        out: uint8 array to write the labels into. Defaults to a new one.
+    Returns:
+        out: uint8 array of image's shape holding NONE, WEAK or STRONG.
+    """
+    import compiled
+
+    pixels, out, flat = _prepare(image, out, np.uint8)
+    compiled.double_threshold_pixels(pixels, float(low), float(high), flat)
+    return out
@@ -0,0 +1,379 @@
+# """
+# Where does the time go? Per-stage timing for the filter and edge pipelines.
+#
+# Wrap a block in `with stage("name"):` or a function in `@profiled`, and while profiling is enabled
+# every call records its latency, the bytes it was handed, the Python objects it left behind and
+# (with --allocations, single-threaded stages only) the peak memory it allocated, arrays included,
+# into an in-process registry.
+# Stages nest: the summary splits each stage's time into its own ("self") time and the time spent
+# in stages inside it, and the Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev)
+# shows them as a flame chart per thread and process.
+#
+# Profiling is off by default, and then stage() hands back a shared do-nothing context manager and
+# @profiled functions go straight to the function: one flag check per call. Turn it on with
+# `profiling.enable()`, by setting PROFILE=1 in the environment, or by running a script through
+# this file:
+#   python profiling.py edges.py                          # summary table after the script finishes
+#   python profiling.py --trace trace.json lanes.py road.mp4
+#   python profiling.py --allocations filters.py          # also track memory (slower)
+# batch.py takes --profile trace.json and collects the stages of every worker process.
+# """
+
+import functools
+import os
+import random
+import sys
+import threading
+from time import perf_counter_ns
+
+_enabled = False
+_allocations = False
+# Whether enable() started tracemalloc (and so disable() should stop it)
+_started_tracemalloc = False
+_local = threading.local()
+# For allocation tracking: how many threads are inside a stage right now, and how many times a
+# thread has entered one while another already was (see _Stage)
+_memory_lock = threading.Lock()
+_busy_threads = 0
+_overlaps = 0
+
+
+class Registry:
+    """
+    Every recorded stage call since the last clear(), as tuples of
+    (name, start ns, duration ns, self ns, pid, thread id, bytes, peak bytes, blocks). Peak bytes
+    is None for calls that overlapped another thread's stages, whose peak can't be told apart.
+
+    Args:
+        max_events: calls kept for the trace. Past that they only count towards the summary.
+        max_samples: durations kept per stage for the p95 column. Past that they're a uniform
+            random sample of all the calls (reservoir sampling), so memory stays bounded however
+            long a batch runs.
+    """
+
+    def __init__(self, max_events=1_000_000, max_samples=10_000):
+        self.max_events = max_events
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self.clear()
+
+    def clear(self):
+        self.events = []
+        self.dropped = 0
+        # name -> [calls, total ns, self ns, bytes, peak bytes, blocks, max ns, [sampled durations]]
+        self.totals = {}
+
+    def record(self, event):
+        name, _, duration, self_time, _, _, nbytes, peak, blocks = event
+        # Stages finish on several threads at once (sweep.py, the threads backend), and the totals
+        # are read-modify-writes
+        with self._lock:
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+            else:
+                self.dropped += 1
+            totals = self.totals.get(name)
+            if totals is None:
+                totals = self.totals[name] = [0, 0, 0, 0, 0, 0, 0, []]
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] += self_time
+            totals[3] += nbytes
+            if peak is not None:
+                totals[4] = max(totals[4], peak)
+            totals[5] += blocks
+            totals[6] = max(totals[6], duration)
+            samples = totals[7]
+            if len(samples) < self.max_samples:
+                samples.append(duration)
+            else:
+                slot = self._random.randrange(totals[0])
+                if slot < self.max_samples:
+                    samples[slot] = duration
+
+    def extend(self, events):
+        """Add events recorded somewhere else, e.g. the list a worker process got from drain()."""
+        for event in events:
+            self.record(tuple(event))
+
+    def drain(self):
+        """Returns and forgets the events recorded so far (the summary totals too)."""
+        with self._lock:
+            events = self.events
+            self.clear()
+        return events
+
+    def summary(self):
+        """
+        Returns:
+            dict mapping stage name to a dict of "calls", "total_ms", "self_ms", "mean_ms",
+            "p95_ms" (from at most max_samples calls), "max_ms", "mb_per_s" (bytes handed in per
+            second), "peak_mb" (most memory a call allocated at once, NumPy arrays included; 0
+            unless allocations were tracked, and only counting calls that had the process to
+            themselves, see `enable`) and "blocks" (net pymalloc blocks left allocated: small
+            Python objects only, NumPy's data buffers don't come from pymalloc and aren't counted),
+            slowest self time first.
+        """
+        import numpy as np
+
+        with self._lock:
+            totals = [(name, list(values[:7]), list(values[7])) for name, values in self.totals.items()]
+        summary = {}
+        for name, (calls, total, self_time, nbytes, peak, blocks, longest), durations in totals:
+            summary[name] = {
+                "calls": calls,
+                "total_ms": total / 1e6,
+                "self_ms": self_time / 1e6,
+                "mean_ms": total / 1e6 / calls,
+                "p95_ms": float(np.percentile(np.array(durations) / 1e6, 95)),
+                "max_ms": longest / 1e6,
+                "mb_per_s": nbytes / 2 ** 20 / (total / 1e9) if total else 0.0,
+                "peak_mb": peak / 2 ** 20,
+                "blocks": blocks,
+            }
+        return dict(sorted(summary.items(), key=lambda item: -item[1]["self_ms"]))
+
+    def print_summary(self, limit=None, file=None):
+        summary = list(self.summary().items())[:limit]
+        if not summary:
+            print("no stages recorded", file=file)
+            return
+        width = max(len("stage"), *(len(name) for name, _ in summary))
+        print(f"{'stage':<{width}} {'calls':>7} {'total ms':>10} {'self ms':>10} {'mean ms':>9} {'p95 ms':>9} "
+              f"{'MB/s':>9} {'peak MB':>8} {'py blocks':>9}", file=file)
+        for name, row in summary:
+            print(f"{name:<{width}} {row['calls']:>7} {row['total_ms']:>10.2f} {row['self_ms']:>10.2f} "
+                  f"{row['mean_ms']:>9.3f} {row['p95_ms']:>9.3f} {row['mb_per_s']:>9.1f} {row['peak_mb']:>8.1f} "
+                  f"{row['blocks']:>9}", file=file)
+        if self.dropped:
+            print(f"({self.dropped} calls past max_events are in the totals but not the trace)", file=file)
+
+    def write_chrome_trace(self, path):
+        """
+        Write the recorded calls in Chrome's trace event format ("complete" events, timestamps in
+        microseconds).
+        """
+        import json
+
+        events = [{"name": name, "cat": name.split(".")[0], "ph": "X", "ts": start / 1000, "dur": duration / 1000,
+                   "pid": pid, "tid": tid, "args": {"bytes": nbytes, "self_us": self_time / 1000,
+                                                    "peak_bytes": peak, "blocks": blocks}}
+                  for name, start, duration, self_time, pid, tid, nbytes, peak, blocks in self.events]
+        with open(path, "w") as trace:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace)
+
+
+REGISTRY = Registry()
+
+
+def enable(allocations=False):
+    """
+    Start recording stages.
+
+    Args:
+        allocations: also track the peak memory each stage allocates, with tracemalloc (NumPy
+            reports its array buffers to it, so they count). That slows down every allocation in
+            the process, so only turn it on when looking for memory. tracemalloc only has one peak
+            for the whole process, so a call that overlaps a stage on another thread (sweep.py's
+            pool, convolution's "threads" backend) gets no peak; run single-threaded to measure.
+    """
+    global _enabled, _allocations, _started_tracemalloc
+    if allocations:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracemalloc = True
+    _enabled, _allocations = True, allocations
+
+
+def disable():
+    global _enabled, _allocations, _started_tracemalloc
+    if _started_tracemalloc:
+        # Leave tracemalloc alone if someone else had it running before enable()
+        import tracemalloc
+        tracemalloc.stop()
+        _started_tracemalloc = False
+    _enabled = _allocations = False
+
+
+def enabled():
+    return _enabled
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class _Stage:
+    __slots__ = ("name", "nbytes", "start", "children", "blocks", "peak", "memory", "tracked", "overlaps")
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        global _busy_threads, _overlaps
+        stack = _stack()
+        self.children = 0
+        self.peak = 0
+        self.tracked = _allocations
+        if self.tracked:
+            import tracemalloc
+            # tracemalloc's peak is one number for the whole process: it only means something for
+            # a stage if no other thread was inside a stage at any point while it ran
+            with _memory_lock:
+                if not stack:
+                    _busy_threads += 1
+                    if _busy_threads > 1:
+                        _overlaps += 1
+                self.overlaps = None if _busy_threads > 1 else _overlaps
+            if self.overlaps is None:
+                self.peak = None
+            else:
+                current, peak = tracemalloc.get_traced_memory()
+                # The stage we're inside has to keep whatever peak it reached before we reset it
+                outer = stack[-1] if stack else None
+                if outer is not None and outer.tracked and outer.peak is not None:
+                    outer.peak = max(outer.peak, peak - outer.memory)
+                tracemalloc.reset_peak()
+                self.memory = current
+        stack.append(self)
+        # pymalloc's small-object blocks: a cheap leak check for Python objects, blind to arrays
+        self.blocks = sys.getallocatedblocks()
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _busy_threads
+        end = perf_counter_ns()
+        blocks = sys.getallocatedblocks() - self.blocks
+        stack = _stack()
+        stack.pop()
+        duration = end - self.start
+        if self.tracked:
+            import tracemalloc
+            with _memory_lock:
+                if self.overlaps != _overlaps:
+                    # Another thread's stages ran alongside this one: its peak is theirs too
+                    self.peak = None
+                if not stack:
+                    _busy_threads -= 1
+            if self.peak is not None:
+                self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self.memory)
+        if stack:
+            outer = stack[-1]
+            outer.children += duration
+            if self.tracked and self.peak is None:
+                outer.peak = None
+            elif self.tracked and outer.tracked and outer.peak is not None:
+                outer.peak = max(outer.peak, self.peak + self.memory - outer.memory)
+        REGISTRY.record((self.name, self.start, duration, duration - self.children, os.getpid(),
+                         threading.get_ident(), self.nbytes, self.peak, blocks))
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, nbytes=0):
+    """
+    Context manager timing the block inside it as one call of stage `name`.
+
+    Args:
+        name: stage name, e.g. "canny" or "lanes.hough".
+        nbytes: bytes the block processes, for the MB/s column.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, nbytes)
+
+
+def _array_bytes(args):
+    total = 0
+    for arg in args:
+        # Array instances have an int nbytes (np.float32 itself has a descriptor)
+        nbytes = getattr(arg, "nbytes", None)
+        if isinstance(nbytes, int):
+            total += nbytes
+    return total
+
+
+def _module_name(fn):
+    module = fn.__module__
+    if module in ("__main__", "__mp_main__"):
+        # A script: use its file name rather than whatever it's running as
+        path = getattr(sys.modules.get(module), "__file__", None)
+        if path:
+            module = os.path.splitext(os.path.basename(path))[0]
+    return module
+
+
+def profiled(fn=None, name=None):
+    """
+    Decorator timing every call of fn as a stage, named after the function (module.function) unless
+    a name is given. The stage's bytes are those of the arrays passed positionally.
+
+        @profiled
+        def my_filter(image, kernel): ...
+
+        canny = profiled(feature.canny, "skimage.canny")   # someone else's function
+    """
+    if fn is None:
+        return lambda fn: profiled(fn, name)
+    label = name or f"{_module_name(fn)}.{fn.__qualname__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return fn(*args, **kwargs)
+        with _Stage(label, _array_bytes(args)):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+if os.environ.get("PROFILE"):
+    enable(allocations=os.environ.get("PROFILE") == "allocations")
+
+
+def main(argv=None):
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Run a script with stage profiling on.")
+    parser.add_argument("--trace", help="also write a Chrome trace here")
+    parser.add_argument("--allocations", action="store_true", help="track memory per stage too (slower)")
+    parser.add_argument("--limit", type=int, help="only show the slowest stages")
+    parser.add_argument("script")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    enable(allocations=args.allocations)
+    sys.argv = [args.script] + args.args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    try:
+        runpy.run_path(args.script, run_name="__main__")
+    finally:
+        REGISTRY.print_summary(args.limit)
+        if args.trace:
+            REGISTRY.write_chrome_trace(args.trace)
+            print(f"trace written to {args.trace}")
+
+
+if __name__ == "__main__":
+    # Run through the importable module, so the script's own `import profiling` sees the same state
+    import profiling
+    profiling.main()
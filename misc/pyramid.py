@@ -0,0 +1,374 @@
+# """
+# Coarse-to-fine edge and line detection on an image pyramid.
+#
+# Lane lines and coin edges are still there at a quarter of the size, so there's no need to run
+# Canny and Hough over every pixel of a big frame to find out where they are. Blur and decimate the
+# image a couple of times (pyr_down: the same Gaussian and boundary modes as the rest of
+# convolution.py, but only computed at the pixels that survive the decimation), detect on the small
+# image, and then only go back over the neighbourhoods of what was found at the finer levels:
+#   - pyramid_canny: Canny at the coarsest level, then at each finer level the fused gradient pass
+#     (compiled.canny_gradients_blocks) only runs on the tiles that touch a band around the edges
+#     found one level up
+#   - pyramid_hough_lines: Canny + Hough at the coarsest level, then full resolution edges in a band
+#     around just the lines found there, and the Hough transform again on those for exact endpoints
+# Edges that don't show up at all at the coarse level aren't found, so this is for images whose
+# interesting structure is bigger than a few pixels (which is what makes large images worth it).
+#
+# Usage:
+#   python pyramid.py road.jpg 100 120 --upscale 4     # compare with full resolution on a 2048px road
+# """
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from canny import canny, default_ksize
+from convolution import gaussian_taps, output_buffer, pad_image, store, work_dtype
+from hough import probabilistic_hough_line
+from profiling import profiled
+
+
+@profiled
+def pyr_down(image, ksize=5, sigma=0, boundary="reflect", dtype=None, out=None):
+    """
+    Gaussian blur and drop every other row and column, like cv2.pyrDown (which is ksize 5, sigma 0
+    and "reflect"). This isn't bit-for-bit what cv2.pyrDown gives: the taps are summed in a
+    different order, so float32 results differ by float rounding (up to about 1e-7 on 0-1 images)
+    and uint8 ones by up to one level.
+
+    The blur is only worked out at the pixels that are kept: the column pass runs on every other
+    row and the row pass on every other column of that, well under half the work of blurring
+    everything and then slicing.
+
+    Args:
+        image: numpy array of shape (H, W) or (H, W, C).
+        ksize, sigma: Gaussian parameters, see `convolution.gaussian_taps`.
+        boundary: boundary mode, see `convolution.pad_image`.
+        dtype: dtype of the result. Defaults to image's dtype.
+        out: array of shape ((H + 1) // 2, (W + 1) // 2) (plus any channel axis) to write into.
+    Returns:
+        out
+    """
+    import compiled
+
+    rows, cols = (image.shape[0] + 1) // 2, (image.shape[1] + 1) // 2
+    if dtype is None and out is None:
+        dtype = image.dtype
+    out = output_buffer((rows, cols) + image.shape[2:], dtype, out)
+    work = work_dtype(out.dtype)
+    taps = gaussian_taps(ksize, sigma).astype(work)
+    padded = pad_image(image, (ksize, ksize), boundary).astype(work, copy=False)
+    # The compiled passes see channels as part of the row: (H, W * C)
+    channels = padded[0, 0].size
+    padded = padded.reshape(padded.shape[0], -1)
+
+    # Output pixel (i, j) is centered on input pixel (2i, 2j), which is padded pixel
+    # (2i + ksize // 2, 2j + ksize // 2): the taps start at padded row 2i and column 2j
+    shape = (rows, cols * channels)
+    direct = out.dtype == work and out.flags.c_contiguous
+    result = out.reshape(shape) if direct else np.empty(shape, dtype=work)
+    columns_done = np.empty((rows, padded.shape[1]), dtype=work)
+    compiled.decimate_columns(padded, taps, columns_done, channels)
+    compiled.decimate_rows(columns_done, taps, result, channels)
+    return out if direct else store(result.reshape(out.shape), out)
+
+
+def build_pyramid(image, levels, ksize=5, sigma=0, boundary="reflect", dtype=None):
+    """
+    Returns:
+        list of levels + 1 images, the original first, each one `pyr_down` of the one before.
+        dtype (default: image's dtype) applies to the smaller levels only.
+    """
+    pyramid = [image]
+    for _ in range(levels):
+        pyramid.append(pyr_down(pyramid[-1], ksize, sigma, boundary, dtype))
+    return pyramid
+
+
+def dilate(mask, radius):
+    """
+    Returns:
+        boolean mask of pixels within `radius` (in both x and y) of a pixel set in mask.
+    """
+    # A square max filter is a max over rows and then over columns; at the coarse level the mask is
+    # small, so shifted ORs are cheap enough
+    rows = mask.copy()
+    for d in range(1, radius + 1):
+        rows[d:] |= mask[:-d]
+        rows[:-d] |= mask[d:]
+    out = rows.copy()
+    for d in range(1, radius + 1):
+        out[:, d:] |= rows[:, :-d]
+        out[:, :-d] |= rows[:, d:]
+    return out
+
+
+def band_blocks(band, tile, scale=1):
+    """
+    Cover a band with blocks for compiled.canny_gradients_blocks: the image is cut into tile x tile
+    tiles, and each horizontal run of tiles with band pixels in them becomes one block (wider
+    blocks spend less time on their halos).
+
+    Args:
+        band: boolean mask, at 1 / scale of the image's size.
+        tile: tile side, in image pixels. A multiple of scale.
+        scale: how many image pixels each band pixel covers across.
+    Returns:
+        (N, 3) int64 array of (top, left, width) of the blocks, in image pixels.
+    """
+    if tile % scale:
+        raise ValueError(f"tile ({tile}) should be a multiple of the band's scale ({scale})")
+    step = tile // scale
+    rows, cols = -(-band.shape[0] // step), -(-band.shape[1] // step)
+    padded = np.zeros((rows * step, cols * step), dtype=np.bool_)
+    padded[:band.shape[0], :band.shape[1]] = band
+    touched = padded.reshape(rows, step, cols, step).any(axis=(1, 3))
+    # Runs start where a row of tiles goes from untouched to touched and end where it goes back
+    edges = np.diff(np.pad(touched.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    starts, ends = np.argwhere(edges == 1), np.argwhere(edges == -1)
+    return np.column_stack([starts[:, 0], starts[:, 1], ends[:, 1] - starts[:, 1]]).astype(np.int64) * tile
+
+
+def band_coverage(blocks, shape, tile):
+    """
+    Returns:
+        the fraction of the tile x tile tiles of an image of this shape that `band_blocks` covers.
+    """
+    tiles = -(-shape[0] // tile) * -(-shape[1] // tile)
+    return blocks[:, 2].sum() / tile / tiles
+
+
+@profiled
+def refine_edges(image, band, low_threshold, high_threshold, sigma=1.0, ksize=None, scale=1, tile=16, out=None,
+                 max_coverage=0.4, maxima=None, padded=None):
+    """
+    Canny, but only near band: the fused gradient pass only runs on the tiles with band pixels in
+    them, and there are no edges anywhere else. Inside those tiles this agrees exactly with
+    `canny.canny` on the whole image, as long as an edge's strong pixels are in them too.
+
+    Per pixel the tiles cost more than the whole-image pass (each one redoes its halo), so once
+    they'd cover more than max_coverage of the image this just runs `canny.canny` on all of it.
+    On a 2048px frame that pays off somewhere between 35% (scattered tiles) and 50% (long runs).
+
+    Args:
+        image: (H, W) numpy array.
+        band: boolean mask of where to look for edges, at image's size or (with scale > 1) at a
+            coarser pyramid level's.
+        low_threshold, high_threshold, sigma, ksize: see `canny.canny`.
+        scale: how many image pixels each band pixel covers across, e.g. 2 for the next level up.
+        tile: side of the tiles the gradient pass is split into, a multiple of scale.
+        out: boolean (H, W) array to write into. Defaults to a new one.
+        max_coverage: fraction of the image's tiles above which the whole image is done instead.
+        maxima, padded: scratch buffers, see `canny.canny` (padded is only used when the whole
+            image is done). Pass these, and out, to run on frame after frame without allocating.
+    Returns:
+        out: boolean edge map.
+    """
+    import compiled
+
+    if high_threshold < low_threshold:
+        raise ValueError("low_threshold should be lower than high_threshold")
+    taps = np.asarray(gaussian_taps(default_ksize(sigma) if ksize is None else ksize, sigma), dtype=np.float32)
+    if image.dtype not in (np.uint8, np.float32):
+        image = image.astype(np.float32)
+    if out is None:
+        out = np.empty(image.shape, dtype=np.bool_)
+    blocks = band_blocks(band, tile, scale)
+    if band_coverage(blocks, image.shape, tile) > max_coverage:
+        return canny(image, low_threshold, high_threshold, sigma, ksize, out=out, maxima=maxima, padded=padded)
+    # Outside the blocks there are no maxima, so hysteresis only has to look for strong pixels inside
+    if maxima is None:
+        maxima = np.zeros(image.shape, dtype=np.float32)
+    else:
+        maxima[:] = 0
+    compiled.canny_gradients_blocks(np.ascontiguousarray(image), taps, maxima, blocks, tile)
+    compiled.hysteresis_blocks(maxima, float(low_threshold), float(high_threshold), out, blocks, tile)
+    return out
+
+
+@profiled
+def pyramid_canny(image, low_threshold, high_threshold, sigma=1.0, ksize=None, levels=2, margin=1, tile=16,
+                  coarse_ratio=0.75, pyramid=None, max_coverage=0.4):
+    """
+    Coarse-to-fine Canny: detect on the smallest level of the pyramid, then at each finer level only
+    look within `margin` coarse pixels of the edges found one level up.
+
+    This only saves time when the edges are sparse. If the band around the coarsest edges touches
+    more than max_coverage of the next level's tiles (see `refine_edges`), the finer levels are
+    skipped and this returns plain `canny.canny` of the whole image, so on busy, textured images it
+    costs what full resolution Canny does plus the pyramid and the coarse pass. A finer level whose
+    band is too busy is done whole by `refine_edges`.
+
+    Args:
+        image: (H, W) numpy array.
+        low_threshold, high_threshold, sigma, ksize: see `canny.canny`, used at every level.
+            Gradients of a step edge come out about the same size at every level, so the thresholds
+            don't need rescaling.
+        levels: number of times to halve the image before detecting.
+        margin: how far (in pixels of the coarser level) around a coarse edge to look at the finer
+            level. 1 covers the half-pixel rounding of a decimated edge.
+        tile: tile side for the gradient pass at the finer levels, see `refine_edges`.
+        coarse_ratio: the coarsest level's thresholds are this fraction of the others. Fine edges
+            are fainter once blurred and decimated; looser thresholds there miss fewer of them, at
+            the cost of a wider band to refine.
+        pyramid: `build_pyramid(image, levels)` if you already have it.
+        max_coverage: see `refine_edges`.
+    Returns:
+        boolean (H, W) edge map.
+    """
+    if pyramid is None:
+        pyramid = build_pyramid(image, levels, dtype=np.float32)
+    edges = canny(pyramid[-1], low_threshold * coarse_ratio, high_threshold * coarse_ratio, sigma, ksize)
+    for index, level in enumerate(reversed(pyramid[:-1])):
+        band = dilate(edges, margin)
+        # The first band is the cheapest to check, and if it's too busy the finer ones will be too
+        if index == 0 and band_coverage(band_blocks(band, tile, 2), level.shape, tile) > max_coverage:
+            return canny(pyramid[0], low_threshold, high_threshold, sigma, ksize)
+        edges = refine_edges(level, band, low_threshold, high_threshold, sigma, ksize, 2, tile,
+                             max_coverage=max_coverage)
+    return edges
+
+
+@profiled
+def pyramid_hough_lines(image, low_threshold, high_threshold, threshold=10, line_length=50, line_gap=10,
+                        sigma=1.0, levels=2, margin=2, theta=None, rng=None, tile=16, coarse_ratio=0.75,
+                        max_coverage=0.4):
+    """
+    Coarse-to-fine line detection: Canny + probabilistic Hough on the smallest level of the pyramid,
+    with the segment lengths, gaps and vote threshold shrunk to match, then Canny at full resolution
+    only within `margin` coarse pixels of the lines found, and the Hough transform again on just
+    those edges. The full resolution pass has the final say on which lines there are and where
+    they end; the coarse one only has to not miss any.
+
+    This only saves time when the lines are sparse. If the band around the coarse lines touches
+    more than max_coverage of the full resolution tiles, Canny runs over the whole frame instead
+    (see `refine_edges`), and the Hough transform then sees all of its edges: the same lines as
+    full resolution detection, for its cost plus the coarse pass.
+
+    Args:
+        image: (H, W) numpy array.
+        low_threshold, high_threshold, sigma: Canny parameters, see `canny.canny`.
+        threshold, line_length, line_gap, theta, rng: see `hough.probabilistic_hough_line`, in full
+            resolution pixels.
+        levels: number of times to halve the image before detecting.
+        margin: how far (in coarse pixels) around a coarse line to look for its edges.
+        tile: tile side for the full resolution gradient pass, see `refine_edges`.
+        coarse_ratio: the coarse Canny thresholds, Hough votes and segment length are this fraction
+            of their scaled down values, so that faint or short lines still make it into the band.
+        max_coverage: see `refine_edges`.
+    Returns:
+        LineSet of the segments found, in full resolution coordinates.
+    """
+    from imagewriter import draw_lines
+
+    scale = 2 ** levels
+    small = build_pyramid(image, levels, dtype=np.float32)[-1]
+    coarse_edges = canny(small, low_threshold * coarse_ratio, high_threshold * coarse_ratio, sigma)
+    coarse = probabilistic_hough_line(coarse_edges, max(int(threshold * coarse_ratio / scale), 1),
+                                      max(int(line_length * coarse_ratio / scale), 1), max(line_gap // scale, 1),
+                                      theta, rng)
+    band = draw_lines(np.zeros(small.shape, dtype=np.bool_), coarse.segments, color=True)
+    edges = refine_edges(image, dilate(band, margin), low_threshold, high_threshold, sigma, scale=scale,
+                         tile=max(tile, scale), max_coverage=max_coverage)
+    return probabilistic_hough_line(edges, threshold, line_length, line_gap, theta, rng)
+
+
+def _agreement(expected, found, slack=1):
+    # Fraction of either edge map's pixels the other one has within `slack` pixels (like
+    # canny.compare_with_skimage)
+    near_expected, near_found = dilate(expected, slack), dilate(found, slack)
+    precision = np.count_nonzero(found & near_expected) / max(np.count_nonzero(found), 1)
+    recall = np.count_nonzero(expected & near_found) / max(np.count_nonzero(expected), 1)
+    return min(precision, recall)
+
+
+def compare_with_full_resolution(image, low_threshold, high_threshold, sigma=1.0, levels=2, repeats=5,
+                                 hough_options=None, skimage=False):
+    """
+    Time pyramid_canny and pyramid_hough_lines against canny + probabilistic_hough_line on the whole
+    image, and report how closely they agree.
+
+    Args:
+        image: (H, W) numpy array.
+        hough_options: dict of probabilistic_hough_line arguments. Lines aren't compared if None.
+        skimage: also time skimage's canny (and probabilistic_hough_line), what edges.py runs.
+    Returns:
+        dict with "ms" (median times of "canny", "pyramid_canny", and with hough_options "hough"
+        and "pyramid_hough", both including their Canny, plus "skimage_canny" and
+        "skimage_hough" if asked for), "edge_agreement" (see canny.compare_with_skimage) and with
+        hough_options "line_agreement": the same measure on the pixels of the drawn lines, allowing
+        2 pixels of slack.
+    """
+    from imagewriter import draw_lines
+
+    def median_ms(fn):
+        fn()
+        times = []
+        for _ in range(repeats):
+            start = perf_counter()
+            result = fn()
+            times.append(perf_counter() - start)
+        return np.median(times) * 1000, result
+
+    ms = {}
+    ms["canny"], expected = median_ms(lambda: canny(image, low_threshold, high_threshold, sigma))
+    ms["pyramid_canny"], edges = median_ms(lambda: pyramid_canny(image, low_threshold, high_threshold, sigma,
+                                                                  levels=levels))
+    result = {"ms": ms, "edge_agreement": _agreement(expected, edges)}
+    if skimage:
+        from skimage import feature, transform
+
+        ms["skimage_canny"], _ = median_ms(lambda: feature.canny(
+            image, sigma=sigma, low_threshold=low_threshold, high_threshold=high_threshold))
+    if hough_options is not None:
+        # Fixed seed, so both sides visit points in a repeatable order
+        options = dict(hough_options, rng=0)
+        ms["hough"], expected = median_ms(lambda: probabilistic_hough_line(
+            canny(image, low_threshold, high_threshold, sigma), **options))
+        ms["pyramid_hough"], lines = median_ms(lambda: pyramid_hough_lines(
+            image, low_threshold, high_threshold, sigma=sigma, levels=levels, **options))
+        drawn = [draw_lines(np.zeros(image.shape, dtype=np.bool_), found.segments, color=True)
+                 for found in (expected, lines)]
+        result.update(lines=(len(expected), len(lines)), line_agreement=_agreement(*drawn, slack=2))
+        if skimage:
+            ms["skimage_hough"], _ = median_ms(lambda: transform.probabilistic_hough_line(
+                feature.canny(image, sigma=sigma, low_threshold=low_threshold, high_threshold=high_threshold),
+                hough_options.get("threshold", 10), hough_options.get("line_length", 50),
+                hough_options.get("line_gap", 10), rng=0))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare coarse-to-fine detection with full resolution.")
+    parser.add_argument("image")
+    parser.add_argument("low", type=float)
+    parser.add_argument("high", type=float)
+    parser.add_argument("--sigma", type=float, default=1.0)
+    parser.add_argument("--levels", type=int, default=2)
+    parser.add_argument("--upscale", type=int, default=1, help="blow the image up first, to stand in for a big frame")
+    parser.add_argument("--threshold", type=int, default=50, help="Hough votes")
+    parser.add_argument("--line-length", type=int, default=25)
+    parser.add_argument("--line-gap", type=int, default=30)
+    parser.add_argument("--skimage", action="store_true", help="also time skimage's canny and Hough")
+    args = parser.parse_args()
+
+    import cv2
+
+    image = cv2.imread(args.image, flags=cv2.IMREAD_GRAYSCALE)
+    if args.upscale > 1:
+        image = cv2.resize(image, None, fx=args.upscale, fy=args.upscale, interpolation=cv2.INTER_CUBIC)
+    # Lengths are given for the original image
+    hough_options = {"threshold": args.threshold * args.upscale, "line_length": args.line_length * args.upscale,
+                     "line_gap": args.line_gap * args.upscale}
+    comparison = compare_with_full_resolution(image, args.low, args.high, args.sigma, args.levels,
+                                              hough_options=hough_options, skimage=args.skimage)
+    ms = comparison["ms"]
+    print(f"{image.shape[1]}x{image.shape[0]}, {args.levels} levels")
+    print(f"canny: full {ms['canny']:.1f} ms, pyramid {ms['pyramid_canny']:.1f} ms, "
+          f"{comparison['edge_agreement']:.1%} of edges agree")
+    print(f"canny + hough: full {ms['hough']:.1f} ms ({comparison['lines'][0]} lines), "
+          f"pyramid {ms['pyramid_hough']:.1f} ms ({comparison['lines'][1]} lines), "
+          f"{comparison['line_agreement']:.1%} of line pixels agree")
+    if args.skimage:
+        print(f"skimage: canny {ms['skimage_canny']:.1f} ms, canny + hough {ms['skimage_hough']:.1f} ms")
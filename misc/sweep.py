@@ -0,0 +1,272 @@
+# """
+# Parameter sweeps (blur sigma x kernel size, Canny thresholds) that share their work.
+#
+# edges.py explores parameters by rerunning the whole pipeline for every setting. Most settings
+# share most of that work, though:
+#   - a Gaussian only has so many taps that matter, so e.g. sigma=0.1 blurs identically at ksize 5
+#     and ksize 45; each (sigma, ksize) is cut down to the taps that carry weight first and grid
+#     points that end up with the same kernel share one blur
+#   - Canny's blur/gradients/non-maximum suppression don't depend on the thresholds, so a grid of
+#     thresholds costs one gradient pass plus a (cheap) hysteresis per threshold pair
+# Intermediates are kept in an IntermediateCache, an LRU cache with a cap on the bytes it holds,
+# keyed by (hash of the image, stage, kernel), so later sweeps over the same image reuse them too.
+# Independent pieces of a sweep run on a thread pool (the compiled kernels release the GIL).
+#
+# Usage:
+#   python sweep.py noisy_einstein.png      # 10x10 grids, compared with running every point from scratch
+# """
+
+import argparse
+import hashlib
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import perf_counter
+
+import numpy as np
+
+from convolution import IntermediateCache, gaussian_taps
+
+# Gaussian taps holding less than this much of the kernel's total weight are dropped
+TAP_TOLERANCE = 1e-7
+
+
+# Shared by every sweep that isn't given its own cache
+DEFAULT_CACHE = IntermediateCache()
+
+
+def image_key(image):
+    """A key identifying an image by its contents: shape, dtype and a hash of the pixels."""
+    digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).hexdigest()
+    return image.shape, image.dtype.str, digest
+
+
+@lru_cache(maxsize=256)
+def effective_gaussian(ksize, sigma, tolerance=TAP_TOLERANCE):
+    """
+    The Gaussian blur cv2.GaussianBlur(image, (ksize, ksize), sigma) does, with the outer taps that
+    carry (together) less than `tolerance` of its weight cut off. Different (ksize, sigma) pairs that
+    come out the same share the result, so e.g. every ksize gives the same kernel for sigma=0.1.
+
+    Returns:
+        (ksize, sigma) of the trimmed kernel: pass these to `gaussian_taps`.
+    """
+    if sigma <= 0:
+        # OpenCV works sigma out from ksize, so the kernel size is part of what the kernel is
+        return ksize, sigma
+    taps = gaussian_taps(ksize, sigma)
+    # Weight outside the middle 2r+1 taps, for r = 0, 1, ...
+    outside = 1 - np.array([taps[ksize // 2 - r:ksize // 2 + r + 1].sum() for r in range(ksize // 2 + 1)])
+    radius = int(np.argmax(outside <= tolerance)) if (outside <= tolerance).any() else ksize // 2
+    return 2 * radius + 1, sigma
+
+
+def _run(tasks, workers):
+    """Run functions of no arguments on a thread pool (or inline for one worker), in order."""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda task: task(), tasks))
+
+
+def image_spectrum(image, size, boundary="reflect", cache=None, key=None):
+    """
+    The image's half of an FFT convolution with any kernel up to size x size, through the cache.
+
+    Returns:
+        rfft2 of the image padded for a (size, size) kernel (read-only, it may be shared).
+    """
+    from convolution import fft_shape_for, pad_image
+
+    cache = DEFAULT_CACHE if cache is None else cache
+    key = image_key(image) if key is None else key
+
+    def compute():
+        padded = pad_image(image.astype(np.float64, copy=False), (size, size), boundary)
+        return np.fft.rfft2(padded, s=fft_shape_for(image.shape, (size, size)), axes=(0, 1))
+
+    return cache.cached((key, "spectrum", size, boundary), compute)
+
+
+def blur(image, ksize, sigma, boundary="reflect", cache=None, key=None, spectrum_size=None):
+    """
+    Gaussian blur through the cache. boundary defaults to "reflect", which is OpenCV's default
+    border, so this matches cv2.GaussianBlur(image, (ksize, ksize), sigma) up to rounding.
+
+    Args:
+        image: (H, W) or (H, W, C) numpy array.
+        ksize, sigma: Gaussian parameters, see `convolution.gaussian_taps`.
+        boundary: boundary mode, see `convolution.pad_image`.
+        cache: IntermediateCache to use. Defaults to DEFAULT_CACHE.
+        key: `image_key(image)`, if you already have it.
+        spectrum_size: largest kernel size in the sweep. Kernels that are cheaper to apply by FFT
+            then share one transform of the image (`image_spectrum`) and only pay for the inverse.
+    Returns:
+        blurred: float64 array of image's shape (read-only, it may be shared).
+    """
+    from convolution import convolve, fft_cost, fft_shape_for, gaussian_kernel, separable_cost
+
+    cache = DEFAULT_CACHE if cache is None else cache
+    key = image_key(image) if key is None else key
+    ksize, sigma = effective_gaussian(ksize, sigma)
+    kernel = gaussian_kernel(ksize, sigma)
+
+    def compute():
+        taps = gaussian_taps(ksize, sigma)
+        # With the image's transform already paid for, an FFT blur is a multiply and one inverse
+        if spectrum_size is None or fft_cost(image.shape, kernel) / 2 >= separable_cost(image.shape, [(taps, taps)]):
+            return convolve(image, kernel, boundary)
+        # Taps zero-padded (about their center) to spectrum_size read exactly the pixels they did
+        # before, so every kernel can use the image padded for the biggest one
+        spectrum = image_spectrum(image, spectrum_size, boundary, cache, key)
+        embedded = np.zeros(spectrum_size)
+        start = spectrum_size // 2 - ksize // 2
+        embedded[start:start + ksize] = taps
+        fft_shape = fft_shape_for(image.shape, (spectrum_size, spectrum_size))
+        # The Gaussian is separable, so its 2D spectrum is the outer product of two 1D ones (and
+        # conjugated, for correlation, as in convolution.kernel_spectrum)
+        kernel_spectrum = np.conj(np.outer(np.fft.fft(embedded, fft_shape[0]), np.fft.rfft(embedded, fft_shape[1])))
+        product = spectrum * kernel_spectrum.reshape(kernel_spectrum.shape + (1,) * (image.ndim - 2))
+        out = np.fft.irfft2(product, s=fft_shape, axes=(0, 1))
+        return np.ascontiguousarray(out[:image.shape[0], :image.shape[1]])
+
+    return cache.cached((key, "blur", ksize, sigma, boundary), compute)
+
+
+def gradient_maxima(image, sigma=1.0, ksize=None, cache=None, key=None, parallel=True):
+    """
+    canny.gradient_maxima through the cache: everything Canny does before the thresholds.
+
+    Returns:
+        float32 array of image's shape (read-only, it may be shared).
+    """
+    import canny
+
+    cache = DEFAULT_CACHE if cache is None else cache
+    key = image_key(image) if key is None else key
+    ksize, sigma = effective_gaussian(canny.default_ksize(sigma) if ksize is None else ksize, sigma)
+    return cache.cached((key, "canny", ksize, sigma),
+                        lambda: canny.gradient_maxima(image, taps=gaussian_taps(ksize, sigma), parallel=parallel))
+
+
+def blur_sweep(image, ksizes, sigmas, boundary="reflect", cache=None, workers=None):
+    """
+    Blur an image with every combination of kernel size and sigma. Each distinct (trimmed) kernel
+    is computed once, in parallel across kernels, and the large ones share one FFT of the image.
+
+    Args:
+        image: (H, W) or (H, W, C) numpy array.
+        ksizes: odd kernel sizes.
+        sigmas: Gaussian standard deviations.
+        boundary: boundary mode, see `blur`.
+        cache: IntermediateCache to use. Defaults to DEFAULT_CACHE.
+        workers: threads to use. Defaults to one per CPU.
+    Returns:
+        dict mapping (ksize, sigma) to the blurred image. Grid points with the same effective
+        kernel share one array; every distinct blur is in here whatever the cache's byte cap is.
+    """
+    key = image_key(image)
+    grid = list(itertools.product(ksizes, sigmas))
+    kernels = sorted({effective_gaussian(ksize, sigma) for ksize, sigma in grid})
+    largest = max(ksize for ksize, _ in kernels)
+    # Use what the workers computed, rather than asking the cache again: it may have evicted them
+    tasks = [lambda ksize=ksize, sigma=sigma: blur(image, ksize, sigma, boundary, cache, key, largest)
+             for ksize, sigma in kernels]
+    blurred = dict(zip(kernels, _run(tasks, workers)))
+    return {(ksize, sigma): blurred[effective_gaussian(ksize, sigma)] for ksize, sigma in grid}
+
+
+def canny_sweep(image, thresholds, sigmas=(1.0,), ksizes=(None,), cache=None, workers=None):
+    """
+    Canny with every combination of blur and thresholds. The blur/gradient pass runs once per
+    distinct kernel and the hysteresis thresholds are all tried against it, in parallel across
+    kernels.
+
+    Args:
+        image: (H, W) numpy array.
+        thresholds: (low, high) pairs to try.
+        sigmas: Gaussian standard deviations.
+        ksizes: Gaussian kernel sizes (None means the canny.default_ksize for each sigma).
+        cache: IntermediateCache to use. Defaults to DEFAULT_CACHE.
+        workers: threads to use. Defaults to one per CPU.
+    Returns:
+        dict mapping (sigma, ksize, low, high) to the boolean edge map.
+    """
+    from canny import hysteresis
+
+    key = image_key(image)
+    workers = workers or os.cpu_count() or 1
+    groups = list(dict.fromkeys(itertools.product(sigmas, ksizes)))
+    thresholds = [tuple(pair) for pair in thresholds]
+    # When the groups run on our own threads, keep numba's thread pool out of it
+    parallel = workers == 1 or len(groups) == 1
+
+    def run_group(sigma, ksize):
+        maxima = gradient_maxima(image, sigma, ksize, cache, key, parallel=parallel)
+        return {(sigma, ksize, low, high): hysteresis(maxima, low, high) for low, high in thresholds}
+
+    results = {}
+    for edges in _run([lambda sigma=sigma, ksize=ksize: run_group(sigma, ksize) for sigma, ksize in groups],
+                      workers):
+        results.update(edges)
+    return results
+
+
+def compare_with_scratch(image, sigmas=None, ksizes=None, thresholds=None, workers=None):
+    """
+    Time 10x10 sweeps like the ones in edges.py (sigma x ksize blurs on the image, and low x high
+    Canny thresholds on its grayscale version) done with blur_sweep/canny_sweep against running every grid
+    point from scratch with OpenCV/skimage.
+
+    Returns:
+        dict mapping "blur"/"canny" to (scratch seconds, sweep seconds).
+    """
+    import cv2
+    from skimage import feature
+
+    sigmas = sigmas or [0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10]
+    ksizes = ksizes or [5, 9, 13, 17, 21, 25, 29, 33, 39, 45]
+    thresholds = thresholds or [(low, high) for low in range(5, 55, 5) for high in range(55, 105, 5)]
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    timings = {}
+
+    # The sweep works in float64 too; converting once here keeps that copy out of the scratch timing
+    as_float = image.astype(np.float64)
+
+    # Get compiling, FFT planning etc. out of the way on both sides
+    cv2.GaussianBlur(as_float, (ksizes[-1], ksizes[-1]), sigmas[-1])
+    feature.canny(gray, sigma=1, low_threshold=thresholds[0][0], high_threshold=thresholds[0][1])
+    blur_sweep(image, ksizes[-1:], sigmas[-1:], cache=IntermediateCache(), workers=workers)
+    canny_sweep(gray, thresholds[:1], cache=IntermediateCache(), workers=workers)
+
+    start = perf_counter()
+    for ksize, sigma in itertools.product(ksizes, sigmas):
+        cv2.GaussianBlur(as_float, (ksize, ksize), sigma)
+    scratch = perf_counter() - start
+    start = perf_counter()
+    blur_sweep(image, ksizes, sigmas, cache=IntermediateCache(), workers=workers)
+    timings["blur"] = (scratch, perf_counter() - start)
+
+    start = perf_counter()
+    for low, high in thresholds:
+        feature.canny(gray, sigma=1, low_threshold=low, high_threshold=high)
+    scratch = perf_counter() - start
+    start = perf_counter()
+    canny_sweep(gray, thresholds, cache=IntermediateCache(), workers=workers)
+    timings["canny"] = (scratch, perf_counter() - start)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time parameter sweeps against running every point from scratch.")
+    parser.add_argument("image")
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    import cv2
+
+    for name, (scratch, swept) in compare_with_scratch(cv2.imread(args.image), workers=args.workers).items():
+        print(f"{name:<6} from scratch {scratch * 1000:8.1f} ms, sweep {swept * 1000:8.1f} ms "
+              f"({scratch / swept:.1f}x)")
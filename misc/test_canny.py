@@ -0,0 +1,40 @@
+# """
+# Hysteresis only ever keeps gradient maxima, whatever the thresholds, in canny.canny and in the
+# block-restricted pyramid.refine_edges that shares its kernel.
+#
+# Usage:
+#   python -m pytest test_canny.py
+# """
+
+import numpy as np
+import pytest
+
+from canny import canny, gradient_maxima
+from pyramid import refine_edges
+
+
+def disks():
+    rows, cols = np.mgrid[:96, :128]
+    image = np.zeros((96, 128), dtype=np.float32)
+    for y, x, r in ((30, 40, 18), (60, 90, 25)):
+        image[(rows - y) ** 2 + (cols - x) ** 2 < r * r] = 200
+    return image + np.random.default_rng(0).normal(0, 2, image.shape).astype(np.float32)
+
+
+@pytest.mark.parametrize("low", [0, -1])
+def test_low_threshold_zero_only_keeps_maxima(low):
+    image = disks()
+    maxima = gradient_maxima(image) > 0
+    edges = canny(image, low, 50)
+    assert edges.any()
+    assert not (edges & ~maxima).any()
+    assert np.count_nonzero(edges) < 0.2 * edges.size
+
+
+def test_refine_edges_low_threshold_zero():
+    image = disks()
+    band = np.ones(image.shape, dtype=np.bool_)
+    # max_coverage=1 keeps it on the block kernels rather than falling back to canny
+    edges = refine_edges(image, band, 0, 50, max_coverage=1)
+    assert not (edges & ~(gradient_maxima(image) > 0)).any()
+    np.testing.assert_array_equal(edges, canny(image, 0, 50))
@@ -0,0 +1,54 @@
+# """
+# The float32/uint8 paths of the convolution backends against their own float64 results, allocating
+# the result and writing into a caller's out, and filters.load's conversion to floats.
+#
+# Usage:
+#   python -m pytest test_dtypes.py
+# """
+
+import numpy as np
+import pytest
+
+import convolution
+import filters
+from benchmark import ACCURACY_BOUNDS, check_accuracy, dtype_backends
+
+
+@pytest.mark.parametrize("dtype", ["float32", "uint8"])
+@pytest.mark.parametrize("backend", list(dtype_backends()))
+def test_matches_float64(backend, dtype):
+    # The sweep runs here rather than at collection, so a backend that raises fails its own test
+    results = check_accuracy(dtypes=(dtype,), backends={backend: dtype_backends()[backend]})
+    assert results
+    for result in results:
+        assert result["error"] <= result["bound"], result
+        assert result["ok"], result
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_multichannel_out_gets_passthrough_channels(dtype):
+    image = np.random.default_rng(0).random((24, 32, 3)).astype(dtype)
+    out = np.full(image.shape, np.nan, dtype=dtype)
+    convolution.multichannel_convolution_filter(image, {"R": np.full((3, 3), 1 / 9)}, out=out)
+    assert not np.isnan(out).any()
+    np.testing.assert_array_equal(out[..., 1:], image[..., 1:])
+
+
+def test_uint8_out_is_fully_written():
+    image = np.random.default_rng(1).integers(0, 256, (24, 32), dtype=np.uint8)
+    kernel = convolution.gaussian_kernel(5, 1)
+    reference = convolution.strided_convolution_filter(image, kernel, "reflect")
+    for fill in (0, 255):
+        out = np.full(image.shape, fill, dtype=np.uint8)
+        convolution.strided_convolution_filter(image, kernel, "reflect", out=out)
+        expected = np.clip(np.rint(reference), 0, 255)
+        assert np.abs(out - expected).max() <= ACCURACY_BOUNDS["uint8"]
+
+
+def test_load_float64_matches_dividing_by_255(tmp_path):
+    from skimage import io
+
+    pixels = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    io.imsave(tmp_path / "ramp.png", pixels, check_contrast=False)
+    np.testing.assert_array_equal(filters.load(tmp_path / "ramp.png"), pixels.astype(np.float64) / 255)
+    np.testing.assert_array_equal(filters.load(tmp_path / "ramp.png", np.float32), pixels.astype(np.float32) / 255)
@@ -0,0 +1,32 @@
+# """
+# The library modules import quickly, without loading numba, skimage, matplotlib or cv2 (see
+# benchmark.py --import-budget). Each check runs in a fresh interpreter.
+#
+# Usage:
+#   python -m pytest test_imports.py
+# """
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmark import LIBRARY_MODULES, import_time
+
+# Seconds each module may take to import on top of NumPy, as in `benchmark.py --import-budget 0.1`
+IMPORT_BUDGET = 0.1
+HEAVY_MODULES = ("numba", "skimage", "matplotlib", "cv2")
+
+
+@pytest.mark.parametrize("module", LIBRARY_MODULES)
+def test_import_time_within_budget(module):
+    assert import_time(module) <= IMPORT_BUDGET
+
+
+@pytest.mark.parametrize("module", LIBRARY_MODULES)
+def test_import_leaves_heavy_modules_unloaded(module):
+    script = f"import sys, {module}; print(' '.join(sorted(sys.modules)))"
+    here = os.path.dirname(os.path.abspath(__file__))
+    loaded = set(subprocess.check_output([sys.executable, "-c", script], cwd=here, text=True).split())
+    assert not loaded & set(HEAVY_MODULES)